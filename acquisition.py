@@ -0,0 +1,268 @@
+"""Threaded image acquisition.
+
+An :class:`AcquisitionEngine` grabs frames from a camera in a
+background thread and hands them to consumers through a bounded queue
+so that slow consumers do not lower the camera frame rate. Frames are
+grabbed with :meth:`camera.Camera.get_image`, so ring buffer recording
+happens on the grab thread as well.
+
+Camera drivers talking to the hardware through ctypes release the GIL
+while waiting for the library (e.g., in ``is_FreezeVideo`` or
+``is_WaitForNextImage``), so the grab thread does not keep consumer
+threads from running while it waits for frames.
+
+"""
+
+import time
+import threading
+from collections import deque
+from log import logger
+from exceptions import CameraError
+
+#: Overflow policies for the frame queue.
+POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+
+class AcquisitionEngine(object):
+    """Grab frames from a camera in a background thread.
+
+    Frames are either consumed by iterating over the engine (or
+    calling :meth:`get`) or by registering callbacks with
+    :meth:`add_callback`, which are then run on a separate dispatch
+    thread. Frames taken from the queue are returned to the camera
+    with :meth:`camera.Camera.release_image` when consumers are done
+    with them: callbacks and iterators do this automatically once the
+    callback returns or the next frame is requested, respectively.
+    Consumers that need to keep a frame for longer should copy it.
+
+    Attributes
+    ----------
+    frames_acquired : int
+        Number of frames grabbed from the camera.
+    frames_delivered : int
+        Number of frames handed to consumers.
+    frames_dropped : int
+        Number of frames discarded because the queue was full.
+
+    """
+    def __init__(self, camera, maxsize=16, policy='drop_oldest'):
+        """Create a new acquisition engine.
+
+        Parameters
+        ----------
+        camera : Camera
+            The camera to acquire frames from.
+        maxsize : int
+            Maximum number of frames waiting in the queue.
+        policy : str
+            What to do when the queue is full: ``'block'`` waits for a
+            consumer to take a frame (which stalls acquisition),
+            ``'drop_oldest'`` discards the oldest queued frame and
+            ``'drop_newest'`` discards the newly acquired frame.
+
+        """
+        if policy not in POLICIES:
+            raise CameraError(
+                "Invalid overflow policy {}. Must be one of {}".format(
+                    policy, POLICIES))
+        assert maxsize >= 1
+        self.camera = camera
+        self.maxsize = maxsize
+        self.policy = policy
+        self.frames_acquired = 0
+        self.frames_delivered = 0
+        self.frames_dropped = 0
+        self.error = None
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._callbacks = []
+        self._running = False
+        self._threads = []
+        self._t_start = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.stop()
+
+    def __iter__(self):
+        return self.frames()
+
+    @property
+    def running(self):
+        return self._running
+
+    def add_callback(self, func):
+        """Register a function to be called with each frame. Callbacks
+        run on the dispatch thread, which is started along with the
+        engine if any callbacks are registered.
+
+        """
+        assert callable(func)
+        self._callbacks.append(func)
+
+    def start(self):
+        """Start grabbing frames."""
+        if self._running:
+            return
+        self._running = True
+        self.error = None
+        self._t_start = time.perf_counter()
+        targets = [self._grab_loop]
+        if self._callbacks:
+            targets.append(self._dispatch_loop)
+        self._threads = [
+            threading.Thread(target=target) for target in targets]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop grabbing frames and release all frames still waiting
+        in the queue.
+
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+        with self._condition:
+            while self._queue:
+                self.camera.release_image(self._queue.popleft()[0])
+
+    def stats(self):
+        """Return a dict of frame counters and the achieved delivery
+        rate.
+
+        """
+        elapsed = time.perf_counter() - self._t_start if self._t_start else 0
+        return {
+            'acquired': self.frames_acquired,
+            'delivered': self.frames_delivered,
+            'dropped': self.frames_dropped,
+            'queued': len(self._queue),
+            'fps': self.frames_delivered/elapsed if elapsed else 0.,
+        }
+
+    def _put(self, frame, timestamp):
+        """Add a frame and its acquisition timestamp to the queue
+        according to the overflow policy.
+
+        """
+        with self._condition:
+            if len(self._queue) >= self.maxsize:
+                if self.policy == 'block':
+                    while self._running and len(self._queue) >= self.maxsize:
+                        self._condition.wait()
+                    if not self._running:
+                        self.camera.release_image(frame)
+                        return
+                elif self.policy == 'drop_oldest':
+                    self.camera.release_image(self._queue.popleft()[0])
+                    self.frames_dropped += 1
+                else:
+                    self.camera.release_image(frame)
+                    self.frames_dropped += 1
+                    return
+            self._queue.append((frame, timestamp))
+            self._condition.notify_all()
+
+    def _grab_loop(self):
+        while self._running:
+            try:
+                frame = self.camera.get_image()
+            except CameraError as e:
+                logger.error('Acquisition error: {}'.format(e))
+                continue
+            except Exception as e:
+                logger.exception('Stopping acquisition thread.')
+                with self._condition:
+                    self.error = e
+                    self._running = False
+                    self._condition.notify_all()
+                return
+            self.frames_acquired += 1
+            self._put(frame, self.camera.last_timestamp)
+
+    def _dispatch_loop(self):
+        latency = self.camera.latency
+        while True:
+            try:
+                frame = self.get()
+            except (IndexError, CameraError):
+                return
+            t0 = latency.clock() if latency.enabled else None
+            try:
+                for func in self._callbacks:
+                    func(frame)
+            except Exception:
+                logger.exception('Error in frame callback.')
+            finally:
+                self.camera.release_image(frame)
+            if t0 is not None:
+                latency.record('callbacks', t0)
+
+    def get(self, timeout=None, with_timestamp=False):
+        """Take the next frame from the queue. If ``with_timestamp`` is
+        True, return a tuple of the frame and the time at which it was
+        acquired (see :attr:`camera.Camera.last_timestamp`).
+
+        Raises
+        ------
+        IndexError
+            If no frame becomes available within ``timeout`` seconds
+            or the engine was stopped with no frames left.
+
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self._condition:
+            while not self._queue:
+                if not self._running:
+                    if self.error is not None:
+                        raise CameraError(
+                            "Acquisition failed: {}".format(self.error))
+                    raise IndexError("No frames available.")
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        raise IndexError("No frames available.")
+                    self._condition.wait(remaining)
+            frame, timestamp = self._queue.popleft()
+            self.frames_delivered += 1
+            self._condition.notify_all()
+            return (frame, timestamp) if with_timestamp else frame
+
+    def frames(self, timeout=None):
+        """Iterate over acquired frames until the engine is stopped.
+
+        Each frame is released back to the camera when the next one is
+        requested, so frames must be copied if they are to be kept.
+        With latency instrumentation enabled, the time taken by the
+        consumer to request the next frame is recorded as the
+        ``consumer`` stage.
+
+        """
+        latency = self.camera.latency
+        frame = None
+        try:
+            while True:
+                try:
+                    frame = self.get(timeout)
+                except IndexError:
+                    return
+                t0 = latency.clock() if latency.enabled else None
+                yield frame
+                if t0 is not None:
+                    latency.record('consumer', t0)
+                self.camera.release_image(frame)
+                frame = None
+        finally:
+            if frame is not None:
+                self.camera.release_image(frame)
@@ -0,0 +1,476 @@
+"""Acquisition benchmark suite.
+
+Measures the throughput of each stage of the acquisition path:
+
+* ``acquire``: :meth:`camera.Camera.acquire_image_data`
+* ``get_image``: :meth:`camera.Camera.get_image` with ring buffer
+  recording on and off
+* ``rbuffer_write`` and ``rbuffer_read``: writing single frames to and
+  reading all frames back from each ring buffer backend
+* ``colormap``: :func:`image.apply_colormap`
+* ``binning``: :func:`image.bin_image`
+* ``trigger``: software trigger to frame with a pre-armed burst
+  (ThorLabs cameras only)
+
+Each benchmark is swept across image sizes (ROIs), bit depths and, for
+the ring buffer, buffer lengths. Cameras are simulated by default
+(:class:`simulated.SimulatedCamera`); ``--camera fake`` runs the
+ThorLabs driver against :class:`fakeuc480.FakeUC480` and ``--camera
+thorlabs`` against real hardware. For example::
+
+  $ python benchmark.py --json > results.json
+  $ python benchmark.py --save-baseline baseline.json
+  $ python benchmark.py --baseline baseline.json acquire get_image
+
+When comparing against a baseline, results with a frame rate more than
+``--tolerance`` below the baseline are flagged as regressions and the
+exit status is 1.
+
+"""
+
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import itertools
+import numpy as np
+from log import logger
+
+#: Image sizes (width, height) benchmarked by default.
+ROIS = [(1280, 1024), (640, 480), (320, 240), (40, 32)]
+
+#: Bits per pixel benchmarked by default.
+DEPTHS = [8, 16]
+
+#: Ring buffer lengths benchmarked by default.
+BUFFER_LENGTHS = [16, 128]
+
+#: Binning factors benchmarked.
+BINS = [2, 4, 8]
+
+#: Camera backends.
+CAMERAS = ('simulated', 'fake', 'thorlabs')
+
+
+class Context(object):
+    """Settings shared by all benchmarks of a run."""
+    def __init__(self, camera='simulated', rois=ROIS, depths=DEPTHS,
+                 buffer_lengths=BUFFER_LENGTHS, frames=100,
+                 rbuffer_backends=('memory', 'hdf5', 'mmap')):
+        assert camera in CAMERAS
+        assert frames >= 1
+        self.camera = camera
+        self.rois = list(rois)
+        self.depths = list(depths)
+        self.buffer_lengths = list(buffer_lengths)
+        self.frames = frames
+        self.rbuffer_backends = list(rbuffer_backends)
+        self.directory = tempfile.mkdtemp()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, tb):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open_camera(self, depth, **kwargs):
+        """Open a camera with images of ``depth`` bits. Returns None if
+        the camera does not support the depth.
+
+        """
+        kwargs.setdefault('buffer_backend', 'memory')
+        kwargs.setdefault('buffer_dir', self.directory)
+        if self.camera == 'simulated':
+            from simulated import SimulatedCamera
+            return SimulatedCamera(depth=depth, **kwargs)
+        # The ThorLabs driver only implements 8 bit mono.
+        if depth != 8:
+            return None
+        from thorlabs import ThorlabsDCx
+        if self.camera == 'fake':
+            from fakeuc480 import FakeUC480
+            kwargs['library'] = FakeUC480(fps=None)
+        return ThorlabsDCx(**kwargs)
+
+    def sample_frames(self, roi, depth, n=8):
+        """Return ``n`` simulated frames of size ``roi`` (width,
+        height).
+
+        """
+        from simulated import FrameGenerator
+        width, height = roi
+        generator = FrameGenerator(
+            (width, height), (width//2, height//2), depth=depth, seed=0)
+        return [generator.render() for _ in range(n)]
+
+
+def _time(func, n, warmup=3):
+    """Call ``func`` ``warmup`` + ``n`` times and return the durations
+    of the last ``n`` calls in s.
+
+    """
+    for _ in range(warmup):
+        func()
+    times = np.empty(n)
+    for i in range(n):
+        t0 = time.perf_counter()
+        func()
+        times[i] = time.perf_counter() - t0
+    return times
+
+
+def _result(benchmark, params, times, nbytes):
+    """Summarize the durations of ``len(times)`` operations each
+    processing ``nbytes`` bytes.
+
+    """
+    total = float(times.sum())
+    return {
+        'benchmark': benchmark,
+        'params': params,
+        'fps': len(times)/total if total else float('inf'),
+        'MBps': nbytes*len(times)/total/1e6 if total else float('inf'),
+        'median_us': float(np.median(times))*1e6,
+        'p99_us': float(np.percentile(times, 99))*1e6,
+    }
+
+
+def _roi_name(roi):
+    return '{}x{}'.format(*roi)
+
+
+def bench_acquire(ctx):
+    """Time :meth:`acquire_image_data` (releasing each frame)."""
+    results = []
+    for depth in ctx.depths:
+        cam = ctx.open_camera(depth, recording=False)
+        if cam is None:
+            continue
+        with cam:
+            cam.start()
+            for roi in ctx.rois:
+                cam.set_crop([1, roi[0], 1, roi[1]])
+                frame = cam.acquire_image_data()
+                cam.release_image(frame)
+
+                def acquire():
+                    cam.release_image(cam.acquire_image_data())
+                times = _time(acquire, ctx.frames)
+                results.append(_result(
+                    'acquire', {'roi': _roi_name(roi), 'depth': depth},
+                    times, frame.nbytes))
+            cam.stop()
+    return results
+
+
+def bench_get_image(ctx):
+    """Time :meth:`get_image` with ring buffer recording on and
+    off.
+
+    """
+    results = []
+    for depth in ctx.depths:
+        for recording in (False, True):
+            cam = ctx.open_camera(
+                depth, recording=recording,
+                buffer_options={'N': max(ctx.buffer_lengths)})
+            if cam is None:
+                continue
+            with cam:
+                cam.start()
+                for roi in ctx.rois:
+                    cam.set_crop([1, roi[0], 1, roi[1]])
+                    frame = cam.get_image()
+                    cam.release_image(frame)
+
+                    def get_image():
+                        cam.release_image(cam.get_image())
+                    times = _time(get_image, ctx.frames)
+                    results.append(_result(
+                        'get_image',
+                        {'roi': _roi_name(roi), 'depth': depth,
+                         'recording': recording},
+                        times, frame.nbytes))
+                cam.stop()
+    return results
+
+
+def _open_rbuffer(ctx, backend, N, frame):
+    from ringbuffer import BACKENDS
+    return BACKENDS[backend](
+        directory=ctx.directory, N=N, shape=frame.shape, dtype=frame.dtype)
+
+
+def bench_rbuffer_write(ctx):
+    """Time writing single frames to each ring buffer backend."""
+    results = []
+    for backend in ctx.rbuffer_backends:
+        for depth in ctx.depths:
+            for roi in ctx.rois:
+                frames = ctx.sample_frames(roi, depth)
+                for N in ctx.buffer_lengths:
+                    with _open_rbuffer(ctx, backend, N, frames[0]) as rb:
+                        i = itertools.count()
+
+                        def write():
+                            rb.write(frames[next(i) % len(frames)])
+                        times = _time(write, ctx.frames)
+                        rb.drain()
+                    results.append(_result(
+                        'rbuffer_write',
+                        {'backend': backend, 'roi': _roi_name(roi),
+                         'depth': depth, 'N': N},
+                        times, frames[0].nbytes))
+    return results
+
+
+def bench_rbuffer_read(ctx):
+    """Time reading a full ring buffer in chronological order with
+    :meth:`to_array`. Frame rates are in frames read per second.
+
+    """
+    results = []
+    for backend in ctx.rbuffer_backends:
+        for depth in ctx.depths:
+            for roi in ctx.rois:
+                frames = ctx.sample_frames(roi, depth)
+                for N in ctx.buffer_lengths:
+                    with _open_rbuffer(ctx, backend, N, frames[0]) as rb:
+                        for i in range(N):
+                            rb.write(frames[i % len(frames)])
+                        rb.drain()
+                        repeat = max(1, ctx.frames//N)
+                        times = _time(rb.to_array, repeat, warmup=1)/N
+                    times = np.repeat(times, N)
+                    results.append(_result(
+                        'rbuffer_read',
+                        {'backend': backend, 'roi': _roi_name(roi),
+                         'depth': depth, 'N': N},
+                        times, frames[0].nbytes))
+    return results
+
+
+def bench_colormap(ctx):
+    """Time applying a colormap with fixed limits (the lookup table
+    path used for live display).
+
+    """
+    from image import apply_colormap
+    results = []
+    for depth in ctx.depths:
+        for roi in ctx.rois:
+            frame = ctx.sample_frames(roi, depth, n=1)[0]
+            vmax = 2**depth - 1
+            out = np.empty(frame.shape + (4,), dtype=np.uint8)
+            times = _time(
+                lambda: apply_colormap(frame, 'viridis', 0, vmax, out=out),
+                ctx.frames)
+            results.append(_result(
+                'colormap', {'roi': _roi_name(roi), 'depth': depth},
+                times, frame.nbytes))
+    return results
+
+
+def bench_binning(ctx):
+    """Time software binning by summing."""
+    from image import bin_image
+    results = []
+    for depth in ctx.depths:
+        for roi in ctx.rois:
+            frame = ctx.sample_frames(roi, depth, n=1)[0]
+            for bins in BINS:
+                if bins > min(frame.shape):
+                    continue
+                times = _time(lambda: bin_image(frame, bins), ctx.frames)
+                results.append(_result(
+                    'binning',
+                    {'roi': _roi_name(roi), 'depth': depth, 'bins': bins},
+                    times, frame.nbytes))
+    return results
+
+
+def bench_trigger(ctx):
+    """Time from a software trigger until :meth:`get_image` returns
+    the frame, with a pre-armed burst (see
+    :meth:`thorlabs.ThorlabsDCx.arm`).
+
+    """
+    results = []
+    if ctx.camera == 'simulated':
+        return results
+    for depth in ctx.depths:
+        cam = ctx.open_camera(depth, recording=False)
+        if cam is None:
+            continue
+        with cam:
+            cam.set_trigger_mode('software')
+            for roi in ctx.rois:
+                cam.set_crop([1, roi[0], 1, roi[1]])
+                cam.arm(min(ctx.buffer_lengths))
+
+                def trigger():
+                    cam.trigger()
+                    cam.release_image(cam.get_image())
+                times = _time(trigger, ctx.frames)
+                results.append(_result(
+                    'trigger', {'roi': _roi_name(roi), 'depth': depth},
+                    times, roi[0]*roi[1]*((depth + 7)//8)))
+            cam.disarm()
+    return results
+
+
+#: Available benchmarks in the order they are run.
+BENCHMARKS = {
+    'acquire': bench_acquire,
+    'get_image': bench_get_image,
+    'rbuffer_write': bench_rbuffer_write,
+    'rbuffer_read': bench_rbuffer_read,
+    'colormap': bench_colormap,
+    'binning': bench_binning,
+    'trigger': bench_trigger,
+}
+
+
+def run(names=None, **kwargs):
+    """Run the benchmarks ``names`` (default: all) and return a list of
+    result dicts. Keyword arguments are passed on to :class:`Context`.
+
+    """
+    names = list(BENCHMARKS) if not names else names
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError("Unknown benchmark {}".format(name))
+    results = []
+    with Context(**kwargs) as ctx:
+        for name in names:
+            logger.info('Running benchmark {}'.format(name))
+            results.extend(BENCHMARKS[name](ctx))
+    return results
+
+
+def result_key(result):
+    """Return a string identifying the benchmark and parameters of a
+    result.
+
+    """
+    params = ','.join(
+        '{}={}'.format(k, v) for k, v in sorted(result['params'].items()))
+    return '{}[{}]'.format(result['benchmark'], params)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Compare results with a baseline run. Returns one dict per result
+    found in the baseline with the ratio of frame rates (current /
+    baseline) and whether it is a regression, i.e., more than
+    ``tolerance`` (a fraction) slower than the baseline.
+
+    """
+    reference = {result_key(r): r for r in baseline}
+    comparison = []
+    for result in results:
+        key = result_key(result)
+        if key not in reference:
+            continue
+        ratio = result['fps']/reference[key]['fps']
+        comparison.append({
+            'key': key,
+            'fps': result['fps'],
+            'baseline_fps': reference[key]['fps'],
+            'ratio': ratio,
+            'regression': bool(ratio < 1 - tolerance),
+        })
+    return comparison
+
+
+def main(argv=None):
+    """Command line interface. Run with ``--help`` for details. Returns
+    the exit status: 1 if regressions were found, 0 otherwise.
+
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the acquisition path.')
+    parser.add_argument(
+        'benchmarks', nargs='*', metavar='benchmark',
+        help='Benchmarks to run (default: all): {}'.format(
+            ', '.join(BENCHMARKS)))
+    parser.add_argument(
+        '--camera', choices=CAMERAS, default='simulated',
+        help='Camera backend for the acquire and get_image benchmarks.')
+    parser.add_argument(
+        '--rois', default=','.join(_roi_name(r) for r in ROIS),
+        metavar='WxH,...', help='Image sizes to sweep.')
+    parser.add_argument(
+        '--depths', default=','.join(str(d) for d in DEPTHS),
+        metavar='BITS,...', help='Bits per pixel to sweep.')
+    parser.add_argument(
+        '--buffer-lengths', default=','.join(str(n) for n in BUFFER_LENGTHS),
+        metavar='N,...', help='Ring buffer lengths to sweep.')
+    parser.add_argument(
+        '-n', '--frames', type=int, default=100,
+        help='Number of timed operations per case.')
+    parser.add_argument(
+        '--baseline', metavar='FILE',
+        help='Compare against results stored with --save-baseline.')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='Fractional slowdown flagged as a regression.')
+    parser.add_argument(
+        '--save-baseline', metavar='FILE',
+        help='Store the results as a baseline.')
+    parser.add_argument(
+        '--json', action='store_true', help='Print results as JSON.')
+    args = parser.parse_args(argv)
+
+    try:
+        rois = [tuple(int(n) for n in roi.split('x'))
+                for roi in args.rois.split(',')]
+        depths = [int(d) for d in args.depths.split(',')]
+        lengths = [int(n) for n in args.buffer_lengths.split(',')]
+    except ValueError:
+        parser.error('Invalid sweep values')
+    if any(len(roi) != 2 for roi in rois):
+        parser.error('ROIs must be given as WIDTHxHEIGHT')
+    if any(d not in DEPTHS for d in depths):
+        parser.error('Depths must be one of {}'.format(DEPTHS))
+    try:
+        results = run(
+            args.benchmarks, camera=args.camera, rois=rois, depths=depths,
+            buffer_lengths=lengths, frames=args.frames)
+    except ValueError as e:
+        parser.error(str(e))
+
+    comparison = None
+    if args.baseline:
+        with open(args.baseline) as infile:
+            comparison = compare(results, json.load(infile), args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+    regressions = [c for c in comparison or [] if c['regression']]
+    if args.json:
+        output = {'results': results}
+        if comparison is not None:
+            output['comparison'] = comparison
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        print('{:<64}{:>10}{:>10}{:>12}'.format(
+            'case', 'frames/s', 'MB/s', 'median us'))
+        for r in results:
+            print('{:<64}{:>10.1f}{:>10.1f}{:>12.1f}'.format(
+                result_key(r), r['fps'], r['MBps'], r['median_us']))
+        if comparison is not None:
+            print('\n{} of {} cases slower than the baseline by more '
+                  'than {:.0%}:'.format(
+                      len(regressions), len(comparison), args.tolerance))
+            for c in regressions:
+                print('  {key}: {fps:.1f} vs {baseline_fps:.1f} frames/s '
+                      '({ratio:.2f}x)'.format(**c))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""Import time benchmark.
+
+Measures the cold start latency of importing the camera modules: each
+import statement is timed in a fresh interpreter, so the result is the
+time a script spends importing before it can talk to a camera. Run
+with ``--help`` for options, e.g.::
+
+  $ python benchmark_imports.py -n 20
+  $ python benchmark_imports.py --modules 10 "from thorlabs import ThorlabsDCx"
+
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+#: Import statements timed by default.
+STATEMENTS = [
+    'from camera import Camera',
+    'from thorlabs import ThorlabsDCx',
+    'import ringbuffer',
+    'import image',
+]
+
+# Times the statement after the interpreter itself has started.
+_TIMER = (
+    "import time; t0 = time.perf_counter(); {}; "
+    "print(time.perf_counter() - t0)")
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def _run(args):
+    # Byte code has to be cached for the results to be representative.
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return subprocess.run(
+        [sys.executable] + args, cwd=_DIRECTORY, env=env, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+
+
+def time_import(statement, repeat=10):
+    """Time ``statement`` in ``repeat`` fresh interpreters. Returns a
+    list of times in s.
+
+    """
+    assert repeat >= 1
+    # Make sure byte code is compiled so that it is not timed.
+    _run(['-c', statement])
+    return [
+        float(_run(['-c', _TIMER.format(statement)]).stdout.split()[-1])
+        for _ in range(repeat)]
+
+
+def slowest_modules(statement, n=10):
+    """Return the ``n`` modules imported by ``statement`` which take
+    longest to import by themselves (i.e., excluding their imports)
+    according to ``python -X importtime``. Returns a list of
+    ``(module, self_ms, cumulative_ms)`` tuples.
+
+    """
+    stderr = _run(['-X', 'importtime', '-c', statement]).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue  # header
+        modules.append(
+            (fields[2].strip(), self_us/1000., cumulative_us/1000.))
+    return sorted(modules, key=lambda m: m[1], reverse=True)[:n]
+
+
+def benchmark_imports(statements=STATEMENTS, repeat=10):
+    """Time each import statement. Returns one dict per statement
+    with the median, minimum and maximum import time in ms.
+
+    """
+    results = []
+    for statement in statements:
+        times = sorted(time_import(statement, repeat))
+        median = times[len(times)//2] if len(times) % 2 else \
+            (times[len(times)//2 - 1] + times[len(times)//2])/2
+        results.append({
+            'statement': statement,
+            'median_ms': median*1000,
+            'min_ms': times[0]*1000,
+            'max_ms': times[-1]*1000,
+        })
+    return results
+
+
+def main(argv=None):
+    """Command line interface. Run with ``--help`` for details."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark cold start import times.')
+    parser.add_argument(
+        'statements', nargs='*', default=STATEMENTS,
+        help='Import statements to time.')
+    parser.add_argument(
+        '-n', '--repeat', type=int, default=10,
+        help='Number of fresh interpreters to time each statement in.')
+    parser.add_argument(
+        '--modules', type=int, default=0, metavar='N',
+        help='Also list the N slowest modules imported by each statement.')
+    parser.add_argument(
+        '--json', action='store_true', help='Print results as JSON.')
+    args = parser.parse_args(argv)
+
+    results = benchmark_imports(args.statements, args.repeat)
+    if args.modules:
+        for result in results:
+            result['modules'] = [
+                {'module': name, 'self_ms': self_ms,
+                 'cumulative_ms': cumulative_ms}
+                for name, self_ms, cumulative_ms in slowest_modules(
+                    result['statement'], args.modules)]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    print('{:<40}{:>10}{:>10}{:>10}'.format(
+        'statement', 'median ms', 'min ms', 'max ms'))
+    for r in results:
+        print('{statement:<40}{median_ms:>10.1f}{min_ms:>10.1f}'
+              '{max_ms:>10.1f}'.format(**r))
+        for m in r.get('modules', []):
+            print('    {module:<36}{self_ms:>10.1f}{cumulative_ms:>10.1f}'
+                  .format(**m))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,15 @@
-import numpy.random as npr
+import time
+import numpy as np
 from log import logger
-from ringbuffer import RingBuffer
+from ringbuffer import BACKENDS
 from camprops import CameraProperties
 from exceptions import CameraError
+from acquisition import AcquisitionEngine
+from image import bin_image, BIN_MODES
+from latency import LatencyRecorder
+
+#: Largest supported software binning factor.
+MAX_SOFTWARE_BINS = 8
 
 class Camera(object):
     """Base class for all cameras. New camera implementations should
@@ -22,6 +29,16 @@ class Camera(object):
         Number of pixels (x, y)
     bins : int
         Bin size to use.
+    software_bins : int
+        Bin size applied in software by :meth:`process_image`. Set by
+        :meth:`set_bins` for cameras without hardware binning.
+    bin_mode : str
+        How software binned pixels are combined: ``'mean'`` (keeps the
+        image type, so binning by n stores n**2 times fewer bytes) or
+        ``'sum'`` (uses a wider integer type).
+    roi_crop : bool
+        If True, images are cropped to :attr:`roi` before they are
+        stored.
     crop : list
         Crop specifications. Should be of the form::
             [horiz start, horiz end, vert start, vert end]
@@ -36,11 +53,27 @@ class Camera(object):
         Temperature set point for the cooler if present.
     acq_mode : str
         Camera acquisition mode.
-    trigger_mode : int
+    trigger_mode : int or str
         Camera triggering mode. These are obviously defined
-        differently depending on the particular camera's SDK.
-    rbuffer : RingBuffer
-        The RingBuffer object for autosaving of images.
+        differently depending on the particular camera's SDK. The
+        available modes are listed in ``props['trigger_modes']``.
+    rbuffer : RingBuffer or None
+        The RingBuffer object for autosaving of images. It is only
+        opened once recording is turned on (see
+        :meth:`set_recording_state`).
+    engine : AcquisitionEngine or None
+        The background acquisition engine if threaded acquisition is
+        active.
+    publisher : FramePublisher or None
+        Publisher sharing acquired images with other processes if
+        enabled with :meth:`start_publisher`.
+    last_timestamp : int or None
+        Host time (ns on the :func:`time.monotonic_ns` clock) at which
+        the most recent image returned by :meth:`get_image` was
+        acquired. This is the timestamp stored in the ring buffer.
+    latency : LatencyRecorder
+        Per-stage latency histograms of the acquisition path. See
+        :meth:`enable_instrumentation` and :meth:`stats`.
     props : CameraProperties
         A CameraProperties object defining several generic settings of
         the camera as well as flags indicating if certain
@@ -56,11 +89,33 @@ class Camera(object):
         -----------------
         bins : int
             Binning to use.
+        bin_mode : str
+            ``'mean'`` or ``'sum'`` for software binning. Default:
+            ``'mean'``.
+        roi_crop : bool
+            Crop images to the ROI before storing them. Default:
+            False.
+        recording : bool
+            Record images to the ring buffer. When False, the ring
+            buffer is not opened until recording is turned on with
+            :meth:`set_recording_state`. Default: True.
         buffer_dir : str
             Directory to store the ring buffer file to. Default:
             '.'.
+        buffer_backend : str
+            Ring buffer backend to use: ``'hdf5'`` to record to disk,
+            ``'memory'`` to keep images in memory or ``'mmap'`` for a
+            memory mapped file readable by other processes. Default:
+            ``'hdf5'``.
+        buffer_options : dict
+            Additional keyword arguments for the ring buffer
+            (e.g., ``{'async_write': True}`` to write frames to disk
+            in a background thread).
         log_level : int
             Logging level to use. Default: ``logging.INFO``.
+        instrument : bool
+            Record per-stage latencies from the start. Default:
+            False.
 
         """
         self.clib = None
@@ -69,6 +124,9 @@ class Camera(object):
         self.gain = 0
         self.shape = (512, 512)
         self.bins = 1
+        self.software_bins = 1
+        self.bin_mode = 'mean'
+        self.roi_crop = False
         self.crop = (1, self.shape[0], 1, self.shape[1])
         self.shutter_open = False
         self.cooler_active = False
@@ -76,32 +134,52 @@ class Camera(object):
         self.acq_mode = "single"
         self.trigger_mode = 0
         self.rbuffer = None
+        self.engine = None
+        self.publisher = None
+        self.last_timestamp = None
+        self.latency = LatencyRecorder()
         self.props = CameraProperties()
 
         # Get kwargs and set defaults
         bins = kwargs.get('bins', 1)
+        bin_mode = kwargs.get('bin_mode', 'mean')
+        roi_crop = kwargs.get('roi_crop', False)
+        instrument = kwargs.get('instrument', False)
         buffer_dir = kwargs.get('buffer_dir', '.')
         recording = kwargs.get('recording', True)
+        buffer_backend = kwargs.get('buffer_backend', 'hdf5')
+        buffer_options = kwargs.get('buffer_options', {})
 
         # Check kwarg types are correct
         assert isinstance(bins, int)
+        assert isinstance(roi_crop, bool)
+        if bin_mode not in BIN_MODES:
+            raise CameraError("Unknown binning mode {}".format(bin_mode))
         assert isinstance(buffer_dir, str)
+        assert isinstance(buffer_options, dict)
+        if buffer_backend not in BACKENDS:
+            raise CameraError(
+                "Unknown ring buffer backend {}".format(buffer_backend))
 
         # Configure logging
         logger.info("Connecting to camera")
 
         # Initialize
-        try:
-            self.rbuffer = RingBuffer(
-                directory=buffer_dir, recording=recording, roi=self.roi)
-        except ValueError:
-            logger.warn('Error oepning the ring buffer. This is expected with a remote camera server.')
-            self.rbuffer = None
-        x0 = npr.randint(self.shape[0]/4, self.shape[0]/2)
-        y0 = npr.randint(self.shape[1]/4, self.shape[1]/2)
+        self._rbuffer_backend = buffer_backend
+        self._rbuffer_options = dict(buffer_options, directory=buffer_dir)
+        if recording:
+            self._open_rbuffer()
+        if instrument:
+            self.latency.enable()
+        x0 = np.random.randint(self.shape[0]/4, self.shape[0]/2)
+        y0 = np.random.randint(self.shape[1]/4, self.shape[1]/2)
         self.sim_img_center = (x0, y0)
         self.initialize(**kwargs)
         self.get_camera_properties()
+        self.bin_mode = bin_mode
+        self.roi_crop = roi_crop
+        if bins != 1:
+            self.set_bins(bins)
 
     def initialize(self, **kwargs):
         """Any extra initialization required should be placed in this
@@ -109,6 +187,29 @@ class Camera(object):
 
         """
 
+    def _open_rbuffer(self):
+        """Open the ring buffer unless it is already open."""
+        if self.rbuffer is not None:
+            return
+        try:
+            self.rbuffer = BACKENDS[self._rbuffer_backend](
+                roi=self.roi, **self._rbuffer_options)
+        except ValueError:
+            logger.warn('Error oepning the ring buffer. This is expected with a remote camera server.')
+            self.rbuffer = None
+        if self.rbuffer is not None:
+            self.rbuffer.latency = self.latency
+
+    def set_recording_state(self, state):
+        """Turn recording images to the ring buffer on or off. The
+        ring buffer is opened the first time recording is turned on.
+
+        """
+        if state:
+            self._open_rbuffer()
+        if self.rbuffer is not None:
+            self.rbuffer.set_recording_state(state)
+
     def get_camera_properties(self):
         """Code for getting camera properties should go here."""
         logger.warning(
@@ -120,6 +221,8 @@ class Camera(object):
 
     def __exit__(self, type_, value, traceback):
         logger.info("Shutting down camera.")
+        self.stop_acquisition_thread()
+        self.stop_publisher()
         if self.rbuffer is not None:
             self.rbuffer.close()
         self.close()
@@ -142,10 +245,41 @@ class Camera(object):
         image from the camera should be added to the
         :meth:`acquire_image_data` method.
 
+        With latency instrumentation enabled (see
+        :meth:`enable_instrumentation`), the durations of the
+        ``acquire``, ``process``, ``record`` and ``publish`` stages
+        and of the whole call (``get_image``) are recorded.
+        Cameras may record finer stages of ``acquire`` (e.g.,
+        waiting for the driver and copying the frame) in
+        :meth:`acquire_image_data`.
+
         """
-        img = self.acquire_image_data()
+        latency = self.latency if self.latency.enabled else None
+        t = t_start = latency.clock() if latency else 0
+        raw = self.acquire_image_data()
+        timestamp = self.last_timestamp = time.monotonic_ns()
+        if latency:
+            t = latency.record('acquire', t)
+        img = self.process_image(raw)
+        if img is not raw:
+            # Processed images are copies, so the camera can have its
+            # buffer back right away.
+            self.release_image(raw)
+        if latency:
+            t = latency.record('process', t)
         if self.rbuffer is not None:
-            self.rbuffer.write(img)
+            info = self.get_image_info()
+            info['timestamp'] = timestamp
+            self.rbuffer.write(img, info=info)
+            if latency:
+                t = latency.record('record', t)
+        if self.publisher is not None:
+            self.publisher.publish(img, timestamp=self.last_timestamp)
+            if latency:
+                latency.record('publish', t)
+        if latency:
+            latency.record('get_image', t_start)
+            latency.tick()
         return img
 
     def acquire_image_data(self):
@@ -155,6 +289,132 @@ class Camera(object):
         """
         raise NotImplementedError
 
+    def process_image(self, img):
+        """Apply the software ROI crop (if :attr:`roi_crop` is set)
+        and binning (see :meth:`set_bins`) to a newly acquired image.
+        Returns ``img`` itself if there is nothing to do and a new
+        array otherwise.
+
+        The ROI is given in pixels of ``img`` as [x1, y1, x2, y2] with
+        indices starting from 1 and is cropped before binning.
+
+        """
+        processed = img
+        if self.roi_crop:
+            x1, y1, x2, y2 = self.roi
+            processed = processed[max(y1 - 1, 0):y2, max(x1 - 1, 0):x2]
+        if self.software_bins > 1:
+            processed = bin_image(
+                processed, self.software_bins, self.bin_mode)
+        elif processed is not img:
+            processed = processed.copy()
+        return processed
+
+    def get_image_info(self):
+        """Return a dict of metadata for the most recently acquired
+        image to store in the ring buffer. Cameras providing a
+        hardware timestamp (in ns) or frame counter should override
+        this to add them as ``hw_timestamp`` and ``hw_frame``. By
+        default only the exposure time is included.
+
+        """
+        return {'exposure': self.t_ms}
+
+    def start_acquisition_thread(self, callback=None, **kwargs):
+        """Start acquiring images in a background thread. Acquired
+        images are read by iterating over :meth:`frames` or by passing
+        a ``callback`` to be called with each image. Keyword
+        arguments are passed on to :class:`AcquisitionEngine` (e.g.,
+        ``maxsize`` and ``policy``).
+
+        Cameras supporting continuous acquisition should be started
+        with :meth:`start` first for maximum frame rates.
+
+        """
+        if self.engine is not None and self.engine.running:
+            raise CameraError("Acquisition thread already running.")
+        self.engine = AcquisitionEngine(self, **kwargs)
+        if callback is not None:
+            self.engine.add_callback(callback)
+        self.engine.start()
+        return self.engine
+
+    def stop_acquisition_thread(self):
+        """Stop the background acquisition thread if running."""
+        if self.engine is not None:
+            self.engine.stop()
+
+    def frames(self, timeout=None):
+        """Iterate over images acquired by the background acquisition
+        thread. See :meth:`AcquisitionEngine.frames`.
+
+        """
+        if self.engine is None:
+            raise CameraError("Acquisition thread not started.")
+        return self.engine.frames(timeout)
+
+    def start_publisher(self, **kwargs):
+        """Start sharing acquired images with other processes. Keyword
+        arguments are passed on to :class:`FramePublisher`. Subscribers
+        are created with ``camera.publisher.add_subscriber()``.
+
+        """
+        from fanout import FramePublisher
+        if self.publisher is not None:
+            raise CameraError("Publisher already started.")
+        self.publisher = FramePublisher(**kwargs)
+        return self.publisher
+
+    def stop_publisher(self):
+        """Stop sharing images and disconnect all subscribers."""
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+
+    def enable_instrumentation(self, log_interval=None):
+        """Start recording per-stage latencies of the acquisition
+        path. If ``log_interval`` is given, a summary is logged every
+        ``log_interval`` seconds. Instrumentation can be toggled at any
+        time, including while acquiring.
+
+        """
+        self.latency.enable(log_interval)
+
+    def disable_instrumentation(self):
+        """Stop recording latencies. Recorded histograms are kept
+        until :meth:`reset_stats` is called.
+
+        """
+        self.latency.disable()
+
+    def reset_stats(self):
+        """Discard recorded latencies."""
+        self.latency.reset()
+
+    def stats(self):
+        """Return a dict of acquisition statistics: per-stage
+        latencies (count, mean, min, p50, p99 and max in us) under
+        ``'latency'``, plus ring buffer, acquisition thread and
+        publisher statistics if these are in use.
+
+        """
+        stats = {'latency': self.latency.summary()}
+        if self.rbuffer is not None:
+            stats['rbuffer'] = self.rbuffer.stats()
+        if self.engine is not None:
+            stats['engine'] = self.engine.stats()
+        if self.publisher is not None:
+            stats['publisher'] = self.publisher.stats()
+        return stats
+
+    def release_image(self, img):
+        """Hand an image returned by :meth:`get_image` back to the
+        camera once it is no longer needed. Cameras that return frames
+        from a pool of preallocated buffers should override this to
+        recycle the buffer; by default it does nothing.
+
+        """
+
     def get_trigger_mode(self):
         """Query the current trigger mode."""
         raise NotImplementedError
@@ -163,6 +423,10 @@ class Camera(object):
         """Setup trigger mode."""
         raise NotImplementedError
 
+    def trigger(self):
+        """Send a software trigger to take an image immediately."""
+        raise NotImplementedError
+
     def start(self):
         """Code needed for getting the camera to begin triggering
         should be placed here.
@@ -292,15 +556,21 @@ class Camera(object):
         """Define the portion of the CCD to actually collect data
         from. Using a reduced sensor area typically allows for faster
         readout. Derived classes should define :meth:`update_crop`
-        instead of overriding this one.
+        instead of overriding this one. If the camera rejects the crop,
+        the previous one is kept.
 
         """
         assert crop[1] > crop[0]
         assert crop[3] > crop[2]
         if len(crop) != 4:
             raise CameraError("crop must be a length 4 array.")
+        old = self.crop
         self.crop = crop
-        self.update_crop(self.crop)
+        try:
+            self.update_crop(self.crop)
+        except Exception:
+            self.crop = old
+            raise
 
     def reset_crop(self):
         """Reset the crop to the maximum size."""
@@ -322,6 +592,32 @@ class Camera(object):
         """
         return self.bins
 
-    def set_bins(self, bins):
-        """Set binning to bins x bins."""
-        logger.debug("set_bins not implemented.")
\ No newline at end of file
+    def set_bins(self, bins, mode=None):
+        """Set binning to bins x bins. Unless overridden by cameras
+        supporting hardware binning, images are binned in software
+        before they are stored, combining pixels according to ``mode``
+        (``'mean'`` or ``'sum'``; default: keep :attr:`bin_mode`).
+        Averaged images keep their type; summed images use a wider
+        integer type so they cannot overflow, which costs twice the
+        storage.
+
+        """
+        if not isinstance(bins, int) or not 1 <= bins <= MAX_SOFTWARE_BINS:
+            raise CameraError(
+                "Binning must be an integer from 1 to {}.".format(
+                    MAX_SOFTWARE_BINS))
+        if mode is not None:
+            if mode not in BIN_MODES:
+                raise CameraError("Unknown binning mode {}".format(mode))
+            self.bin_mode = mode
+        self.bins = bins
+        self.software_bins = bins
+        logger.info('Software binning: {0}x{0} ({1})'.format(
+            bins, self.bin_mode))
+
+    def set_roi_crop(self, enabled):
+        """Enable or disable cropping images to the ROI before they
+        are stored.
+
+        """
+        self.roi_crop = bool(enabled)
\ No newline at end of file
@@ -1,20 +1,9 @@
-from thorlabs import ThorlabsDCx
-
-import matplotlib.pyplot as plt
-import time
-cam = ThorlabsDCx()
-#cam.open()
-cam.set_roi_pos([0,0])
-roi=[40,32]
-cam.set_roi_shape(roi)
-print("The ROI is set to:" ,roi)
-start=time.time()
-for i in range(200):
-	test = cam.acquire_image_data()
-	#print(test)
-	#print(test.shape)
-end=time.time()
-frame_rate=200.0/(end-start)
-print("The frame rate is",frame_rate," per second")
-cam.close()
+# Frame rate of a ThorLabs camera at full frame and with a 40x32 ROI.
+# See benchmark.py for the full benchmark suite, which can also run
+# without hardware.
+import sys
+import benchmark
 
+sys.exit(benchmark.main([
+	'--camera', 'thorlabs', '--rois', '1280x1024,40x32', '--depths', '8',
+	'-n', '200', 'acquire']))
@@ -0,0 +1,975 @@
+"""Software stand-in for the Thorlabs uc480 (uEye) SDK
+
+:class:`FakeUC480` exposes the ``is_*`` entry points used by
+:class:`thorlabs.ThorlabsDCx` as real ctypes function pointers. Calls
+made by the driver therefore go through the same ctypes argument
+conversion as with the real library, which makes the fake useful for
+profiling the per-frame overhead of the driver and for running it on
+machines without a camera or SDK installed::
+
+  from fakeuc480 import FakeUC480
+  from thorlabs import ThorlabsDCx
+  cam = ThorlabsDCx(library=FakeUC480(fps=60))
+
+Only the subset of the SDK used by the driver is implemented. Image
+memory is filled with frames synthesized by
+:class:`simulated.FrameGenerator` at a rate limited by the simulated
+sensor readout and exposure time.
+
+The entry points are Python callbacks, which take the GIL back for
+the duration of every call. Timings measured against the fake
+therefore do not show the concurrency of the real driver, which
+releases the GIL while it waits for frames or copies memory.
+
+Triggered capture is simulated as well. Edges on the trigger input of
+a simulated camera are generated with :meth:`FakeUC480.pulse` or
+:meth:`FakeUC480.set_trigger_input`; a triggered frame is ready one
+exposure plus readout time after its trigger.
+
+"""
+
+import time
+import threading
+from collections import deque
+import ctypes
+from ctypes import c_int, c_uint, c_double, c_void_p
+import numpy as np
+from simulated import FrameGenerator
+from thorlabs import (
+    UEYEIMAGEINFO, SENSORINFO, CamInfo, camera_list_type)
+
+# Return codes
+IS_NO_SUCCESS = -1
+IS_SUCCESS = 0
+IS_INVALID_CAMERA_HANDLE = 1
+IS_CANT_OPEN_DEVICE = 3
+IS_INVALID_MEMORY_POINTER = 49
+IS_TIMED_OUT = 122
+IS_INVALID_PARAMETER = 125
+IS_OUT_OF_MEMORY = 127
+IS_INVALID_BUFFER_SIZE = 159
+
+# is_FreezeVideo/is_CaptureVideo wait parameters
+IS_DONT_WAIT = 0
+IS_WAIT = 1
+
+IS_IGNORE_PARAMETER = -1
+
+# is_InitCamera: open by device ID instead of camera ID
+IS_USE_DEVICE_ID = 0x8000
+
+# Color modes
+IS_CM_MONO8 = 6
+IS_CM_MONO12 = 26
+IS_CM_MONO16 = 28
+
+# is_AOI commands
+IS_AOI_IMAGE_SET_AOI = 1
+IS_AOI_IMAGE_GET_AOI = 2
+IS_AOI_IMAGE_SET_POS = 3
+IS_AOI_IMAGE_GET_POS = 4
+IS_AOI_IMAGE_SET_SIZE = 5
+IS_AOI_IMAGE_GET_SIZE = 6
+
+# is_Exposure commands
+IS_EXPOSURE_CMD_GET_EXPOSURE = 7
+IS_EXPOSURE_CMD_GET_EXPOSURE_RANGE = 8
+IS_EXPOSURE_CMD_SET_EXPOSURE = 12
+
+# is_SetDisplayMode query
+IS_GET_DISPLAY_MODE = 0x8000
+IS_GET_FRAMERATE = 0x8000
+IS_SET_DM_DIB = 1
+
+# is_SetExternalTrigger modes
+IS_SET_TRIGGER_OFF = 0x0000
+IS_SET_TRIGGER_HI_LO = 0x0001
+IS_SET_TRIGGER_LO_HI = 0x0002
+IS_SET_TRIGGER_SOFTWARE = 0x1000
+IS_GET_EXTERNALTRIGGER = 0x8000
+
+
+def _get(ptr, ctype):
+    """Dereference a pointer passed in as an integer address."""
+    return ctype.from_address(ptr).value
+
+
+def _set(ptr, ctype, value):
+    """Store a value at a pointer passed in as an integer address."""
+    ctype.from_address(ptr).value = value
+
+
+class _ImageMemory(object):
+    """An image memory allocated by ``is_AllocImageMem`` or registered
+    with ``is_SetAllocatedImageMem``.
+
+    """
+    def __init__(self, width, height, bits, address=None):
+        self.width = width
+        self.height = height
+        self.bits = bits
+        bytes_per_pixel = (bits + 7)//8
+        line = width*bytes_per_pixel
+        self.pitch = line + (-line % 4)
+        if address is None:
+            self.buffer = (ctypes.c_char*(self.pitch*height))()
+        else:
+            # User allocated memory (see is_SetAllocatedImageMem)
+            self.buffer = (ctypes.c_char*(self.pitch*height)).from_address(
+                address)
+        self.address = ctypes.addressof(self.buffer)
+        self.mem_id = None
+
+        # Image info of the last frame written (see is_GetImageInfo)
+        self.frame_number = 0
+        self.timestamp = 0
+
+    @property
+    def size(self):
+        return self.pitch*self.height
+
+    def as_array(self, dtype):
+        """Return a writable (height, pixels per line) view of the
+        memory.
+
+        """
+        arr = np.frombuffer(self.buffer, dtype=dtype)
+        return arr.reshape(self.height, -1)
+
+
+class _FakeDevice(object):
+    """State of a single simulated camera. The unique ``device_id``
+    also serves as the camera handle.
+
+    """
+    def __init__(self, device_id, camera_id, shape, fps, **kwargs):
+        self.device_id = device_id
+        self.camera_id = camera_id
+        self.shape = tuple(shape)
+        self.serial = '4102{:06d}'.format(device_id)
+        self.fps = fps
+        self.opened = False
+        self.color_mode = IS_CM_MONO8
+        self.aoi = [0, 0, self.shape[0], self.shape[1]]
+        self.exposure = 1.
+        self.frame_rate = None
+        self.trigger_mode = IS_SET_TRIGGER_OFF
+        self.trigger_level = 0
+        self.triggers = deque()
+        self.memories = {}
+        self.active_mem = None
+        self.next_mem_id = 1
+
+        # Live capture state. The condition protects everything that
+        # is shared with the capture thread.
+        self.condition = threading.Condition()
+        self.sequence = []
+        self.locked = set()
+        self.queue = deque()
+        self.queue_enabled = False
+        self.live = False
+        self.thread = None
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.frame_counter = 0
+        self.t_start = time.perf_counter()
+        self._generator_kwargs = kwargs
+        center = (self.shape[0]//3 + device_id, self.shape[1]//3)
+        self.center = center
+        self.generator = None
+        self.configure_generator()
+
+    @property
+    def depth(self):
+        return 8 if self.color_mode == IS_CM_MONO8 else 16
+
+    def configure_generator(self):
+        if self.generator is None or self.generator.depth != self.depth:
+            self.generator = FrameGenerator(
+                self.shape, self.center, depth=self.depth,
+                **self._generator_kwargs)
+        x, y, w, h = self.aoi
+        self.generator.configure([x + 1, x + w, y + 1, y + h])
+
+    def readout_time(self):
+        """Time in s needed to read out the current AOI. Readout time
+        scales with the number of rows in the AOI.
+
+        """
+        if self.fps is None:
+            return 0.
+        return self.aoi[3]/float(self.shape[1])/self.fps
+
+    def shot_time(self):
+        """Time in s for exposing and reading out a single frame."""
+        if self.fps is None:
+            return 0.
+        return self.exposure/1000. + self.readout_time()
+
+    def frame_time(self):
+        """Time in s between frames in free run mode. Exposure of the
+        next frame overlaps with readout of the current one, and the
+        frame rate set with ``is_SetFrameRate`` is an upper limit.
+
+        """
+        if self.fps is None:
+            return 0.
+        limit = 0. if self.frame_rate is None else 1./self.frame_rate
+        return max(self.exposure/1000., self.readout_time(), limit)
+
+    def frame_time_range(self):
+        """Minimum and maximum time in s between frames for the
+        current AOI.
+
+        """
+        return max(self.readout_time(), 1e-4), 10.
+
+    def render(self, mem):
+        """Write a new frame to the image memory ``mem``."""
+        w, h = self.aoi[2], self.aoi[3]
+        if mem.width < w or mem.height < h or mem.bits < self.depth:
+            return IS_INVALID_BUFFER_SIZE
+        dtype = np.uint8 if self.depth == 8 else np.uint16
+        view = mem.as_array(dtype)[:h, :w]
+        scale = self.exposure/10.
+        self.generator.render(scale, out=view)
+        self.frame_counter += 1
+        mem.frame_number = self.frame_counter
+        mem.timestamp = int((time.perf_counter() - self.t_start)*1e7)
+        return IS_SUCCESS
+
+    @property
+    def external_trigger(self):
+        return self.trigger_mode in (IS_SET_TRIGGER_HI_LO, IS_SET_TRIGGER_LO_HI)
+
+    def set_trigger_input(self, level):
+        """Set the level of the trigger input. An edge matching the
+        trigger mode triggers a frame.
+
+        """
+        level = int(bool(level))
+        with self.condition:
+            edge = level - self.trigger_level
+            self.trigger_level = level
+            if (edge > 0 and self.trigger_mode == IS_SET_TRIGGER_LO_HI) or \
+               (edge < 0 and self.trigger_mode == IS_SET_TRIGGER_HI_LO):
+                self.triggers.append(time.perf_counter())
+                self.condition.notify_all()
+
+    def wait_for_trigger(self, timeout=None, live=False):
+        """Wait for a trigger and return its time, or None if there is
+        none within ``timeout`` seconds or, if ``live`` is True, live
+        capture stops. The caller must hold the condition.
+
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not self.triggers:
+            if live and not self.live:
+                return None
+            if deadline is None:
+                self.condition.wait()
+            else:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+        return self.triggers.popleft()
+
+    def deliver(self):
+        """Write a single triggered frame to the next free sequence
+        buffer and add it to the image queue.
+
+        """
+        with self.condition:
+            position = self._next_sequence_buffer(0)
+            if position is None:
+                self.frames_dropped += 1
+                return IS_NO_SUCCESS
+            mem = self.sequence[position]
+            status = self.render(mem)
+            if status != IS_SUCCESS:
+                self.frames_dropped += 1
+                return status
+            self.frames_captured += 1
+            if self.queue_enabled:
+                self.queue.append(mem)
+                self.condition.notify_all()
+        return IS_SUCCESS
+
+    def _next_sequence_buffer(self, position):
+        """Find the next sequence buffer at or after ``position`` that
+        is neither locked nor waiting in the image queue. Returns the
+        sequence position or None if all buffers are in use.
+
+        """
+        queued = set(mem.mem_id for mem in self.queue)
+        n = len(self.sequence)
+        for i in range(n):
+            pos = (position + i) % n
+            mem_id = self.sequence[pos].mem_id
+            if mem_id not in self.locked and mem_id not in queued:
+                return pos
+        return None
+
+    def capture_loop(self):
+        """Free run capture into the sequence buffers. This runs in a
+        separate thread while live capture is active.
+
+        """
+        next_frame = time.perf_counter()
+        position = 0
+        while True:
+            with self.condition:
+                if not self.live:
+                    return
+                if self.external_trigger:
+                    # Expose on each trigger; the sensor cannot start
+                    # a new frame before the last one was read out.
+                    t_trigger = self.wait_for_trigger(live=True)
+                    if t_trigger is None:
+                        return
+                    next_frame = max(
+                        t_trigger + self.shot_time(),
+                        next_frame + self.readout_time())
+                else:
+                    next_frame = max(
+                        next_frame + self.frame_time(), time.perf_counter())
+                while self.live and time.perf_counter() < next_frame:
+                    self.condition.wait(
+                        max(next_frame - time.perf_counter(), 0))
+                if not self.live:
+                    return
+
+                position = self._next_sequence_buffer(position)
+                if position is None:
+                    # No buffer to write to: the frame is lost.
+                    self.frames_dropped += 1
+                    position = 0
+                    if self.fps is None:
+                        self.condition.wait(0.001)
+                    continue
+                mem = self.sequence[position]
+                position += 1
+                if self.render(mem) != IS_SUCCESS:
+                    self.frames_dropped += 1
+                    continue
+                self.frames_captured += 1
+                self.active_mem = mem
+                if self.queue_enabled:
+                    self.queue.append(mem)
+                self.condition.notify_all()
+
+    def stop_live(self):
+        """Stop live capture and wait for the capture thread to
+        finish.
+
+        """
+        with self.condition:
+            self.live = False
+            self.condition.notify_all()
+            thread, self.thread = self.thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+
+class FakeUC480(object):
+    """Pure-software replacement for the uc480 library.
+
+    An instance can be passed to :class:`thorlabs.ThorlabsDCx` in place
+    of the ctypes library handle.
+
+    """
+    # Prototypes of the implemented entry points. Pointer arguments
+    # are declared as void pointers so that anything the real library
+    # would accept (``byref``, ``pointer``, arrays, ``c_char_p``) is
+    # accepted here as well.
+    _PROTOTYPES = {
+        'is_GetNumberOfCameras': [c_void_p],
+        'is_GetCameraList': [c_void_p],
+        'is_GetCameraInfo': [c_int, c_void_p],
+        'is_InitCamera': [c_void_p, c_void_p],
+        'is_ExitCamera': [c_int],
+        'is_EnableAutoExit': [c_int, c_int],
+        'is_SetColorMode': [c_int, c_int],
+        'is_SetDisplayMode': [c_int, c_int],
+        'is_AllocImageMem': [c_int, c_int, c_int, c_int, c_void_p, c_void_p],
+        'is_SetAllocatedImageMem': [
+            c_int, c_int, c_int, c_int, c_void_p, c_void_p],
+        'is_FreeImageMem': [c_int, c_void_p, c_int],
+        'is_SetImageMem': [c_int, c_void_p, c_int],
+        'is_FreezeVideo': [c_int, c_int],
+        'is_SetExternalTrigger': [c_int, c_int],
+        'is_ForceTrigger': [c_int],
+        'is_AddToSequence': [c_int, c_void_p, c_int],
+        'is_ClearSequence': [c_int],
+        'is_LockSeqBuf': [c_int, c_int, c_void_p],
+        'is_UnlockSeqBuf': [c_int, c_int, c_void_p],
+        'is_InitImageQueue': [c_int, c_int],
+        'is_ExitImageQueue': [c_int],
+        'is_CaptureVideo': [c_int, c_int],
+        'is_StopLiveVideo': [c_int, c_int],
+        'is_WaitForNextImage': [c_int, c_uint, c_void_p, c_void_p],
+        'is_CopyImageMem': [c_int, c_void_p, c_int, c_void_p],
+        'is_GetImageInfo': [c_int, c_int, c_void_p, c_int],
+        'is_GetSensorInfo': [c_int, c_void_p],
+        'is_GetFrameTimeRange': [c_int, c_void_p, c_void_p, c_void_p],
+        'is_SetFrameRate': [c_int, c_double, c_void_p],
+        'is_AOI': [c_int, c_uint, c_void_p, c_uint],
+        'is_Exposure': [c_int, c_uint, c_void_p, c_uint],
+        'is_ImageFile': [c_int, c_uint, c_void_p, c_uint],
+        'is_ParameterSet': [c_int, c_uint, c_void_p, c_uint],
+    }
+
+    def __init__(self, n_cameras=1, shape=(1280, 1024), fps=60.,
+                 camera_ids=None, **kwargs):
+        """Create a fake library.
+
+        Parameters
+        ----------
+        n_cameras : int
+            Number of simulated cameras connected.
+        shape : tuple
+            Number of sensor pixels (x, y).
+        fps : float or None
+            Full frame readout rate. Reading out smaller AOIs is
+            proportionally faster. If None, frames are delivered as
+            fast as they can be rendered.
+        camera_ids : list or None
+            User defined camera IDs of the simulated cameras. Default:
+            1 for all of them, as for cameras fresh from the factory.
+            Device IDs are always 1 to ``n_cameras``.
+
+        Additional keyword arguments are passed on to
+        :class:`simulated.FrameGenerator`.
+
+        """
+        assert n_cameras >= 0
+        assert fps is None or fps > 0
+        if camera_ids is None:
+            camera_ids = [1]*n_cameras
+        assert len(camera_ids) == n_cameras
+        self.devices = [
+            _FakeDevice(i + 1, camera_id, shape, fps, **kwargs)
+            for i, camera_id in enumerate(camera_ids)]
+        self.calls = 0
+
+        for name, argtypes in self._PROTOTYPES.items():
+            prototype = ctypes.CFUNCTYPE(c_int, *argtypes)
+            func = self._counted(getattr(self, '_' + name))
+            setattr(self, name, prototype(func))
+
+    def _counted(self, func):
+        """Wrap an entry point to keep track of the number of calls
+        made into the library.
+
+        """
+        def wrapper(*args):
+            self.calls += 1
+            return func(*args)
+        return wrapper
+
+    def _devices(self, device_id):
+        if device_id is None:
+            return self.devices
+        return [d for d in self.devices if d.device_id == device_id]
+
+    def set_trigger_input(self, level, device_id=None):
+        """Set the trigger input level of camera ``device_id`` (default:
+        all cameras, as if they shared a trigger line).
+
+        """
+        for device in self._devices(device_id):
+            device.set_trigger_input(level)
+
+    def pulse(self, device_id=None):
+        """Send a pulse to the trigger input of camera ``device_id``
+        (default: all cameras). This triggers a frame on either edge
+        polarity.
+
+        """
+        self.set_trigger_input(1, device_id)
+        self.set_trigger_input(0, device_id)
+
+    def _device(self, handle):
+        for device in self.devices:
+            if device.device_id == handle and device.opened:
+                return device
+        return None
+
+    # Initialization and shutdown
+    # -------------------------------------------------------------------------
+
+    def _is_GetNumberOfCameras(self, pnNumCams):
+        _set(pnNumCams, c_int, len(self.devices))
+        return IS_SUCCESS
+
+    def _is_GetCameraList(self, pucl):
+        # The caller sets dwCount to the number of entries allocated.
+        # As with the SDK, passing 0 only queries the number of
+        # cameras.
+        count = _get(pucl, ctypes.c_uint32)
+        _set(pucl, ctypes.c_uint32, len(self.devices))
+        if count == 0:
+            return IS_SUCCESS
+        camera_list = camera_list_type(count).from_address(pucl)
+        for info, device in zip(camera_list.uci, self.devices):
+            ctypes.memset(ctypes.addressof(info), 0, ctypes.sizeof(info))
+            info.dwCameraID = device.camera_id
+            info.dwDeviceID = device.device_id
+            info.dwSensorID = 1
+            info.dwInUse = device.opened
+            info.SerNo = device.serial.encode('ascii')
+            info.Model = b'DCC1240M'
+            info.FullModelName = b'DCC1240M (fake)'
+        return IS_SUCCESS
+
+    def _is_GetCameraInfo(self, hCam, pInfo):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        info = CamInfo.from_address(pInfo)
+        ctypes.memset(pInfo, 0, ctypes.sizeof(info))
+        info.SerNo = device.serial.encode('ascii')
+        info.ID = b'Thorlabs GmbH'
+        info.Version = b'V1.00'
+        info.Date = b'01.01.2016'
+        info.Select = device.camera_id
+        return IS_SUCCESS
+
+    def _is_InitCamera(self, phCam, hWnd):
+        requested = _get(phCam, c_int)
+        for device in self.devices:
+            if device.opened:
+                continue
+            if requested & IS_USE_DEVICE_ID:
+                found = requested & ~IS_USE_DEVICE_ID == device.device_id
+            else:
+                found = requested in (0, device.camera_id)
+            if found:
+                device.opened = True
+                _set(phCam, c_int, device.device_id)
+                return IS_SUCCESS
+        return IS_CANT_OPEN_DEVICE
+
+    def _is_ExitCamera(self, hCam):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        device.stop_live()
+        device.opened = False
+        device.sequence = []
+        device.memories.clear()
+        device.active_mem = None
+        return IS_SUCCESS
+
+    def _is_EnableAutoExit(self, hCam, nMode):
+        if self._device(hCam) is None:
+            return IS_INVALID_CAMERA_HANDLE
+        return IS_SUCCESS
+
+    def _is_SetColorMode(self, hCam, mode):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        if mode not in (IS_CM_MONO8, IS_CM_MONO12, IS_CM_MONO16):
+            return IS_INVALID_PARAMETER
+        with device.condition:
+            device.color_mode = mode
+            device.configure_generator()
+        return IS_SUCCESS
+
+    def _is_SetDisplayMode(self, hCam, mode):
+        if self._device(hCam) is None:
+            return IS_INVALID_CAMERA_HANDLE
+        if mode == IS_GET_DISPLAY_MODE:
+            return IS_SET_DM_DIB
+        return IS_SUCCESS
+
+    # Image memory
+    # -------------------------------------------------------------------------
+
+    def _add_memory(self, hCam, width, height, bitspixel, address, pid):
+        device = self._device(hCam)
+        if device is None:
+            return None
+        if width < 1 or height < 1 or bitspixel not in (8, 16):
+            return None
+        mem = _ImageMemory(width, height, bitspixel, address)
+        mem_id = device.next_mem_id
+        device.next_mem_id += 1
+        mem.mem_id = mem_id
+        device.memories[mem_id] = mem
+        _set(pid, c_int, mem_id)
+        return mem
+
+    def _is_AllocImageMem(self, hCam, width, height, bitspixel, ppcMem, pid):
+        if self._device(hCam) is None:
+            return IS_INVALID_CAMERA_HANDLE
+        mem = self._add_memory(hCam, width, height, bitspixel, None, pid)
+        if mem is None:
+            return IS_INVALID_PARAMETER
+        _set(ppcMem, c_void_p, mem.address)
+        return IS_SUCCESS
+
+    def _is_SetAllocatedImageMem(self, hCam, width, height, bitspixel,
+                                 pcImgMem, pid):
+        if self._device(hCam) is None:
+            return IS_INVALID_CAMERA_HANDLE
+        if not pcImgMem:
+            return IS_INVALID_MEMORY_POINTER
+        mem = self._add_memory(hCam, width, height, bitspixel, pcImgMem, pid)
+        if mem is None:
+            return IS_INVALID_PARAMETER
+        return IS_SUCCESS
+
+    def _is_FreeImageMem(self, hCam, pcMem, mem_id):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        mem = device.memories.get(mem_id)
+        if mem is None or mem.address != pcMem:
+            return IS_INVALID_MEMORY_POINTER
+        if device.active_mem is mem:
+            device.active_mem = None
+        del device.memories[mem_id]
+        return IS_SUCCESS
+
+    def _is_SetImageMem(self, hCam, pcMem, mem_id):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        mem = device.memories.get(mem_id)
+        if mem is None or mem.address != pcMem:
+            return IS_INVALID_MEMORY_POINTER
+        device.active_mem = mem
+        return IS_SUCCESS
+
+    def _is_CopyImageMem(self, hCam, pcSource, mem_id, pcDest):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        mem = device.memories.get(mem_id)
+        if mem is None or mem.address != pcSource or not pcDest:
+            return IS_INVALID_MEMORY_POINTER
+        ctypes.memmove(pcDest, pcSource, mem.size)
+        return IS_SUCCESS
+
+    def _is_GetImageInfo(self, hCam, mem_id, pImageInfo, size):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        mem = device.memories.get(mem_id)
+        if mem is None:
+            return IS_INVALID_MEMORY_POINTER
+        if size != ctypes.sizeof(UEYEIMAGEINFO):
+            return IS_INVALID_PARAMETER
+        info = UEYEIMAGEINFO.from_address(pImageInfo)
+        ctypes.memset(pImageInfo, 0, size)
+        info.u64TimestampDevice = mem.timestamp
+        info.u64FrameNumber = mem.frame_number
+        info.dwImageBuffers = len(device.sequence)
+        info.dwImageBuffersInUse = len(device.locked)
+        info.dwImageWidth = mem.width
+        info.dwImageHeight = mem.height
+        return IS_SUCCESS
+
+    # Acquisition
+    # -------------------------------------------------------------------------
+
+    def _is_FreezeVideo(self, hCam, wait):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        queued = device.queue_enabled and device.sequence
+        if device.active_mem is None and not queued:
+            return IS_INVALID_MEMORY_POINTER
+
+        # A single shot exposes and then reads out the sensor, starting
+        # now or, with an external trigger, on the next edge.
+        start = time.perf_counter()
+        if device.external_trigger:
+            timeout = None if wait == IS_WAIT else wait/100.
+            with device.condition:
+                start = device.wait_for_trigger(timeout)
+            if start is None:
+                return IS_TIMED_OUT
+        ready = start + device.shot_time()
+        if wait not in (IS_DONT_WAIT, IS_WAIT) and ready - start > wait/100.:
+            return IS_TIMED_OUT
+        if queued:
+            # With an image queue, the frame goes to the next free
+            # sequence buffer once it has been read out.
+            delay = ready - time.perf_counter()
+            if wait == IS_DONT_WAIT and delay > 0:
+                timer = threading.Timer(delay, device.deliver)
+                timer.daemon = True
+                timer.start()
+                return IS_SUCCESS
+            if delay > 0:
+                time.sleep(delay)
+            return device.deliver()
+        if wait == IS_DONT_WAIT:
+            # The frame will be in memory once it is ready; rendering
+            # it immediately is indistinguishable to the caller.
+            ready = start
+        status = device.render(device.active_mem)
+        delay = ready - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        return status
+
+    def _is_SetExternalTrigger(self, hCam, mode):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        if mode == IS_GET_EXTERNALTRIGGER:
+            return device.trigger_mode
+        if mode not in (IS_SET_TRIGGER_OFF, IS_SET_TRIGGER_HI_LO,
+                        IS_SET_TRIGGER_LO_HI, IS_SET_TRIGGER_SOFTWARE):
+            return IS_INVALID_PARAMETER
+        with device.condition:
+            device.trigger_mode = mode
+            device.triggers.clear()
+            device.condition.notify_all()
+        return IS_SUCCESS
+
+    def _is_ForceTrigger(self, hCam):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        if not device.external_trigger:
+            return IS_NO_SUCCESS
+        with device.condition:
+            device.triggers.append(time.perf_counter())
+            device.condition.notify_all()
+        return IS_SUCCESS
+
+    # Live capture
+    # -------------------------------------------------------------------------
+
+    def _sequence_memory(self, device, nNum, pcMem):
+        """Find a sequence buffer either by its position (starting from
+        1) or, if ``nNum`` is ``IS_IGNORE_PARAMETER``, its address.
+
+        """
+        if nNum == IS_IGNORE_PARAMETER:
+            for mem in device.sequence:
+                if mem.address == pcMem:
+                    return mem
+        elif 1 <= nNum <= len(device.sequence):
+            return device.sequence[nNum - 1]
+        return None
+
+    def _is_AddToSequence(self, hCam, pcMem, mem_id):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        mem = device.memories.get(mem_id)
+        if mem is None or mem.address != pcMem:
+            return IS_INVALID_MEMORY_POINTER
+        with device.condition:
+            device.sequence.append(mem)
+        return IS_SUCCESS
+
+    def _is_ClearSequence(self, hCam):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        if device.live:
+            return IS_NO_SUCCESS
+        with device.condition:
+            device.sequence = []
+            device.locked.clear()
+            device.queue.clear()
+        return IS_SUCCESS
+
+    def _is_LockSeqBuf(self, hCam, nNum, pcMem):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        with device.condition:
+            mem = self._sequence_memory(device, nNum, pcMem)
+            if mem is None:
+                return IS_INVALID_PARAMETER
+            device.locked.add(mem.mem_id)
+        return IS_SUCCESS
+
+    def _is_UnlockSeqBuf(self, hCam, nNum, pcMem):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        with device.condition:
+            mem = self._sequence_memory(device, nNum, pcMem)
+            if mem is None:
+                return IS_INVALID_PARAMETER
+            device.locked.discard(mem.mem_id)
+            device.condition.notify_all()
+        return IS_SUCCESS
+
+    def _is_InitImageQueue(self, hCam, nMode):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        with device.condition:
+            device.queue.clear()
+            device.queue_enabled = True
+        return IS_SUCCESS
+
+    def _is_ExitImageQueue(self, hCam):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        with device.condition:
+            device.queue.clear()
+            device.queue_enabled = False
+            device.condition.notify_all()
+        return IS_SUCCESS
+
+    def _is_CaptureVideo(self, hCam, wait):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        with device.condition:
+            if device.live:
+                return IS_SUCCESS
+            if not device.sequence:
+                return IS_INVALID_MEMORY_POINTER
+            device.live = True
+            device.thread = threading.Thread(target=device.capture_loop)
+            device.thread.daemon = True
+            device.thread.start()
+        return IS_SUCCESS
+
+    def _is_StopLiveVideo(self, hCam, wait):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        device.stop_live()
+        return IS_SUCCESS
+
+    def _is_WaitForNextImage(self, hCam, timeout_ms, ppcMem, pid):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        deadline = time.perf_counter() + timeout_ms/1000.
+        with device.condition:
+            if not device.queue_enabled:
+                return IS_NO_SUCCESS
+            while not device.queue:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or not device.queue_enabled:
+                    return IS_TIMED_OUT
+                # Without live capture, only software triggered frames
+                # (see _is_FreezeVideo) can still arrive.
+                if not device.live and \
+                   device.trigger_mode != IS_SET_TRIGGER_SOFTWARE:
+                    return IS_TIMED_OUT
+                device.condition.wait(remaining)
+            mem = device.queue.popleft()
+            device.locked.add(mem.mem_id)
+        _set(ppcMem, c_void_p, mem.address)
+        _set(pid, c_int, mem.mem_id)
+        return IS_SUCCESS
+
+    # Settings
+    # -------------------------------------------------------------------------
+
+    def _is_GetSensorInfo(self, hCam, pInfo):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        info = SENSORINFO.from_address(pInfo)
+        ctypes.memset(pInfo, 0, ctypes.sizeof(info))
+        info.strSensorName = b'FAKE1280'
+        info.nColorMode = 1  # IS_COLORMODE_MONOCHROME
+        info.nMaxWidth, info.nMaxHeight = device.shape
+        info.bGlobShutter = True
+        info.wPixelSize = 530
+        return IS_SUCCESS
+
+    def _is_GetFrameTimeRange(self, hCam, min_, max_, interval):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        t_min, t_max = device.frame_time_range()
+        _set(min_, c_double, t_min)
+        _set(max_, c_double, t_max)
+        _set(interval, c_double, 1e-6)
+        return IS_SUCCESS
+
+    def _is_SetFrameRate(self, hCam, fps, newFPS):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        with device.condition:
+            if fps != IS_GET_FRAMERATE:
+                t_min, t_max = device.frame_time_range()
+                fps = min(max(fps, 1./t_max), 1./t_min)
+                device.frame_rate = fps
+                # As with real sensors, the exposure cannot be longer
+                # than the frame time.
+                device.exposure = min(device.exposure, 1000./fps)
+            frame_time = device.frame_time()
+            _set(newFPS, c_double, 1./frame_time if frame_time else 0.)
+        return IS_SUCCESS
+
+    def _is_AOI(self, hCam, command, pParam, size):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        x, y, w, h = device.aoi
+        if command == IS_AOI_IMAGE_GET_AOI:
+            (c_int*4).from_address(pParam)[:] = device.aoi
+            return IS_SUCCESS
+        elif command == IS_AOI_IMAGE_GET_POS:
+            (c_int*2).from_address(pParam)[:] = [x, y]
+            return IS_SUCCESS
+        elif command == IS_AOI_IMAGE_GET_SIZE:
+            (c_int*2).from_address(pParam)[:] = [w, h]
+            return IS_SUCCESS
+        elif command == IS_AOI_IMAGE_SET_AOI:
+            x, y, w, h = (c_int*4).from_address(pParam)
+        elif command == IS_AOI_IMAGE_SET_POS:
+            x, y = (c_int*2).from_address(pParam)
+        elif command == IS_AOI_IMAGE_SET_SIZE:
+            w, h = (c_int*2).from_address(pParam)
+        else:
+            return IS_INVALID_PARAMETER
+
+        # Sensor constraints: the AOI width must be a multiple of 4
+        # and the height a multiple of 2.
+        if w < 16 or h < 4 or w % 4 or h % 2 or x < 0 or y < 0:
+            return IS_INVALID_PARAMETER
+        if x + w > device.shape[0] or y + h > device.shape[1]:
+            return IS_INVALID_PARAMETER
+        with device.condition:
+            device.aoi = [x, y, w, h]
+            device.configure_generator()
+        return IS_SUCCESS
+
+    def _is_Exposure(self, hCam, command, pParam, size):
+        device = self._device(hCam)
+        if device is None:
+            return IS_INVALID_CAMERA_HANDLE
+        if command == IS_EXPOSURE_CMD_GET_EXPOSURE:
+            _set(pParam, c_double, device.exposure)
+        elif command == IS_EXPOSURE_CMD_GET_EXPOSURE_RANGE:
+            (c_double*3).from_address(pParam)[:] = [0.01, 10000., 0.01]
+        elif command == IS_EXPOSURE_CMD_SET_EXPOSURE:
+            exposure = _get(pParam, c_double)
+            if not 0.01 <= exposure <= 10000.:
+                return IS_INVALID_PARAMETER
+            device.exposure = exposure
+        else:
+            return IS_INVALID_PARAMETER
+        return IS_SUCCESS
+
+    def _is_ImageFile(self, hCam, command, pParam, size):
+        if self._device(hCam) is None:
+            return IS_INVALID_CAMERA_HANDLE
+        return IS_NO_SUCCESS
+
+    def _is_ParameterSet(self, hCam, command, pParam, size):
+        if self._device(hCam) is None:
+            return IS_INVALID_CAMERA_HANDLE
+        return IS_NO_SUCCESS
@@ -0,0 +1,416 @@
+"""Zero-copy distribution of frames to other processes.
+
+A :class:`FramePublisher` copies each frame once into a pool of slots
+in a :mod:`multiprocessing.shared_memory` block and sends only the slot
+index and a few bytes of metadata to each subscriber over a pipe.
+Subscribers (:class:`FrameSubscriber`) map the same block and get
+numpy views of the slots, so frames are never pickled.
+
+Slots are reference counted: the shared block holds one flag per slot
+and subscriber which is set by the publisher when a frame is sent and
+cleared by the subscriber when it releases the frame. A slot is reused
+once no subscriber holds it. Subscribers holding ``max_pending`` frames
+are considered too slow and are skipped for new frames instead of
+stalling the camera. Since every subscriber can hold at most
+``max_pending`` slots, the pool always has a free slot and publishing
+never blocks.
+
+Typical usage::
+
+    cam.start_publisher(max_subscribers=2)
+    sub = cam.publisher.add_subscriber()
+    proc = multiprocessing.Process(target=analyze, args=(sub,))
+    proc.start()
+
+    def analyze(sub):
+        for frame, meta in sub.frames():
+            ...
+
+"""
+
+import time
+import threading
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from log import logger
+
+# Alignment of the image data in the shared block.
+_ALIGN = 64
+
+
+def _layout(n_slots, max_subscribers, shape, dtype):
+    """Return the offset of the image data and the total size of a
+    shared block.
+
+    """
+    flags = n_slots*max_subscribers
+    offset = flags + (-flags % _ALIGN)
+    size = offset + n_slots*int(np.prod(shape))*np.dtype(dtype).itemsize
+    return offset, size
+
+
+def _views(buf, n_slots, max_subscribers, shape, dtype):
+    """Return the reference flags and slot arrays of a shared block."""
+    offset, _ = _layout(n_slots, max_subscribers, shape, dtype)
+    flags = np.ndarray(
+        (n_slots, max_subscribers), dtype=np.uint8, buffer=buf)
+    data = np.ndarray(
+        (n_slots,) + tuple(shape), dtype=dtype, buffer=buf, offset=offset)
+    return flags, data
+
+
+class FramePublisher(object):
+    """Publish frames to subscribers in other processes through shared
+    memory.
+
+    Attributes
+    ----------
+    frames_published : int
+        Number of frames copied into the pool.
+    frames_skipped : list
+        Number of frames each subscriber missed because it had too many
+        frames pending.
+
+    """
+    def __init__(self, max_subscribers=4, max_pending=4, n_slots=None,
+                 shape=None, dtype=None):
+        """Create a new publisher.
+
+        Parameters
+        ----------
+        max_subscribers : int
+            Maximum number of subscribers.
+        max_pending : int
+            Maximum number of frames a subscriber may hold before it is
+            skipped.
+        n_slots : int or None
+            Number of slots in the pool. Must be larger than
+            ``max_subscribers*max_pending``, which is the default if
+            None.
+        shape : tuple or None
+            Slot shape. If None, the pool is allocated for the first
+            published frame. Smaller frames are stored in the top left
+            corner of a slot; larger frames or frames of a different
+            type reallocate the pool.
+        dtype : numpy.dtype or None
+            Slot data type.
+
+        """
+        assert max_subscribers >= 1
+        assert max_pending >= 1
+        if n_slots is None:
+            n_slots = max_subscribers*max_pending + 1
+        if n_slots <= max_subscribers*max_pending:
+            raise ValueError(
+                "n_slots must be larger than max_subscribers*max_pending")
+        self.max_subscribers = max_subscribers
+        self.max_pending = max_pending
+        self.n_slots = n_slots
+        self.shape = None
+        self.dtype = None
+        self.frames_published = 0
+        self.frames_skipped = [0]*max_subscribers
+        self._connections = [None]*max_subscribers
+        self._shm = None
+        self._flags = None
+        self._data = None
+        self._next = 0
+        self._lock = threading.Lock()
+        if shape is not None and dtype is not None:
+            self._allocate(shape, dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.close()
+
+    @property
+    def name(self):
+        """Name of the current shared memory block."""
+        return None if self._shm is None else self._shm.name
+
+    @property
+    def n_subscribers(self):
+        return sum(conn is not None for conn in self._connections)
+
+    def _allocate(self, shape, dtype):
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        _, size = _layout(self.n_slots, self.max_subscribers, shape, dtype)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        flags, data = _views(
+            shm.buf, self.n_slots, self.max_subscribers, shape, dtype)
+        flags[:] = 0
+        if self._shm is not None:
+            logger.warning(
+                'Frame shape or type changed; reallocating shared frames.')
+            # Subscribers keep their own mapping of the old block until
+            # they have released all frames, so it can be unlinked now.
+            self._release_block()
+        self._shm, self._flags, self._data = shm, flags, data
+        self.shape, self.dtype = shape, dtype
+        self._next = 0
+
+    def _release_block(self):
+        self._flags = self._data = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def add_subscriber(self):
+        """Create a new subscriber. The returned
+        :class:`FrameSubscriber` is meant to be passed to a child
+        process (e.g., as an argument of
+        :class:`multiprocessing.Process`).
+
+        """
+        with self._lock:
+            try:
+                index = self._connections.index(None)
+            except ValueError:
+                raise IndexError("Maximum number of subscribers reached.")
+            # Start the resource tracker now so that subscriber
+            # processes share it with the publisher (see _attach).
+            resource_tracker.ensure_running()
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            self._connections[index] = writer
+            self.frames_skipped[index] = 0
+            if self._flags is not None:
+                self._flags[:, index] = 0
+        return FrameSubscriber(
+            index, reader, self.n_slots, self.max_subscribers)
+
+    def remove_subscriber(self, subscriber):
+        """Stop sending frames to a subscriber. ``subscriber`` can be a
+        :class:`FrameSubscriber` or its index.
+
+        """
+        index = getattr(subscriber, 'index', subscriber)
+        with self._lock:
+            self._disconnect(index)
+
+    def _disconnect(self, index):
+        conn = self._connections[index]
+        if conn is None:
+            return
+        self._connections[index] = None
+        try:
+            conn.send(None)
+        except (OSError, ValueError):
+            pass
+        conn.close()
+        if self._flags is not None:
+            self._flags[:, index] = 0
+
+    def publish(self, frame, timestamp=None):
+        """Copy a frame into the pool and notify all subscribers which
+        are keeping up. ``timestamp`` is the acquisition time in ns on
+        the :func:`time.monotonic_ns` clock (default: now), as stored
+        in the ring buffer. Returns the slot index or None if no
+        subscriber received the frame.
+
+        """
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        timestamp = int(timestamp)
+        with self._lock:
+            frame_number = self.frames_published
+            self.frames_published += 1
+            if self.n_subscribers == 0:
+                return None
+            if self._shm is None or frame.dtype != self.dtype or \
+               frame.ndim != len(self.shape) or \
+               any(n > m for n, m in zip(frame.shape, self.shape)):
+                shape = frame.shape
+                if self._shm is not None and frame.ndim == len(self.shape):
+                    shape = tuple(
+                        max(n, m) for n, m in zip(frame.shape, self.shape))
+                self._allocate(shape, frame.dtype)
+
+            pending = self._flags.sum(axis=0)
+            targets = []
+            for i, conn in enumerate(self._connections):
+                if conn is None:
+                    continue
+                if pending[i] >= self.max_pending:
+                    self.frames_skipped[i] += 1
+                else:
+                    targets.append(i)
+            if not targets:
+                return None
+
+            # Subscribers only ever clear flags, so a slot seen as free
+            # here cannot be taken concurrently.
+            free = np.flatnonzero(self._flags.any(axis=1) == 0)
+            slot = int(free[np.searchsorted(free, self._next) % len(free)])
+            self._next = (slot + 1) % self.n_slots
+            self._data[slot][tuple(slice(0, n) for n in frame.shape)] = frame
+            self._flags[slot, targets] = 1
+
+            message = (
+                self._shm.name, self.shape, self.dtype.str, slot,
+                frame.shape, frame_number, timestamp)
+            for i in targets:
+                try:
+                    self._connections[i].send(message)
+                except (OSError, ValueError):
+                    logger.warning(
+                        'Subscriber {} disconnected.'.format(i))
+                    self._connections[i] = None
+                    self._flags[:, i] = 0
+            return slot
+
+    def stats(self):
+        """Return a dict of publishing statistics."""
+        with self._lock:
+            pending = [0]*self.max_subscribers if self._flags is None \
+                else self._flags.sum(axis=0).tolist()
+            return {
+                'published': self.frames_published,
+                'subscribers': self.n_subscribers,
+                'skipped': list(self.frames_skipped),
+                'pending': pending,
+            }
+
+    def close(self):
+        """Disconnect all subscribers and free the shared memory."""
+        with self._lock:
+            for i in range(self.max_subscribers):
+                self._disconnect(i)
+            if self._shm is not None:
+                self._release_block()
+
+
+class FrameSubscriber(object):
+    """Receive frames from a :class:`FramePublisher`.
+
+    Frames are read-only views into shared memory. Each frame must be
+    returned with :meth:`release` once it is no longer needed (this is
+    done automatically when iterating over :meth:`frames`); consumers
+    that need to keep a frame for longer should copy it. A subscriber
+    holding too many frames will miss new frames until it releases
+    some.
+
+    """
+    def __init__(self, index, connection, n_slots, max_subscribers):
+        self.index = index
+        self.n_slots = n_slots
+        self.max_subscribers = max_subscribers
+        self.frames_received = 0
+        self._conn = connection
+        self._shm = None
+        self._flags = None
+        self._data = None
+        self._retired = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_shm=None, _flags=None, _data=None, _retired=[])
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.close()
+
+    def __iter__(self):
+        return self.frames()
+
+    def _attach(self, name, shape, dtype):
+        self._detach()
+        # Processes started by multiprocessing after the subscriber was
+        # created share the resource tracker of the publisher, so
+        # attaching does not make this process unlink the block.
+        shm = shared_memory.SharedMemory(name=name)
+        self._shm = shm
+        self._flags, self._data = _views(
+            shm.buf, self.n_slots, self.max_subscribers, shape,
+            np.dtype(dtype))
+
+    def _detach(self):
+        if self._shm is None:
+            return
+        # Frames of the old block are no longer tracked; the block
+        # stays mapped until all views into it are gone.
+        self._flags = self._data = None
+        self._retired.append(self._shm)
+        self._shm = None
+        retired = []
+        for shm in self._retired:
+            try:
+                shm.close()
+            except BufferError:
+                retired.append(shm)
+        self._retired = retired
+
+    def get(self, timeout=None):
+        """Wait for the next frame. Returns the frame and a dict with
+        its ``slot``, ``frame`` number and ``timestamp`` (int, ns on
+        the :func:`time.monotonic_ns` clock).
+
+        Raises
+        ------
+        IndexError
+            If no frame arrives within ``timeout`` seconds or the
+            publisher was closed.
+
+        """
+        try:
+            if not self._conn.poll(timeout):
+                raise IndexError("No frames available.")
+            message = self._conn.recv()
+        except (EOFError, OSError):
+            message = None
+        if message is None:
+            raise IndexError("Publisher closed.")
+        name, slot_shape, dtype, slot, shape, number, timestamp = message
+        if self._shm is None or self._shm.name != name:
+            self._attach(name, slot_shape, dtype)
+        frame = self._data[slot][tuple(slice(0, n) for n in shape)]
+        frame.flags.writeable = False
+        self.frames_received += 1
+        return frame, {'slot': slot, 'frame': number, 'timestamp': timestamp}
+
+    def release(self, frame):
+        """Hand a frame back to the publisher. ``frame`` can be a frame
+        returned by :meth:`get` or its slot index.
+
+        """
+        if self._data is None:
+            return
+        if isinstance(frame, np.ndarray):
+            offset = frame.ctypes.data - self._data.ctypes.data
+            slot = offset//self._data[0].nbytes
+            if offset < 0 or slot >= self.n_slots:
+                return  # frame from a previous block
+        else:
+            slot = frame
+        self._flags[slot, self.index] = 0
+
+    def frames(self, timeout=None):
+        """Iterate over ``(frame, meta)`` pairs until the publisher is
+        closed. Each frame is released when the next one is requested.
+
+        """
+        frame = None
+        try:
+            while True:
+                try:
+                    frame, meta = self.get(timeout)
+                except IndexError:
+                    return
+                yield frame, meta
+                self.release(frame)
+                frame = None
+        finally:
+            if frame is not None:
+                self.release(frame)
+
+    def close(self):
+        """Release all frames and detach from the shared memory."""
+        if self._flags is not None:
+            self._flags[:, self.index] = 0
+        self._detach()
+        self._conn.close()
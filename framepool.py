@@ -0,0 +1,96 @@
+"""Pools of preallocated frame buffers."""
+
+import threading
+from collections import deque
+import numpy as np
+
+
+class FramePool(object):
+    """A fixed set of preallocated frame buffers.
+
+    Buffers are handed out with :meth:`acquire` and returned with
+    :meth:`release`. Frames given to consumers are usually views into
+    a pool buffer (e.g., with line padding removed); :meth:`release`
+    accepts either the buffer itself or any view starting at the
+    beginning of the buffer.
+
+    Attributes
+    ----------
+    buffers : list
+        The preallocated buffers.
+    tags : list
+        Arbitrary per-buffer data (e.g., memory IDs assigned by a
+        camera driver).
+
+    """
+    def __init__(self, n, shape, dtype=np.uint8):
+        """Allocate ``n`` buffers of the given shape and dtype."""
+        assert n >= 1
+        self.buffers = [np.zeros(shape, dtype=dtype) for _ in range(n)]
+        self.tags = [None]*n
+        self._addresses = {
+            buf.ctypes.data: i for i, buf in enumerate(self.buffers)}
+        self._free = deque(range(n))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.buffers)
+
+    @property
+    def n_free(self):
+        """Number of buffers currently available."""
+        return len(self._free)
+
+    def address(self, index):
+        """Return the memory address of buffer ``index``."""
+        return self.buffers[index].ctypes.data
+
+    def index_of(self, frame):
+        """Return the index of the buffer backing ``frame`` or None if
+        it does not belong to the pool.
+
+        """
+        if not isinstance(frame, np.ndarray):
+            return None
+        return self._addresses.get(frame.ctypes.data)
+
+    def is_free(self, index):
+        """Check if buffer ``index`` is available."""
+        with self._lock:
+            return index in self._free
+
+    def take(self, index):
+        """Take the specific buffer ``index`` from the pool. Returns
+        False if it is already in use.
+
+        """
+        with self._lock:
+            if index not in self._free:
+                return False
+            self._free.remove(index)
+        return True
+
+    def acquire(self):
+        """Take a free buffer from the pool. Returns the buffer index
+        or None if all buffers are in use.
+
+        """
+        with self._lock:
+            if not self._free:
+                return None
+            return self._free.popleft()
+
+    def release(self, frame):
+        """Return a buffer to the pool. ``frame`` can be a buffer index
+        or an array backed by a pool buffer. Returns True if a buffer
+        was returned to the pool.
+
+        """
+        index = frame if isinstance(frame, int) else self.index_of(frame)
+        if index is None:
+            return False
+        with self._lock:
+            if index in self._free:
+                return False
+            self._free.append(index)
+        return True
@@ -1,18 +1,286 @@
-"""Image manipulation utilities."""
+"""Image manipulation utilities.
+
+matplotlib and PIL are imported when first needed rather than on
+import. The list of available colormap names, ``COLORMAPS``, is
+likewise computed on first access.
+
+Rotations, flips and crops of an :class:`Image` are kept as a
+:class:`Transform` and applied as a single numpy view when the pixels
+are needed.
+
+"""
 
 #from __future__ import print_function, division
 import numbers
+import functools
 import numpy as np
-from matplotlib import cm as mplcm, colors as mplcolors
-import PIL.Image
 
-COLORMAPS = sorted([cmap for cmap in mplcm.datad if not cmap.endswith('_r')])
+#: Maximum number of colormap lookup tables kept in memory.
+LUT_CACHE_SIZE = 32
+
+#: Ways of combining binned pixels (see :func:`bin_image`).
+BIN_MODES = ('sum', 'mean')
+
+
+def __getattr__(name):
+    """Compute ``COLORMAPS`` on first access."""
+    if name == 'COLORMAPS':
+        from matplotlib import cm as mplcm
+        colormaps = sorted(
+            [cmap for cmap in mplcm.datad if not cmap.endswith('_r')])
+        globals()['COLORMAPS'] = colormaps
+        return colormaps
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def _scalar_mappable(cmap, vmin, vmax):
+    """Create a matplotlib ScalarMappable for a colormap name."""
+    import matplotlib
+    from matplotlib import cm as mplcm, colors as mplcolors
+    try:
+        colormap = matplotlib.colormaps[cmap]
+    except AttributeError:  # matplotlib < 3.5
+        colormap = mplcm.get_cmap(cmap)
+    return mplcm.ScalarMappable(
+        mplcolors.Normalize(vmin=vmin, vmax=vmax), colormap)
+
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def colormap_lut(cmap, vmin, vmax, dtype):
+    """Return an RGBA lookup table for applying the colormap ``cmap``
+    scaled to ``vmin``, ``vmax`` to images of the integer type
+    ``dtype`` (8 or 16 bits).
+
+    The table has one entry per possible pixel value, indexed by the
+    pixel value reinterpreted as unsigned, and is returned as an array
+    of ``uint32`` holding the 4 RGBA bytes of each color. Tables are
+    cached, so repeated calls with the same arguments are free.
+
+    """
+    dtype = np.dtype(dtype)
+    assert dtype.kind in 'ui' and dtype.itemsize <= 2
+    unsigned = np.dtype('u{}'.format(dtype.itemsize))
+    values = np.arange(2**(8*dtype.itemsize)).astype(unsigned).view(dtype)
+    colormap = _scalar_mappable(cmap, vmin, vmax)
+    rgba = np.ascontiguousarray(colormap.to_rgba(values, bytes=True))
+    lut = rgba.view(np.uint32).reshape(-1)
+    lut.flags.writeable = False
+    return lut
+
+
+def apply_colormap(data, cmap, vmin=None, vmax=None, out=None):
+    """Apply a colormap to an image and return an RGBA image of shape
+    ``data.shape + (4,)`` and type ``uint8``.
+
+    For 8 and 16 bit integer images this is a single lookup in a
+    cached table (see :func:`colormap_lut`), optionally into the
+    preallocated array ``out``. Other types are converted with
+    matplotlib. If ``vmin`` or ``vmax`` are not given, the image
+    minimum and maximum are used; giving fixed limits avoids both
+    computing them and building a new table for every image. If
+    ``cmap`` is None, matplotlib's default colormap
+    (``rcParams['image.cmap']``) is used.
+
+    """
+    if cmap is None:
+        import matplotlib
+        cmap = matplotlib.rcParams['image.cmap']
+    if vmin is None:
+        vmin = data.min()
+    if vmax is None:
+        vmax = data.max()
+    if data.dtype.kind not in 'ui' or data.dtype.itemsize > 2:
+        colormap = _scalar_mappable(cmap, vmin, vmax)
+        rgba = colormap.to_rgba(data, bytes=True)
+        if out is None:
+            return rgba
+        out[:] = rgba
+        return out
+
+    lut = colormap_lut(str(cmap), float(vmin), float(vmax), data.dtype.str)
+    if out is None:
+        out = np.empty(data.shape + (4,), dtype=np.uint8)
+    assert out.shape == data.shape + (4,) and out.dtype == np.uint8
+    assert out.flags.c_contiguous
+    indices = data.view('u{}'.format(data.dtype.itemsize))
+    np.take(lut, indices, out=out.view(np.uint32)[..., 0])
+    return out
+
+
+def bin_image(data, bins, mode='sum'):
+    """Bin ``bins x bins`` blocks of pixels of an image by adding them
+    up (``mode='sum'``) or averaging them (``mode='mean'``). Rows and
+    columns which do not fill a whole block are discarded.
+
+    Sums of 8 and 16 bit integer images are returned with twice the
+    number of bits so that they cannot overflow; means keep the type
+    of the image (rounded down for integers).
+
+    """
+    if mode not in BIN_MODES:
+        raise ValueError("Unknown binning mode {}".format(mode))
+    assert bins >= 1
+    rows, cols = data.shape[0]//bins, data.shape[1]//bins
+    blocks = data[:rows*bins, :cols*bins].reshape(
+        (rows, bins, cols, bins) + data.shape[2:])
+    if data.dtype.kind in 'ui' and data.dtype.itemsize <= 2:
+        acc = np.dtype('{}{}'.format(data.dtype.kind, 2*data.dtype.itemsize))
+    elif data.dtype.kind in 'ui':
+        acc = np.dtype(np.int64 if data.dtype.kind == 'i' else np.uint64)
+    else:
+        acc = data.dtype
+
+    # Adding up the bins strided slices of the blocks is several times
+    # faster than np.sum over the strided block axes.
+    columns = blocks[:, :, :, 0].astype(acc)
+    for i in range(1, bins):
+        columns += blocks[:, :, :, i]
+    binned = columns[:, 0].copy()
+    for i in range(1, bins):
+        binned += columns[:, i]
+
+    if mode == 'sum':
+        return binned
+    if acc.kind in 'ui':
+        binned //= bins*bins
+    else:
+        binned /= bins*bins
+    return binned.astype(data.dtype, copy=False)
+
+
+class Transform(object):
+    """A chain of rotations, flips and crops of an image, collapsed
+    into a single numpy view.
+
+    Any sequence of 90 degree rotations and flips of a 2D array is
+    equivalent to an optional transpose followed by reversing rows
+    and/or columns, and a crop is a slice; so the whole chain is kept as
+    a transpose flag plus one start, step and length per axis, and
+    :meth:`apply` returns a strided view without copying any pixels.
+    Operations act on the output of the previous ones, so they compose
+    in the order they are called.
+
+    """
+    def __init__(self, shape):
+        """Create an identity transform for images of ``shape`` (rows,
+        columns).
+
+        """
+        rows, cols = shape[:2]
+        self.input_shape = (rows, cols)
+        self.transposed = False
+        # (start, step, length) of rows and columns, indexing the
+        # (possibly transposed) input.
+        self._axes = [(0, 1, rows), (0, 1, cols)]
+
+    def __repr__(self):
+        return '<Transform transposed={} rows={} cols={}>'.format(
+            self.transposed, self._axes[0], self._axes[1])
+
+    @property
+    def shape(self):
+        """Shape (rows, columns) of the transformed image."""
+        return (self._axes[0][2], self._axes[1][2])
+
+    @property
+    def is_identity(self):
+        return (not self.transposed and
+                self._axes == [(0, 1, self.input_shape[0]),
+                               (0, 1, self.input_shape[1])])
+
+    def copy(self):
+        new = Transform(self.input_shape)
+        new.transposed = self.transposed
+        new._axes = list(self._axes)
+        return new
+
+    def reset(self):
+        """Undo all transformations."""
+        self.__init__(self.input_shape)
+
+    def _reverse(self, axis):
+        start, step, length = self._axes[axis]
+        self._axes[axis] = (start + step*(length - 1), -step, length)
+
+    def transpose(self):
+        """Swap rows and columns."""
+        self.transposed = not self.transposed
+        self._axes.reverse()
+
+    def rotate(self, turns):
+        """Rotate counterclockwise by 90 degrees ``turns`` times (same
+        as :func:`numpy.rot90`).
+
+        """
+        assert isinstance(turns, numbers.Integral)
+        for _ in range(turns % 4):
+            self.transpose()
+            self._reverse(0)
+
+    def flip(self, axis):
+        """Flip ``'vertical'`` (mirror left to right, about the
+        vertical axis) or ``'horizontal'`` (mirror top to bottom).
+
+        """
+        if axis == 'vertical':
+            self._reverse(1)
+        elif axis == 'horizontal':
+            self._reverse(0)
+        else:
+            raise ValueError(
+                "axis must be 'vertical' or 'horizontal', not {!r}".format(
+                    axis))
+
+    def crop(self, box):
+        """Crop to ``box = (left, upper, right, lower)`` in pixels of
+        the current output, with ``right`` and ``lower`` exclusive
+        (as in :meth:`PIL.Image.Image.crop`).
+
+        """
+        left, upper, right, lower = box
+        rows, cols = self.shape
+        if not (0 <= left < right <= cols and 0 <= upper < lower <= rows):
+            raise ValueError(
+                "Crop box {} outside of image of shape {}".format(
+                    box, self.shape))
+        for axis, (lo, hi) in enumerate(((upper, lower), (left, right))):
+            start, step, length = self._axes[axis]
+            self._axes[axis] = (start + step*lo, step, hi - lo)
+
+    def slices(self):
+        """Return the slices selecting the output from the (possibly
+        transposed) input.
+
+        """
+        slices = []
+        for start, step, length in self._axes:
+            stop = start + step*length
+            slices.append(slice(start, stop if stop >= 0 else None, step))
+        return tuple(slices)
+
+    def apply(self, data):
+        """Return a view of ``data`` with the transform applied. Any
+        trailing axes (e.g., color channels) are left alone.
+
+        """
+        if data.shape[:2] != self.input_shape:
+            raise ValueError(
+                "Transform is for images of shape {}, got {}".format(
+                    self.input_shape, data.shape[:2]))
+        if self.transposed:
+            data = data.swapaxes(0, 1)
+        return data[self.slices()]
 
 
 class Image(object):
     """Utility class for representing an image. Images can have
     colormaps applied to them and be transformed in various ways.
 
+    Rotations, flips and crops are recorded in :attr:`transform` and
+    only applied when the pixels are needed (:meth:`to_array`,
+    :attr:`img`, :meth:`save`), so they cost nothing until then.
+
     """
     def __init__(self, data, cmap=None, vmin=None, vmax=None):
         """Create a new image from an array.
@@ -31,47 +299,72 @@ class Image(object):
         assert isinstance(data, np.ndarray)
         assert cmap is None or isinstance(cmap, str)
         self.data = data
+        self.cmap = cmap
+        self.transform = Transform(data.shape)
+        self._rgba = None
+        self._img = None
 
         self._create_image(cmap, vmin, vmax)
 
     def _create_image(self, cmap=None, vmin=None, vmax=None):
-        """Create a new (PIL) image and optionally apply a
-        colormap.
+        """Optionally apply a colormap. The PIL image is created when
+        first needed.
 
         """
         if cmap:
             self.apply_colormap(cmap, vmin, vmax)
         else:
-            # TODO: check that this works properly
-            self.img = PIL.Image.fromarray(self.data)
+            self._rgba = None
+            self._img = None
+
+    @property
+    def img(self):
+        """The transformed image as a PIL image."""
+        if self._img is None:
+            import PIL.Image
+            self._img = PIL.Image.fromarray(
+                np.ascontiguousarray(self.to_array()))
+        return self._img
+
+    @property
+    def shape(self):
+        """Shape (rows, columns) of the transformed image."""
+        return self.transform.shape
+
+    def to_array(self):
+        """Return the transformed pixels (RGBA if a colormap was
+        applied) as a view of the underlying data.
+
+        """
+        pixels = self.data if self._rgba is None else self._rgba
+        return self.transform.apply(pixels)
 
     def apply_colormap(self, cmap=None, vmin=None, vmax=None):
         """Apply a colormap to the image.
 
-        If ``cmap`` is None, use the pre-defined colormap.
+        If ``cmap`` is None, use the pre-defined colormap or, if there
+        is none, matplotlib's default.
 
         """
         assert cmap is None or isinstance(cmap, str)
         assert vmin is None or isinstance(vmin, numbers.Real)
         assert vmax is None or isinstance(vmax, numbers.Real)
-        if vmin is None:
-            vmin = self.data.min()
-        if vmax is None:
-            vmax = self.data.max()
         if cmap is None:
             cmap = self.cmap
+        self.cmap = cmap
 
-        colormap = mplcm.ScalarMappable(
-            mplcolors.Normalize(vmin=vmin, vmax=vmax),
-            mplcm.get_cmap(str(cmap))
-        )
-        self.img = PIL.Image.fromarray(
-            colormap.to_rgba(self.data, bytes=True))
+        # Reuse the output array when recoloring the same image.
+        out = self._rgba
+        if out is not None and out.shape != self.data.shape + (4,):
+            out = None
+        self._rgba = apply_colormap(self.data, cmap, vmin, vmax, out=out)
+        self._img = None
 
     def rotate(self, turns):
         """Rotate counterclockwise 90 degrees ``turns`` times."""
         assert type(turns) is int
-        self.img = self.img.rotate(90*turns)
+        self.transform.rotate(turns)
+        self._img = None
 
     def flip(self, axis):
         """Flip the image either vertically or horizontally.
@@ -79,18 +372,29 @@ class Image(object):
         Parameters
         ----------
         axis : str
-            'vertical' or 'horizontal'
+            'vertical' (left to right) or 'horizontal' (top to bottom)
 
         """
         assert type(axis) is str
-        if axis is 'vertical':
-            self.img = self.img.transpose(PIL.Image.FLIP_LEFT_RIGHT)
-        elif axis is 'horizontal':
-            self.img = self.img.transpose(PIL.Image.FLIP_TOP_BOTTOM)
+        self.transform.flip(axis)
+        self._img = None
+
+    def crop(self, box):
+        """Crop the image to ``box = (left, upper, right, lower)``. See
+        :meth:`Transform.crop`.
+
+        """
+        self.transform.crop(box)
+        self._img = None
+
+    def reset_transform(self):
+        """Undo all rotations, flips and crops."""
+        self.transform.reset()
+        self._img = None
 
     def tostring(self):
-        """Convenience wrapper to the PIL.Image.tostring method."""
-        return self.img.tostring()
+        """Return the transformed pixels as bytes."""
+        return np.ascontiguousarray(self.to_array()).tobytes()
 
     def save(self, filename):
         """Save the image to a file."""
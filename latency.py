@@ -0,0 +1,189 @@
+"""Latency instrumentation.
+
+Durations of the stages of the acquisition path (e.g., waiting for the
+camera, writing to the ring buffer) are recorded into fixed-bucket
+histograms by a :class:`LatencyRecorder`. Recording a sample only
+increments a counter, so instrumentation can be left on while
+acquiring at full speed; when disabled, instrumented code skips it
+entirely after checking a single flag.
+
+Instrumented code follows this pattern::
+
+    latency = self.latency if self.latency.enabled else None
+    t = latency.clock() if latency else 0
+    ...  # stage 1
+    if latency:
+        t = latency.record('stage1', t)
+
+"""
+
+import time
+import threading
+from log import logger
+
+# Histogram layout: durations in ns below 2**_SUB_BITS have a bucket
+# each; above that, every power of two is split into 2**_SUB_BITS
+# buckets, so bucket widths are at most 1/8 of the value. Durations of
+# 2**_MAX_OCTAVE ns (about 18 minutes) or more go into the last bucket.
+_SUB_BITS = 3
+_SUB = 1 << _SUB_BITS
+_MAX_OCTAVE = 40
+_N_BUCKETS = _SUB + (_MAX_OCTAVE - _SUB_BITS)*_SUB
+
+
+def _bucket(ns):
+    """Return the histogram bucket of a duration in ns."""
+    if ns < _SUB:
+        return max(ns, 0)
+    octave = ns.bit_length() - 1
+    if octave >= _MAX_OCTAVE:
+        return _N_BUCKETS - 1
+    return _SUB + (octave - _SUB_BITS)*_SUB + \
+        (ns >> (octave - _SUB_BITS)) - _SUB
+
+
+def _bucket_upper(index):
+    """Return the smallest duration in ns above bucket ``index``."""
+    if index < _SUB:
+        return index + 1
+    shift, sub = divmod(index - _SUB, _SUB)
+    return (_SUB + sub + 1) << shift
+
+
+class LatencyHistogram(object):
+    """Histogram of durations with fixed logarithmic buckets.
+
+    Percentiles are accurate to within 12.5%; the minimum and maximum
+    are exact.
+
+    """
+    def __init__(self):
+        self.counts = [0]*_N_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def add(self, ns):
+        """Record a duration in ns."""
+        self.counts[_bucket(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+
+    def percentile(self, q):
+        """Return the ``q``-th percentile (0 to 100) in ns, or 0 if
+        there are no samples.
+
+        """
+        if not self.count:
+            return 0
+        rank = q/100.*self.count
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(_bucket_upper(index), self.max)
+        return self.max
+
+    def summary(self):
+        """Return a dict with the sample count and the mean, minimum,
+        median, 99th percentile and maximum in us.
+
+        """
+        return {
+            'count': self.count,
+            'mean_us': self.total/self.count/1e3 if self.count else 0.,
+            'min_us': (self.min or 0)/1e3,
+            'p50_us': self.percentile(50)/1e3,
+            'p99_us': self.percentile(99)/1e3,
+            'max_us': self.max/1e3,
+        }
+
+
+class LatencyRecorder(object):
+    """Per-stage latency histograms.
+
+    Attributes
+    ----------
+    enabled : bool
+        Whether instrumented code records durations. Toggle with
+        :meth:`enable` and :meth:`disable`.
+    log_interval : float or None
+        Interval in s at which summaries are logged, or None.
+
+    """
+    #: Clock used for timing stages (ns).
+    clock = staticmethod(time.perf_counter_ns)
+
+    def __init__(self, enabled=False, log_interval=None):
+        self.enabled = enabled
+        self.log_interval = log_interval
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._next_log = None
+
+    def enable(self, log_interval=None):
+        """Start recording. If ``log_interval`` is given, a summary is
+        logged every ``log_interval`` seconds.
+
+        """
+        self.log_interval = log_interval
+        self._next_log = None
+        if log_interval is not None:
+            self._next_log = self.clock() + int(log_interval*1e9)
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording. Recorded histograms are kept."""
+        self.enabled = False
+
+    def reset(self):
+        """Discard all recorded durations."""
+        with self._lock:
+            self.histograms = {}
+
+    def record(self, stage, start):
+        """Record the time since ``start`` (from :meth:`clock`) for
+        ``stage``. Returns the current time, which can be used as the
+        start of the next stage.
+
+        """
+        now = self.clock()
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(
+                    stage, LatencyHistogram())
+        histogram.add(now - start)
+        return now
+
+    def tick(self):
+        """Log a summary if the log interval has elapsed. Meant to be
+        called once per frame.
+
+        """
+        if self._next_log is None or self.clock() < self._next_log:
+            return
+        self._next_log = self.clock() + int(self.log_interval*1e9)
+        self.log_summary()
+
+    def summary(self):
+        """Return a dict of per-stage summaries (see
+        :meth:`LatencyHistogram.summary`).
+
+        """
+        with self._lock:
+            histograms = dict(self.histograms)
+        return {stage: h.summary() for stage, h in histograms.items()}
+
+    def log_summary(self):
+        """Log one line per stage with its latency percentiles."""
+        for stage, s in sorted(self.summary().items()):
+            logger.info(
+                '{:<16} n={count:<8} p50={p50_us:9.1f} us '
+                'p99={p99_us:9.1f} us max={max_us:9.1f} us'.format(
+                    stage, **s))
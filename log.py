@@ -1,7 +1,21 @@
-"""Log handling for qCamera."""
+"""Log handling for qCamera.
+
+:func:`setup_logging` configures the ``qCamera`` logger. By default
+records are only put on a queue by the logging thread; formatting and
+writing to the console or log file happens on a background thread, so
+logging from the acquisition thread never waits for I/O. Messages
+logged repeatedly from the same place are rate limited (see
+:class:`RateLimitFilter`).
+
+"""
 
 import sys
+import time
+import queue
+import atexit
 import logging
+import threading
+import logging.handlers
 try:
     import colorama
     colorama.init(autoreset=True)
@@ -10,6 +24,9 @@ except ImportError:
 
 logger = logging.getLogger('qCamera')
 
+# Background listener started by setup_logging, if any.
+_listener = None
+
 
 class LogFormatter(logging.Formatter):
     """Formatter for use with qCamera's logging facilities."""
@@ -42,7 +59,7 @@ class LogFormatter(logging.Formatter):
         assert isinstance(fmt, str)
         assert isinstance(colors, dict)
 
-        logging.Formatter.__init__(self)
+        logging.Formatter.__init__(self, fmt)
         self.fmt = fmt
         if colors and colorama:
             self.colors = {levelno: colors[levelno] for levelno in colors}
@@ -50,18 +67,73 @@ class LogFormatter(logging.Formatter):
             self.colors = {}
 
     def format(self, record):
-        message = record.getMessage()
-        record.message = message
-        record.asctime = self.formatTime(record)
-        if record.levelno in self.colors:
-            record.color = self.colors[record.levelno]
-        else:
-            record.color = ''
-        formatted = self.fmt % record.__dict__
-        return formatted
+        color = self.colors.get(record.levelno)
+        # Colors are ANSI color numbers, which colorama translates on
+        # Windows.
+        record.color = '' if color is None else '\033[3{}m'.format(color)
+        return logging.Formatter.format(self, record)
 
 
-def setup_logging(level=logging.INFO, stream=True, file=False, color=True):
+class RateLimitFilter(logging.Filter):
+    """Limit how often a message can be logged.
+
+    Messages are told apart by where they are logged from (file and
+    line), so a message with changing values (e.g., an error code)
+    counts as the same message. At most ``burst`` records per message
+    pass every ``interval`` seconds; the first record passing after
+    some were dropped notes how many were suppressed. Only records of
+    at least ``level`` are limited.
+
+    """
+    def __init__(self, interval=1., burst=5, level=logging.WARNING):
+        logging.Filter.__init__(self)
+        assert interval > 0 and burst >= 1
+        self.interval = interval
+        self.burst = burst
+        self.level = level
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.pathname, record.lineno, record.levelno)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.msg = '{} ({} similar messages suppressed)'.format(
+                record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queue handler leaving all formatting to the listener thread.
+
+    The standard handler formats records before queuing them; here
+    only the message arguments are merged (so later changes to them
+    do not show up in the log) and tracebacks are formatted by the
+    listener.
+
+    """
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level=logging.INFO, stream=True, file=False, color=True,
+                  **kwargs):
     """Configure logging with default formatting.
 
     Keyword arguments
@@ -71,20 +143,74 @@ def setup_logging(level=logging.INFO, stream=True, file=False, color=True):
     stream : bool
         Write logs to a stream.
     file: bool
-        TODO: Write logs to a file.
+        Write logs to a file which is rotated when it gets too large.
     color : bool
-        TODO: Try to use colored output if possible for stream handlers.
+        Try to use colored output if possible for stream handlers.
+    filename : str
+        Log file name. Default: ``'qcamera.log'``.
+    max_bytes : int
+        Size at which the log file is rotated. Default: 10 MB.
+    backup_count : int
+        Number of rotated log files to keep. Default: 5.
+    queued : bool
+        Format and write records on a background thread so that
+        logging never blocks on I/O. Default: True.
+    rate_limit : tuple or None
+        ``(interval, burst)`` for a :class:`RateLimitFilter` applied
+        to warnings and errors, or None to disable rate limiting.
+        Default: ``(1., 5)``.
 
     """
+    global _listener
     assert level in [0, 10, 20, 30, 40, 50]
+    filename = kwargs.get('filename', 'qcamera.log')
+    max_bytes = int(kwargs.get('max_bytes', 10*1024**2))
+    backup_count = int(kwargs.get('backup_count', 5))
+    queued = kwargs.get('queued', True)
+    rate_limit = kwargs.get('rate_limit', (1., 5))
+
+    handlers = []
     if stream:
         handler = logging.StreamHandler(sys.stdout)
-        formatter = LogFormatter()
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        logger.setLevel(level)
+        colors = LogFormatter.DEFAULT_COLORS if color else {}
+        handler.setFormatter(LogFormatter(colors=colors))
+        handlers.append(handler)
     if file:
-        pass  # TODO
+        handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(LogFormatter(colors={}))
+        handlers.append(handler)
+
+    stop_logging()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    if queued and handlers:
+        _listener = logging.handlers.QueueListener(
+            queue.SimpleQueue(), *handlers)
+        _listener.start()
+        handlers = [_QueueHandler(_listener.queue)]
+    for handler in handlers:
+        if rate_limit is not None:
+            handler.addFilter(RateLimitFilter(*rate_limit))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+
+
+def stop_logging():
+    """Write out all queued records and stop the background logging
+    thread. This is done automatically at exit.
+
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
 
 if __name__ == "__main__":
     pass
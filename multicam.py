@@ -0,0 +1,429 @@
+"""Synchronized acquisition from several cameras.
+
+A :class:`CameraGroup` acquires from several cameras in parallel: each
+camera is read by its own :class:`acquisition.AcquisitionEngine` worker
+thread and records to its own ring buffer. Frames are combined into
+:class:`FrameSet` objects holding one frame per camera.
+
+The cameras are not synchronized in hardware, so frames are matched by
+the host time at which they were acquired. Each set is built around
+the newest of the oldest pending frames of all cameras (the reference
+time) and takes from every other camera the frame closest to it.
+Frames passed over are released, but remain in the ring buffers. The
+spread of timestamps within a set is the inter-camera skew, which is
+recorded along with the aggregate throughput (see
+:meth:`CameraGroup.stats`)::
+
+  from multicam import open_cameras, CameraGroup
+  group = CameraGroup(open_cameras(buffer_backend='memory'))
+  with group:
+      for frame_set in group.frames():
+          ...
+  group.close()
+
+Or, from the command line with two simulated ThorLabs cameras, each
+recording to its own ``rbuffer_<serial>.h5`` unless ``--no-record``
+is given::
+
+  $ python multicam.py --fake 2 --duration 5 --json
+
+"""
+
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from log import logger, setup_logging
+from latency import LatencyHistogram
+from exceptions import CameraError
+from ringbuffer import BACKENDS
+
+
+def open_cameras(serials=None, library=None, **kwargs):
+    """Open several ThorLabs DCx cameras.
+
+    Parameters
+    ----------
+    serials : list or None
+        Serial numbers of the cameras to open. If None, all connected
+        cameras not in use are opened.
+    library : str, callable, library object or None
+        The uc480 library to use (see :class:`thorlabs.ThorlabsDCx`).
+        It is loaded once and shared by all cameras.
+
+    Additional keyword arguments are passed on to
+    :class:`thorlabs.ThorlabsDCx`. Unless a ring buffer file name is
+    given in ``buffer_options``, each camera records to
+    ``rbuffer_<serial>.h5`` (or ``.mmap``).
+
+    Returns
+    -------
+    cameras : list
+        The opened cameras in the order of ``serials``.
+
+    """
+    from thorlabs import ThorlabsDCx, list_cameras, open_library
+    clib = open_library(library)
+    if serials is None:
+        serials = [c['serial'] for c in list_cameras(clib) if not c['in_use']]
+    if not serials:
+        raise CameraError("No cameras available.")
+    extension = 'mmap' if kwargs.get('buffer_backend') == 'mmap' else 'h5'
+    buffer_options = kwargs.get('buffer_options', {})
+    cameras = []
+    try:
+        for serial in serials:
+            options = dict(buffer_options)
+            options.setdefault(
+                'filename', 'rbuffer_{}.{}'.format(serial, extension))
+            kwargs['buffer_options'] = options
+            cameras.append(ThorlabsDCx(library=clib, serial=serial, **kwargs))
+    except Exception:
+        for camera in cameras:
+            camera.__exit__(None, None, None)
+        raise
+    return cameras
+
+
+class FrameSet(object):
+    """Frames from all cameras of a :class:`CameraGroup` acquired at
+    about the same time. Iterating over a set or indexing it yields
+    the frames.
+
+    Attributes
+    ----------
+    index : int
+        Sequence number of the set.
+    frames : list
+        One frame per camera in the order of the group's cameras.
+    timestamps : list
+        Host acquisition time of each frame in ns on the
+        :func:`time.monotonic_ns` clock, as stored in the ring
+        buffers.
+    skew : int
+        Difference between the latest and earliest timestamp in ns.
+
+    """
+    def __init__(self, index, frames, timestamps):
+        self.index = index
+        self.frames = frames
+        self.timestamps = timestamps
+        self.skew = max(timestamps) - min(timestamps)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+
+class CameraGroup(object):
+    """Acquire matched frames from several cameras in parallel.
+
+    Attributes
+    ----------
+    cameras : list
+        The cameras of the group.
+    sets_delivered : int
+        Number of frame sets returned by :meth:`get`.
+    frames_unmatched : list
+        Number of frames per camera passed over when matching.
+    skew : LatencyHistogram
+        Distribution of the inter-camera skew of the delivered sets.
+
+    """
+    def __init__(self, cameras, maxsize=16, policy='drop_oldest'):
+        """Create a new camera group.
+
+        Parameters
+        ----------
+        cameras : list
+            The cameras to acquire from. Cameras should record to
+            separate ring buffers (see :func:`open_cameras`).
+        maxsize : int
+            Maximum number of frames waiting per camera.
+        policy : str
+            Overflow policy of each camera's queue (see
+            :class:`acquisition.AcquisitionEngine`).
+
+        """
+        if not cameras:
+            raise CameraError("A camera group needs at least one camera.")
+        self.cameras = list(cameras)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sets_delivered = 0
+        self.bytes_delivered = 0
+        self.frames_unmatched = [0]*len(self.cameras)
+        self.skew = LatencyHistogram()
+        self._engines = []
+        self._pending = [deque() for _ in self.cameras]
+        self._t_start = None
+        self._t_stop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.stop()
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def __iter__(self):
+        return self.frames()
+
+    @property
+    def running(self):
+        return any(engine.running for engine in self._engines)
+
+    def start(self):
+        """Start acquiring. All cameras supporting continuous capture
+        are started (see :meth:`camera.Camera.start`) before the
+        worker threads, so that they are all free running by the time
+        the first frames are grabbed.
+
+        """
+        if self.running:
+            return
+        for camera in self.cameras:
+            try:
+                camera.start()
+            except NotImplementedError:
+                pass
+        self._t_start = time.perf_counter()
+        self._t_stop = None
+        self._engines = [
+            camera.start_acquisition_thread(
+                maxsize=self.maxsize, policy=self.policy)
+            for camera in self.cameras]
+
+    def stop(self):
+        """Stop acquiring and release all pending frames."""
+        for camera in self.cameras:
+            camera.stop_acquisition_thread()
+        for camera, pending in zip(self.cameras, self._pending):
+            while pending:
+                camera.release_image(pending.popleft()[0])
+        if self._t_start is not None and self._t_stop is None:
+            self._t_stop = time.perf_counter()
+        for camera in self.cameras:
+            try:
+                camera.stop()
+            except NotImplementedError:
+                pass
+
+    def close(self):
+        """Stop acquiring and close all cameras."""
+        self.stop()
+        for camera in self.cameras:
+            camera.__exit__(None, None, None)
+
+    def _next(self, i, deadline):
+        """Take the next frame and its timestamp from camera ``i``."""
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - time.perf_counter(), 0)
+        return self._engines[i].get(timeout, with_timestamp=True)
+
+    def _skip(self, i):
+        """Release the oldest pending frame of camera ``i``."""
+        self.cameras[i].release_image(self._pending[i].popleft()[0])
+        self.frames_unmatched[i] += 1
+
+    def get(self, timeout=None):
+        """Return the next :class:`FrameSet`. Pass it to
+        :meth:`release` when done with it.
+
+        Matching a frame to the reference time may require waiting for
+        the next frame of a camera to see which one is closer, so sets
+        are delivered up to one frame period late. Frames taken from
+        the cameras are kept for the next call if ``timeout`` expires.
+
+        Raises
+        ------
+        IndexError
+            If no complete set becomes available within ``timeout``
+            seconds or acquisition was stopped.
+        CameraError
+            If acquisition failed for one of the cameras.
+
+        """
+        if not self._engines:
+            raise CameraError("Camera group not started.")
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        pending = self._pending
+        for i, frames in enumerate(pending):
+            if not frames:
+                frames.append(self._next(i, deadline))
+        t_ref = max(frames[0][1] for frames in pending)
+        for i, frames in enumerate(pending):
+            # Keep only the last frame before the reference time and
+            # wait for one at or after it.
+            while True:
+                while len(frames) > 1 and frames[1][1] <= t_ref:
+                    self._skip(i)
+                if frames[-1][1] >= t_ref:
+                    break
+                frames.append(self._next(i, deadline))
+            if len(frames) > 1 and \
+               t_ref - frames[0][1] > frames[1][1] - t_ref:
+                self._skip(i)
+
+        matched = [frames.popleft() for frames in pending]
+        frame_set = FrameSet(
+            self.sets_delivered, [m[0] for m in matched],
+            [m[1] for m in matched])
+        self.sets_delivered += 1
+        self.bytes_delivered += sum(f.nbytes for f in frame_set.frames)
+        self.skew.add(frame_set.skew)
+        return frame_set
+
+    def release(self, frame_set):
+        """Return the frames of a set to their cameras."""
+        for camera, frame in zip(self.cameras, frame_set.frames):
+            camera.release_image(frame)
+
+    def frames(self, timeout=None):
+        """Iterate over frame sets until acquisition is stopped. Each
+        set is released when the next one is requested, so frames must
+        be copied if they are to be kept.
+
+        """
+        frame_set = None
+        try:
+            while True:
+                try:
+                    frame_set = self.get(timeout)
+                except IndexError:
+                    return
+                yield frame_set
+                self.release(frame_set)
+                frame_set = None
+        finally:
+            if frame_set is not None:
+                self.release(frame_set)
+
+    def frames_between(self, t0, t1):
+        """Return a list with the frames recorded by each camera's ring
+        buffer with timestamps ``t0 <= t <= t1``. See
+        :meth:`ringbuffer.BaseRingBuffer.frames_between`.
+
+        """
+        return [camera.rbuffer.frames_between(t0, t1)
+                if camera.rbuffer is not None else None
+                for camera in self.cameras]
+
+    def stats(self):
+        """Return a dict with the aggregate frame rate of all cameras
+        (``fps``), the rate (``set_fps``) and data rate (``MBps``) of
+        delivered sets, the inter-camera skew (count, mean, min, p50,
+        p99 and max in us) and per-camera acquisition and ring buffer
+        statistics.
+
+        """
+        elapsed = 0
+        if self._t_start is not None:
+            elapsed = (self._t_stop or time.perf_counter()) - self._t_start
+        cameras = []
+        for camera, engine, unmatched in zip(
+                self.cameras, self._engines, self.frames_unmatched):
+            stats = engine.stats()
+            stats['unmatched'] = unmatched
+            stats['serial'] = getattr(camera, 'serial', None)
+            if camera.rbuffer is not None:
+                stats['rbuffer'] = camera.rbuffer.stats()
+            cameras.append(stats)
+        acquired = sum(engine.frames_acquired for engine in self._engines)
+        return {
+            'sets': self.sets_delivered,
+            'fps': acquired/elapsed if elapsed else 0.,
+            'set_fps': self.sets_delivered/elapsed if elapsed else 0.,
+            'MBps': self.bytes_delivered/elapsed/1e6 if elapsed else 0.,
+            'skew': self.skew.summary(),
+            'cameras': cameras,
+        }
+
+
+def main(argv=None):
+    """Command line interface. Run with ``--help`` for details."""
+    parser = argparse.ArgumentParser(
+        description='Acquire from several ThorLabs DCx cameras.')
+    parser.add_argument(
+        'serials', nargs='*', metavar='serial',
+        help='Serial numbers of the cameras to use (default: all).')
+    parser.add_argument(
+        '--list', action='store_true',
+        help='List connected cameras and exit.')
+    parser.add_argument(
+        '--fake', type=int, metavar='N', default=0,
+        help='Use N simulated cameras (see fakeuc480.py).')
+    parser.add_argument(
+        '--fps', type=float, default=60.,
+        help='Full frame rate of simulated cameras.')
+    parser.add_argument(
+        '--duration', type=float, default=5.,
+        help='Acquisition time in s.')
+    parser.add_argument(
+        '--no-record', dest='record', action='store_false',
+        help='Do not record frames to the per-camera ring buffers.')
+    parser.add_argument(
+        '--buffer-backend', choices=sorted(BACKENDS), default='hdf5',
+        help='Ring buffer backend to record to.')
+    parser.add_argument(
+        '--buffer-dir', default='.',
+        help='Directory to store the ring buffer files in.')
+    parser.add_argument(
+        '--json', action='store_true', help='Print statistics as JSON.')
+    args = parser.parse_args(argv)
+    if not args.json:
+        # Log to stdout; keep it clean for the JSON output otherwise.
+        setup_logging()
+
+    library = None
+    if args.fake:
+        from fakeuc480 import FakeUC480
+        library = FakeUC480(n_cameras=args.fake, fps=args.fps)
+    if args.list:
+        from thorlabs import list_cameras
+        cameras = list_cameras(library)
+        if args.json:
+            json.dump(cameras, sys.stdout, indent=2)
+            print()
+        else:
+            for c in cameras:
+                print('{camera_id:>3}  {device_id:>3}  {serial:<12} '
+                      '{model:<16} {}'.format(
+                    'in use' if c['in_use'] else '', **c))
+        return
+
+    group = CameraGroup(open_cameras(
+        args.serials or None, library, recording=args.record,
+        buffer_backend=args.buffer_backend, buffer_dir=args.buffer_dir))
+    t_end = time.perf_counter() + args.duration
+    with group:
+        for _ in group.frames(timeout=1.):
+            if time.perf_counter() >= t_end:
+                break
+    group.close()
+
+    stats = group.stats()
+    if args.json:
+        json.dump(stats, sys.stdout, indent=2)
+        print()
+    else:
+        logger.info(
+            '{sets} frame sets ({set_fps:.1f} per s), {fps:.1f} frames/s '
+            'in total, {MBps:.1f} MB/s'.format(**stats))
+        logger.info(
+            'Skew: p50={p50_us:.1f} us, p99={p99_us:.1f} us, '
+            'max={max_us:.1f} us'.format(**stats['skew']))
+
+
+if __name__ == "__main__":
+    main()
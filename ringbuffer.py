@@ -1,24 +1,112 @@
 """Ring buffer for automatic rolling storage of images as they are
 acquired.
 
+PyTables is only imported once it is needed (by the HDF5 backend,
+compression filters or exports) so that importing this module stays
+cheap for cameras recording to memory or not recording at all.
+
 """
 
+import os
 import os.path
-from datetime import datetime
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import zipfile
+import threading
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 import numpy as np
-import tables
 from log import logger
 
+#: Target size of the row band chunks of the HDF5 backend in bytes.
+HDF5_CHUNK_BYTES = 64*1024
 
-class RingBuffer(object):
-    """Buffer for automatic rolling storage of images to disk.
 
-    This utilizes the PyTables module for data persistence. A utility
-    :meth:`to_list` method is included for exporting to other arbitrary
-    formats. Additionally, several ``save`` methods are defined to
-    export to several other formats, with the caveat that they may
-    require additional external dependencies. See the relevant
-    docstrings for details.
+def _split_spec(spec):
+    """Split a compression spec into (complib, complevel, shuffle)."""
+    spec, _, shuffle = spec.partition('+')
+    if shuffle not in ('', 'shuffle', 'bitshuffle'):
+        raise ValueError("Invalid shuffle option: {}".format(shuffle))
+    complib, _, level = spec.rpartition(':')
+    if not level.isdigit():
+        complib, level = spec, 5
+    return complib, int(level), shuffle
+
+
+def parse_filters(spec):
+    """Create :class:`tables.Filters` from a compression spec.
+
+    Specs have the form ``complib[:complevel][+shuffle|+bitshuffle]``,
+    e.g., ``'zlib'``, ``'zlib:1'``, ``'blosc:lz4:5+bitshuffle'`` or
+    ``'blosc:zstd+shuffle'``. The compression libraries available
+    are those supported by PyTables: ``zlib``, ``lzo``, ``bzip2``,
+    ``blosc`` (optionally with a compressor, e.g., ``blosc:lz4``)
+    and ``blosc2``. The default level is 5 and no shuffling is
+    applied unless requested. ``None`` or ``'none'`` disable
+    compression. :class:`tables.Filters` instances are returned
+    unchanged.
+
+    """
+    import tables
+    if isinstance(spec, tables.Filters):
+        return spec
+    if spec is None or spec == 'none':
+        return tables.Filters(complevel=0)
+    complib, level, shuffle = _split_spec(spec)
+    return tables.Filters(
+        complevel=level, complib=complib,
+        shuffle=shuffle == 'shuffle', bitshuffle=shuffle == 'bitshuffle')
+
+
+def filters_available(spec):
+    """Check if the compression library required by a compression
+    spec (see :func:`parse_filters`) is available in this PyTables
+    installation.
+
+    """
+    import tables
+    if spec is None or spec == 'none':
+        return True
+    complib = _split_spec(spec)[0]
+    lib, _, compressor = complib.partition(':')
+    if tables.which_lib_version(lib) is None:
+        return False
+    if lib.startswith('blosc') and compressor:
+        return compressor in tables.blosc_compressor_list()
+    return True
+
+
+class BaseRingBuffer(object):
+    """Common functionality of ring buffer backends.
+
+    Images are stored by circular index in ``self._data``, an array of
+    shape ``(N, height, width)`` supporting numpy style indexing, and
+    per-slot metadata (host and hardware timestamps, hardware frame
+    counter, exposure time, ROI, frame number and frame shape) is kept
+    in the structured array ``self._slots``. Both are allocated by
+    :meth:`_allocate` when the first image is written (or on
+    initialization if ``shape`` and ``dtype`` are given). Smaller
+    images are stored in the upper left corner of a slot; an image
+    larger than the slots or of a different type causes the storage
+    to be reallocated, discarding the buffered images.
+
+    Host timestamps are taken from the monotonic clock in ns.
+    ``clock_offset`` converts them to ns since the Unix epoch and is
+    stored along with the images in all file formats.
+
+    Stored images can be read in chronological order all at once with
+    :meth:`to_array` or :meth:`read_range`, or lazily by iterating
+    over the ring buffer. A utility :meth:`to_list` method is included
+    for exporting to other arbitrary formats. Additionally, several
+    ``save`` methods are defined to export to several other formats,
+    with the caveat that they may require additional external
+    dependencies. See the relevant docstrings for details.
 
     """
     def __init__(self, **kwargs):
@@ -28,33 +116,48 @@ class RingBuffer(object):
         -----------------
         N : int
             Number of images to store in the ring buffer.
-        directory : str
-            The directory to buffer images to.
-        filename : str
-            Filename to use for the ring buffer file.
         recording : bool
             Activate recording when True, disable when False.
         roi : list
             The currently selected region of interest.
+        shape : tuple or None
+            Shape of images to preallocate storage for. Default: None
+            (allocate when the first image is written).
+        dtype : str or np.dtype
+            Type of images to preallocate storage for. Default:
+            ``'uint8'``.
 
         """
-        directory = kwargs.get('directory', '.')
-        filename = kwargs.get('filename', 'rbuffer.h5')
         recording = kwargs.get('recording', True)
         N = int(kwargs.get('N', 100))
         roi = kwargs.get('roi', [10, 100, 10, 100])
-        assert isinstance(directory, str)
-        assert isinstance(filename, str)
+        shape = kwargs.get('shape', None)
+        dtype = np.dtype(kwargs.get('dtype', np.uint8))
         assert isinstance(recording, (int, bool))
         assert isinstance(roi, (list, tuple, np.ndarray))
+        assert N >= 1
 
         self.recording = recording
         self.N = N
         self.roi = roi
+        self.latency = None
         self._index = 0
-        self.filename = os.path.join(directory, filename)
-        self.db = tables.open_file(self.filename, 'w', title="Ring Buffer")
-        self.db.create_group('/', 'images', 'Buffered Images')
+        self._shape = shape
+        self._dtype = dtype
+        self._data = None
+        self._slots = None
+        self._count = 0
+        self._lock = threading.RLock()
+
+        # Write statistics
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.frames_dropped = 0
+        self._t_first_write = None
+        self._t_last_write = None
+
+        # Offset converting monotonic timestamps to ns since the epoch
+        self.clock_offset = time.time_ns() - time.monotonic_ns()
 
     def __enter__(self):
         return self
@@ -67,10 +170,13 @@ class RingBuffer(object):
         buffer.
 
         """
-        return len(self.db.list_nodes('/images'))
+        return min(self._count, self.N)
 
     def close(self):
-        self.db.close()
+        """Release any resources held by the ring buffer."""
+
+    def drain(self):
+        """Block until all written frames have been stored."""
 
     @property
     def index(self):
@@ -93,83 +199,405 @@ class RingBuffer(object):
             logger.debug('Resuming ring buffer recording')
         self.recording = not self.recording
 
-    def write(self, data, roi=None):
+    def write(self, data, roi=None, info=None):
         """Add the data to the queue to be written to disk.
 
-        TODO: enable compression
+        ``info`` is an optional dict of per-frame metadata with any of
+        the keys ``timestamp`` (host time of acquisition from
+        :func:`time.monotonic_ns`; default: now), ``hw_timestamp``
+        (camera timestamp in ns), ``hw_frame`` (camera frame counter)
+        and ``exposure`` (exposure time in ms). Missing hardware
+        values are stored as -1 and a missing exposure as NaN.
+
+        If :attr:`latency` is an enabled
+        :class:`latency.LatencyRecorder`, the duration of each call
+        is recorded as the ``rbuffer_write`` stage.
 
         """
         if not self.recording:
             return
 
+        latency = self.latency
+        t0 = latency.clock() if latency and latency.enabled else None
         roi = roi or self.roi
+        info = info or {}
+        meta = (
+            info.get('timestamp') or time.monotonic_ns(),
+            info.get('hw_timestamp', -1),
+            info.get('hw_frame', -1),
+            info.get('exposure', np.nan),
+        )
+        if self._submit(self._index, data, roi, meta):
+            self._index = self._index + 1 if self._index < self.N - 1 else 0
+        if t0 is not None:
+            latency.record('rbuffer_write', t0)
+
+    def _submit(self, index, data, roi, meta):
+        """Store a frame at ``index``. Backends may override this to
+        defer storing. Returns False if the frame was dropped.
+
+        """
+        with self._lock:
+            self._write_frame(index, data, roi, meta)
+        return True
+
+    @staticmethod
+    def _metadata_dtype(ndim):
+        """Return the dtype of per-slot metadata for images with
+        ``ndim`` dimensions.
+
+        """
+        return np.dtype([
+            ('timestamp', np.int64),
+            ('hw_timestamp', np.int64),
+            ('hw_frame', np.int64),
+            ('exposure', np.float64),
+            ('roi', np.int64, (4,)),
+            ('frame', np.int64),
+            ('shape', np.int32, (ndim,)),
+        ])
+
+    def _preallocate(self):
+        """Allocate storage if the image shape was given on
+        initialization. Backends should call this at the end of their
+        initialization.
+
+        """
+        if self._shape is not None:
+            self._allocate(tuple(self._shape), self._dtype)
 
-        name = 'img{:04d}'.format(self._index)
-        try:
-            self.db.get_node('/images/' + name).remove()
-        except tables.NoSuchNodeError:
-            pass
-        finally:
-            # TODO: Adapt to CArray for compression
-            # filters = tables.Filters(complevel=5, complib='zlib')
-            arr = self.db.create_array('/images', name, data)
-            arr.attrs.timestamp = datetime.strftime(
-                datetime.now(), '%Y-%m-%d %H:%M:%S.%f')
-            arr.attrs.roi = roi
-            arr.flush()
-        self.db.flush()
-
-        self._index = self._index + 1 if self._index < self.N - 1 else 0
+    def _allocate(self, shape, dtype):
+        """Allocate ``self._data`` and ``self._slots`` for images of the
+        given shape and dtype, replacing any existing storage. All
+        slots should be marked as empty by setting their frame number
+        to -1.
+
+        """
+        raise NotImplementedError
+
+    def _begin_write(self, index):
+        """Called before slot ``index`` is overwritten."""
+
+    def _store_metadata(self, index):
+        """Persist the metadata of slot ``index`` if the backend keeps
+        it anywhere other than ``self._slots``. This is called once
+        writing the slot is complete.
+
+        """
+
+    def _write_frame(self, index, data, roi, meta):
+        """Store a single frame. The caller is responsible for holding
+        the lock.
+
+        """
+        if self._t_first_write is None:
+            self._t_first_write = time.perf_counter()
+        data = np.asarray(data)
+        if (self._data is None or data.dtype != self._data.dtype or
+                data.ndim != self._data.ndim - 1 or
+                any(n > m for n, m in zip(data.shape, self._data.shape[1:]))):
+            if self._data is not None:
+                logger.warning(
+                    'Image shape or type changed; '
+                    'discarding buffered images.')
+            self._allocate(data.shape, data.dtype)
+            self._count = 0
+        self._begin_write(index)
+        if data.shape == self._data.shape[1:]:
+            self._data[index] = data
+        else:
+            self._data[(index,) + tuple(slice(0, n) for n in data.shape)] = \
+                data
+
+        slot = self._slots[index:index + 1]
+        (slot['timestamp'], slot['hw_timestamp'], slot['hw_frame'],
+         slot['exposure']) = meta
+        slot['roi'] = roi
+        slot['frame'] = self.frames_written
+        slot['shape'] = data.shape
+        self._store_metadata(index)
+        self._count += 1
+
+        self.frames_written += 1
+        self.bytes_written += data.nbytes
+        self._t_last_write = time.perf_counter()
+
+    def stats(self):
+        """Return write statistics. Throughput is computed from the
+        time between starting to store the first frame and finishing
+        storing the last one.
+
+        """
+        frames, nbytes = self.frames_written, self.bytes_written
+        if self._t_first_write is not None:
+            elapsed = self._t_last_write - self._t_first_write
+        else:
+            elapsed = 0.
+        return {
+            'frames': frames,
+            'bytes': nbytes,
+            'dropped': self.frames_dropped,
+            'queued': 0,
+            'fps': frames/elapsed if elapsed > 0 else 0.,
+            'MBps': nbytes/elapsed/1e6 if elapsed > 0 else 0.,
+        }
+
+    def _check_slot(self, index):
+        """Raise an IndexError if nothing is stored at ``index``."""
+        if self._slots is None or not 0 <= index < self.N or \
+           self._slots['frame'][index] < 0:
+            raise IndexError("No image stored at index {}".format(index))
 
     def read(self, index):
-        """Return data from the ring buffer file."""
+        """Return data from the ring buffer."""
         assert type(index) is int
-        img = self.db.get_node('/images/img{:04d}'.format(index))
-        return np.array(img)
+        with self._lock:
+            self._check_slot(index)
+            shape = self._slots['shape'][index]
+            img = self._data[(index,) + tuple(slice(0, n) for n in shape)]
+            return np.array(img)
 
     def get_timestamp(self, index):
         """Return the timestamp associated with the specified image
-        index.
+        index in ns on the :func:`time.monotonic_ns` clock. Add
+        :attr:`clock_offset` to convert to ns since the Unix epoch.
 
         """
-        return self.db.get_node(
-            '/images/img{:04d}'.format(index)).attrs.timestamp
+        self._check_slot(index)
+        return int(self._slots['timestamp'][index])
 
     def get_roi(self, index):
         """Return the recorded ROI for the given index."""
-        return self.db.get_node('/images/img{:04d}'.format(index)).attrs.roi
+        self._check_slot(index)
+        return self._slots['roi'][index].tolist()
+
+    def _order(self):
+        """Return the indices of all stored slots in chronological
+        order.
+
+        """
+        if self._slots is None:
+            return np.empty(0, dtype=np.intp)
+        frames = self._slots['frame']
+        stored = np.flatnonzero(frames >= 0)
+        return stored[np.argsort(frames[stored], kind='stable')]
+
+    def _read_slots(self, slots):
+        """Read the given slots into one array of shape ``(n,) +
+        shape`` where ``shape`` is the largest image shape among the
+        slots. Runs of consecutive slots holding images of the same
+        shape are read with a single slice each. The caller is
+        responsible for holding the lock.
+
+        """
+        shapes = self._slots['shape'][slots]
+        if not len(slots):
+            return np.empty((0,) + self._data.shape[1:], self._data.dtype)
+        shape = tuple(shapes.max(axis=0))
+        out = np.zeros((len(slots),) + shape, dtype=self._data.dtype)
+        breaks = np.flatnonzero(
+            (np.diff(slots) != 1) | (np.diff(shapes, axis=0) != 0).any(axis=1))
+        start = 0
+        for stop in list(breaks + 1) + [len(slots)]:
+            crop = tuple(slice(0, n) for n in shapes[start])
+            first = slots[start]
+            out[(slice(start, stop),) + crop] = \
+                self._data[(slice(first, first + stop - start),) + crop]
+            start = stop
+        return out
+
+    def read_range(self, start=0, stop=None):
+        """Return stored images ``start`` to ``stop`` as a single array
+        of shape ``(n, height, width)``. Images are counted in
+        chronological order starting from the oldest image still in
+        the buffer and negative values count from the newest one as
+        with Python slices. If the images differ in size, smaller
+        images are padded with zeros.
+
+        """
+        with self._lock:
+            if self._data is None:
+                return np.empty((0, 0, 0), dtype=self._dtype)
+            return self._read_slots(self._order()[start:stop])
+
+    def to_array(self):
+        """Return all stored images in chronological order as a single
+        array. See :meth:`read_range`.
+
+        """
+        return self.read_range()
+
+    def _iter_records(self, chunk_size=16):
+        """Iterate over ``(image, metadata)`` pairs of the stored
+        images in chronological order. See :meth:`iter_frames`.
+
+        """
+        with self._lock:
+            slots = self._order()
+            frames = self._slots['frame'][slots] if len(slots) else []
+        for i in range(0, len(slots), chunk_size):
+            chunk = slots[i:i + chunk_size]
+            with self._lock:
+                if self._slots is None:
+                    return
+                valid = self._slots['frame'][chunk] == \
+                    frames[i:i + chunk_size]
+                chunk = chunk[valid]
+                if not len(chunk):
+                    continue
+                records = self._slots[chunk].copy()
+                data = self._read_slots(chunk)
+            for img, record in zip(data, records):
+                yield img[tuple(slice(0, n) for n in record['shape'])], record
+
+    def iter_frames(self, chunk_size=16):
+        """Iterate over the stored images in chronological order,
+        reading ``chunk_size`` images at a time to bound memory use.
+        Images overwritten before they could be read are skipped.
+
+        """
+        for img, _ in self._iter_records(chunk_size):
+            yield img
+
+    def __iter__(self):
+        return self.iter_frames()
+
+    def timestamps(self, wall=False):
+        """Return the timestamps of all stored images in chronological
+        order. Timestamps are in ns on the :func:`time.monotonic_ns`
+        clock unless ``wall`` is True, in which case they are
+        converted to wall clock time as an array of
+        ``datetime64[ns]``.
+
+        """
+        with self._lock:
+            slots = self._order()
+            timestamps = self._slots['timestamp'][slots] if len(slots) \
+                else np.empty(0, dtype=np.int64)
+        if wall:
+            return (timestamps + self.clock_offset).astype('datetime64[ns]')
+        return timestamps
+
+    def frames_between(self, t0, t1):
+        """Return the stored images with timestamps ``t0 <= t <= t1``
+        (on the clock used by :meth:`timestamps`) as a single array in
+        chronological order. See :meth:`read_range`. The frames are
+        found by binary search over the timestamps, which increase
+        with the frame number.
+
+        """
+        with self._lock:
+            if self._data is None:
+                return np.empty((0, 0, 0), dtype=self._dtype)
+            slots = self._order()
+            timestamps = self._slots['timestamp'][slots]
+            start = np.searchsorted(timestamps, t0, side='left')
+            stop = np.searchsorted(timestamps, t1, side='right')
+            return self._read_slots(slots[start:stop])
+
+    def rois(self):
+        """Return the ROIs of all stored images in chronological order
+        as an array of shape ``(n, 4)``.
+
+        """
+        with self._lock:
+            slots = self._order()
+            if not len(slots):
+                return np.empty((0, 4), dtype=np.int64)
+            return self._slots['roi'][slots]
 
     def to_list(self):
-        """Convert a :class:`RingBuffer` shelf to a list. This is useful
-        for examining and exporting images to other formats.
+        """Convert a ring buffer shelf to a list of images in
+        chronological order. This is useful for examining and
+        exporting images to other formats.
 
         """
-        listified = []
-        for i in range(self.N):
+        return [np.array(img) for img in self.iter_frames()]
+
+    def _export(self, filename, writer, block=True, progress=None,
+                chunk_size=16):
+        """Export the stored images with ``writer(f, records, job)``
+        where ``records`` iterates over ``(image, metadata)`` pairs.
+        The output is written to a temporary file which is moved in
+        place once complete.
+
+        """
+        self.drain()
+        with self._lock:
+            if self._data is None:
+                raise IndexError("No images stored in the ring buffer.")
+            job = ExportJob(filename, len(self), progress)
+            shape, dtype = self._data.shape[1:], self._data.dtype
+            records = self._iter_records(chunk_size)
+
+        def run():
+            tmp = filename + '.tmp'
             try:
-                listified.append(self.read(i))
-            except tables.NoSuchNodeError:
-                break
-        return listified
+                writer(tmp, records, job, shape, dtype)
+                os.replace(tmp, filename)
+                logger.info('Exported {} images to {}'.format(
+                    job.frames_written, filename))
+            except Exception as e:
+                logger.exception('Error exporting ring buffer.')
+                job.error = e
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            finally:
+                job._finish()
 
-    def save_as(self, filename):
+        if block:
+            run()
+            job.wait()
+        else:
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+        return job
+
+    def save_as(self, filename, block=True, progress=None, **kwargs):
         """Save the ring buffer to file filename. The output format
-        will depend on the extension of filename.
+        will depend on the extension of filename: ``.h5`` or ``.hdf5``
+        for HDF5, ``.fits`` for FITS, ``.npz`` for numpy archives and
+        ``.zip`` for a zip file of PNG images.
 
-        """
-        raise NotImplementedError(
-            "Saving ring buffers to other formats is not yet implemented.")
+        All formats are written by streaming images from the buffer in
+        chronological order, so memory use does not depend on the size
+        of the buffer, and keep per image timestamps and ROIs.
+
+        Parameters
+        ----------
+        filename : str
+            File to write to.
+        block : bool
+            If False, export in a background thread and return
+            immediately.
+        progress : callable or None
+            Function to call with the :class:`ExportJob` each time an
+            image has been written.
 
-        if filename[-3:] == 'zip':
-            pass  # TODO
-        elif filename[-2:] == 'h5':
-            pass  # TODO
-        elif filename[-4:] == 'fits':
-            pass  # TODO
-        elif filename[-3:] == 'npz':
-            self.save_as_numpy(filename)
+        Additional keyword arguments are passed on to the format
+        specific ``save_as_*`` method.
 
-    def save_as_hdf5(self, filename):
+        Returns
+        -------
+        ExportJob
+            The (possibly still running) export.
+
+        """
+        ext = os.path.splitext(filename)[1].lower()
+        savers = {
+            '.zip': self.save_as_zip,
+            '.h5': self.save_as_hdf5,
+            '.hdf5': self.save_as_hdf5,
+            '.fits': self.save_as_fits,
+            '.fit': self.save_as_fits,
+            '.npz': self.save_as_numpy,
+        }
+        if ext not in savers:
+            raise ValueError("Unknown file format: {}".format(ext))
+        return savers[ext](filename, block=block, progress=progress, **kwargs)
+
+    def save_as_hdf5(self, filename, compression=None, **kwargs):
         """Save the ring buffer to an HDF5 file using the PyTables
         library. This requires PyTables to be installed with either
         conda::
@@ -180,9 +608,46 @@ class RingBuffer(object):
 
           $ pip install tables
 
+        Images are stored in chronological order in the extendable
+        array ``/images/data`` and their metadata in the table
+        ``/images/meta``. Images smaller than the largest one are
+        stored in the upper left corner. ``compression`` is a
+        compression spec as accepted by :func:`parse_filters`. See
+        :meth:`save_as` for other keyword arguments.
+
         """
+        import tables
+        filters = parse_filters(compression)
+
+        def write(tmp, records, job, shape, dtype):
+            with tables.open_file(tmp, 'w', title="Ring Buffer") as db:
+                db.root._v_attrs.clock_offset = self.clock_offset
+                group = db.create_group('/', 'images', 'Buffered Images')
+                earray = db.create_earray(
+                    group, 'data', atom=tables.Atom.from_dtype(dtype),
+                    shape=(0,) + shape, chunkshape=(1,) + shape,
+                    filters=filters, expectedrows=job.total)
+                meta = db.create_table(
+                    group, 'meta', self._metadata_dtype(len(shape)),
+                    expectedrows=job.total)
+                frame = np.zeros((1,) + shape, dtype=dtype)
+                row = np.zeros(1, dtype=meta.dtype)
+                for img, record in records:
+                    if img.shape == shape:
+                        earray.append(img[np.newaxis])
+                    else:
+                        frame[:] = 0
+                        frame[(0,) + tuple(slice(0, n) for n in img.shape)] = \
+                            img
+                        earray.append(frame)
+                    for name in row.dtype.names:
+                        row[name] = record[name]
+                    meta.append(row)
+                    job._advance()
 
-    def save_as_fits(self, filename):
+        return self._export(filename, write, **kwargs)
+
+    def save_as_fits(self, filename, **kwargs):
         """Save the ring buffer to a FITS file using the Astropy
         library. This requires Astropy to be installed with either
         conda::
@@ -193,6 +658,12 @@ class RingBuffer(object):
 
           $ pip install astropy
 
+        Images are stored in chronological order as a cube in the
+        primary HDU and their metadata in a binary table extension
+        named ``META``. Images smaller than the largest one are stored
+        in the upper left corner. See :meth:`save_as` for keyword
+        arguments.
+
         Notes
         -----
         FITS is convenient for browsing a series of images as many
@@ -201,15 +672,1045 @@ class RingBuffer(object):
         __ http://imagej.nih.gov/ij/
 
         """
+        from astropy.io import fits
+
+        def write(tmp, records, job, shape, dtype):
+            # The cube size is written before streaming the images, so
+            # images overwritten during the export are left blank and
+            # marked with a frame number of -1.
+            header = fits.PrimaryHDU(
+                data=np.zeros((1,) + shape, dtype=dtype)).header
+            header['NAXIS3'] = job.total
+            header['CLKOFFS'] = (
+                self.clock_offset, 'ns from timestamps to Unix epoch')
+            meta = np.zeros(job.total, dtype=self._metadata_dtype(len(shape)))
+            meta['frame'] = -1
+            frame = np.zeros(shape, dtype=dtype)
+
+            def to_fits(a):
+                # FITS stores unsigned integers as signed integers offset
+                # by BZERO, which amounts to flipping the sign bit.
+                if dtype.kind != 'u' or dtype.itemsize == 1:
+                    return a
+                sign = dtype.type(1 << (8*dtype.itemsize - 1))
+                return (a ^ sign).view('i{}'.format(dtype.itemsize))
+
+            stream = fits.StreamingHDU(tmp, header)
+            try:
+                n = 0
+                for img, record in records:
+                    if n == job.total:
+                        break
+                    frame[:] = 0
+                    frame[tuple(slice(0, k) for k in img.shape)] = img
+                    stream.write(to_fits(frame))
+                    for name in meta.dtype.names:
+                        meta[n][name] = record[name]
+                    n += 1
+                    job._advance()
+                if n < job.total:
+                    logger.warning(
+                        '{} images were overwritten during the export.'.format(
+                            job.total - n))
+                    frame[:] = 0
+                    for _ in range(job.total - n):
+                        stream.write(to_fits(frame))
+            finally:
+                stream.close()
+            columns = fits.BinTableHDU(data=meta, name='META')
+            fits.append(tmp, columns.data, columns.header)
+
+        return self._export(filename, write, **kwargs)
 
-    def save_as_numpy(self, filename, compressed=False):
+    def save_as_numpy(self, filename, compressed=False, **kwargs):
         """Save the ring buffer to Numpy's native npz format. If
-        ``compressed`` is ``True``, save using :func:`numpy.savez_compressed`
-        instead of :func:`numpy.savez`.
+        ``compressed`` is ``True``, compress the archive like
+        :func:`numpy.savez_compressed` instead of :func:`numpy.savez`.
+
+        Images are stored in chronological order as ``arr_0``,
+        ``arr_1``, etc. and their metadata in arrays named after the
+        metadata fields (``timestamp``, ``hw_timestamp``,
+        ``hw_frame``, ``exposure``, ``roi``, ``frame`` and ``shape``)
+        and ``clock_offset``. See :meth:`save_as` for other keyword
+        arguments.
+
+        """
+        compression = zipfile.ZIP_DEFLATED if compressed else \
+            zipfile.ZIP_STORED
+
+        def write(tmp, records, job, shape, dtype):
+            rows = []
+            with zipfile.ZipFile(
+                    tmp, 'w', compression=compression, allowZip64=True) as zf:
+                for i, (img, record) in enumerate(records):
+                    with zf.open('arr_{}.npy'.format(i), 'w',
+                                 force_zip64=True) as f:
+                        np.lib.format.write_array(f, np.ascontiguousarray(img))
+                    rows.append(record)
+                    job._advance()
+                # Backends may keep additional fields in their records
+                # (e.g., the sequence counter of the mmap backend), so
+                # only the exported fields are copied.
+                meta = np.zeros(
+                    len(rows), dtype=self._metadata_dtype(len(shape)))
+                for name in meta.dtype.names:
+                    meta[name] = [row[name] for row in rows]
+                arrays = [(name, meta[name]) for name in meta.dtype.names]
+                arrays.append(('clock_offset', np.array(self.clock_offset)))
+                for name, arr in arrays:
+                    with zf.open(name + '.npy', 'w') as f:
+                        np.lib.format.write_array(f, arr)
+
+        return self._export(filename, write, **kwargs)
+
+    def save_as_zip(self, filename, **kwargs):
+        """Save the ring buffer to a zip file of PNG images, one per
+        frame, with the metadata of all images in ``metadata.csv``.
+        Images are named by frame number. See :meth:`save_as` for
+        keyword arguments.
 
         """
-        logger.warn(
-            'Saving in npz format loses timestamp and ROI information.')
-        logger.warn('Consider saving in FITS or HDF5 formats instead.')
-        save_func = np.savez_compressed if compressed else np.savez
-        save_func(filename, *self.to_list())
+        import PIL.Image
+
+        def write(tmp, records, job, shape, dtype):
+            with zipfile.ZipFile(tmp, 'w', allowZip64=True) as zf:
+                rows = ['frame,timestamp,wall_time,hw_timestamp,hw_frame,'
+                        'exposure,roi_x1,roi_y1,roi_x2,roi_y2']
+                for img, record in records:
+                    if img.dtype != np.uint8:
+                        img = img.astype(np.uint16)
+                    name = 'frame_{:08d}.png'.format(record['frame'])
+                    with zf.open(name, 'w') as f:
+                        PIL.Image.fromarray(img).save(f, format='PNG')
+                    wall_time = np.datetime64(
+                        int(record['timestamp']) + self.clock_offset, 'ns')
+                    rows.append('{},{},{},{},{},{},{}'.format(
+                        record['frame'], record['timestamp'], wall_time,
+                        record['hw_timestamp'], record['hw_frame'],
+                        record['exposure'],
+                        ','.join(str(x) for x in record['roi'])))
+                    job._advance()
+                zf.writestr('metadata.csv', '\n'.join(rows) + '\n')
+
+        return self._export(filename, write, **kwargs)
+
+
+class ExportJob(object):
+    """Progress of a ring buffer export started with
+    :meth:`BaseRingBuffer.save_as`.
+
+    Attributes
+    ----------
+    filename : str
+        The file being written.
+    total : int
+        Number of images to export.
+    frames_written : int
+        Number of images exported so far.
+    error : Exception or None
+        The error which stopped the export, if any.
+
+    """
+    def __init__(self, filename, total, callback=None):
+        self.filename = filename
+        self.total = total
+        self.frames_written = 0
+        self.error = None
+        self._callback = callback
+        self._done = threading.Event()
+
+    @property
+    def progress(self):
+        """Fraction of images exported."""
+        return float(self.frames_written)/self.total if self.total else 1.
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the export to finish. Returns False on timeout and
+        re-raises the error if the export failed.
+
+        """
+        if not self._done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def _advance(self):
+        self.frames_written += 1
+        if self._callback is not None:
+            self._callback(self)
+
+    def _finish(self):
+        self._done.set()
+        if self._callback is not None:
+            self._callback(self)
+
+
+class RingBuffer(BaseRingBuffer):
+    """Buffer for automatic rolling storage of images to disk.
+
+    This utilizes the PyTables module for data persistence. Images are
+    stored in a single preallocated ``(N, height, width)`` array
+    (``/images/data``) written in place by circular index. Each frame
+    is split into chunks of whole rows (about
+    :data:`HDF5_CHUNK_BYTES` each), so that images smaller than the
+    slots (e.g., after shrinking the camera AOI) only touch the chunks
+    they cover and the recorded images can be kept. Per-slot metadata is kept in a table
+    (``/images/meta``) of ``N`` rows and mirrored in memory so that
+    metadata lookups do not touch the file.
+
+    Writes can optionally be performed asynchronously ("write behind")
+    by a dedicated writer thread. In this mode, :meth:`write` only
+    copies the frame and queues it; the writer thread stores queued
+    frames in batches and flushes to disk at most every
+    ``flush_interval`` seconds. Use :meth:`drain` to wait until all
+    queued frames are on disk.
+
+    """
+    def __init__(self, **kwargs):
+        """Initialize the ring buffer. In addition to the keyword
+        arguments accepted by :class:`BaseRingBuffer`, the following
+        are accepted.
+
+        Keyword arguments
+        -----------------
+        directory : str
+            The directory to buffer images to.
+        filename : str
+            Filename to use for the ring buffer file.
+        async_write : bool
+            Write frames to disk in a background thread. Default:
+            False.
+        max_queue : int
+            Maximum number of frames waiting to be written in
+            asynchronous mode. Default: 64.
+        overflow : str
+            What to do when the write queue is full in asynchronous
+            mode: ``'block'`` until there is room or ``'drop'`` the
+            frame. Default: ``'block'``.
+        flush_interval : float
+            Maximum time in s between flushes to disk in asynchronous
+            mode. Default: 0.5.
+        batch_size : int
+            Flush after this many frames have been written in
+            asynchronous mode even if ``flush_interval`` has not yet
+            elapsed. Default: 32.
+        compression : str or tables.Filters or None
+            Compression filter to apply to stored images. See
+            :func:`parse_filters` for the format. Images are
+            compressed one chunk at a time. Default: None.
+
+        """
+        import tables
+        BaseRingBuffer.__init__(self, **kwargs)
+        directory = kwargs.get('directory', '.')
+        filename = kwargs.get('filename', 'rbuffer.h5')
+        async_write = kwargs.get('async_write', False)
+        max_queue = int(kwargs.get('max_queue', 64))
+        overflow = kwargs.get('overflow', 'block')
+        flush_interval = float(kwargs.get('flush_interval', 0.5))
+        batch_size = int(kwargs.get('batch_size', 32))
+        filters = parse_filters(kwargs.get('compression', None))
+        assert isinstance(directory, str)
+        assert isinstance(filename, str)
+        assert overflow in ('block', 'drop')
+        assert max_queue >= 1 and batch_size >= 1
+
+        self.filters = filters
+        self.filename = os.path.join(directory, filename)
+        self.db = tables.open_file(self.filename, 'w', title="Ring Buffer")
+        self.db.root._v_attrs.clock_offset = self.clock_offset
+        self.db.create_group('/', 'images', 'Buffered Images')
+        self._meta = None
+
+        # Asynchronous writing
+        self.async_write = async_write
+        self.overflow = overflow
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = None
+        self._writer = None
+        if async_write:
+            self._queue = queue.Queue(max_queue)
+            self._writer = threading.Thread(target=self._writer_loop)
+            self._writer.daemon = True
+            self._writer.start()
+        self._preallocate()
+
+    def close(self):
+        """Write any queued frames and close the ring buffer file."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        with self._lock:
+            self.db.close()
+
+    def _submit(self, index, data, roi, meta):
+        if not self.async_write:
+            with self._lock:
+                self._write_frame(index, data, roi, meta)
+                self.db.flush()
+            return True
+
+        # Copy the frame since the caller may reuse its buffer before
+        # the writer thread gets to it.
+        item = (index, np.array(data), roi, meta)
+        if self.overflow == 'block':
+            self._queue.put(item)
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.frames_dropped += 1
+                return False
+        return True
+
+    def _allocate(self, shape, dtype):
+        import tables
+        if self._data is not None:
+            self._data.remove()
+            self._meta.remove()
+        self._data = self.db.create_carray(
+            '/images', 'data', atom=tables.Atom.from_dtype(np.dtype(dtype)),
+            shape=(self.N,) + tuple(shape),
+            chunkshape=self._chunkshape(shape, dtype), filters=self.filters)
+        meta_dtype = self._metadata_dtype(len(shape))
+        self._slots = np.zeros(self.N, dtype=meta_dtype)
+        self._slots['frame'] = -1
+        self._meta = self.db.create_table(
+            '/images', 'meta', description=meta_dtype)
+        self._meta.append(self._slots)
+
+    @staticmethod
+    def _chunkshape(shape, dtype):
+        """Return a chunk shape of one frame and as many whole rows as
+        fit in :data:`HDF5_CHUNK_BYTES`.
+
+        """
+        shape = tuple(shape)
+        if not shape:
+            return (1,)
+        row_bytes = int(np.prod(shape[1:]))*np.dtype(dtype).itemsize
+        rows = max(1, min(shape[0], HDF5_CHUNK_BYTES//max(row_bytes, 1)))
+        return (1, rows) + shape[1:]
+
+    def _store_metadata(self, index):
+        self._meta.modify_rows(
+            index, index + 1, rows=self._slots[index:index + 1])
+
+    def _writer_loop(self):
+        """Store queued frames in batches until a ``None`` sentinel
+        is received. :class:`threading.Event` items are set once all
+        frames queued before them have been flushed to disk.
+
+        """
+        unflushed = 0
+        last_flush = time.perf_counter()
+        running = True
+        while running:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+            waiters = []
+            with self._lock:
+                while True:
+                    if item is None:
+                        running = False
+                        break
+                    elif isinstance(item, threading.Event):
+                        waiters.append(item)
+                    elif item is not False:
+                        latency = self.latency
+                        t0 = latency.clock() \
+                            if latency and latency.enabled else None
+                        try:
+                            self._write_frame(*item)
+                            unflushed += 1
+                        except Exception:
+                            logger.exception('Error writing frame to disk.')
+                        if t0 is not None:
+                            latency.record('rbuffer_store', t0)
+                    if unflushed >= self.batch_size:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                now = time.perf_counter()
+                if unflushed and (waiters or not running or
+                                  unflushed >= self.batch_size or
+                                  now - last_flush >= self.flush_interval):
+                    self.db.flush()
+                    unflushed = 0
+                    last_flush = now
+            for event in waiters:
+                event.set()
+
+    def drain(self):
+        """Block until all queued frames have been written and flushed
+        to disk.
+
+        """
+        if self._writer is None:
+            with self._lock:
+                self.db.flush()
+            return
+        event = threading.Event()
+        self._queue.put(event)
+        event.wait()
+
+    def stats(self):
+        stats = BaseRingBuffer.stats(self)
+        stats['queued'] = self._queue.qsize() if self._queue else 0
+        return stats
+
+    def compression_ratio(self):
+        """Return the ratio of uncompressed to on-disk size of the
+        stored images.
+
+        """
+        with self._lock:
+            if self._data is None or not self._data.size_on_disk:
+                return 1.
+            stored = float(len(self))/self.N
+            return self._data.size_in_memory*stored/self._data.size_on_disk
+
+
+class MemoryRingBuffer(BaseRingBuffer):
+    """Ring buffer keeping images in memory.
+
+    Images are stored in a single preallocated numpy array of ``N``
+    frames, so writing a frame is a single copy with no disk I/O. The
+    contents can be snapshotted ("spilled") to an HDF5 file with the
+    same layout as a :class:`RingBuffer` file, either on demand with
+    :meth:`spill` or periodically by setting ``spill_interval``.
+
+    """
+    def __init__(self, **kwargs):
+        """Initialize the ring buffer. In addition to the keyword
+        arguments accepted by :class:`BaseRingBuffer`, the following
+        are accepted.
+
+        Keyword arguments
+        -----------------
+        directory : str
+            The directory to spill images to.
+        filename : str
+            Filename to use for spilled images. Default:
+            ``'rbuffer.h5'``.
+        spill_interval : float or None
+            If given, spill the buffer every ``spill_interval``
+            seconds in a background thread. Default: None.
+        compression : str or tables.Filters or None
+            Compression filter to apply to spilled images. See
+            :func:`parse_filters`. Default: None.
+
+        """
+        BaseRingBuffer.__init__(self, **kwargs)
+        directory = kwargs.get('directory', '.')
+        filename = kwargs.get('filename', 'rbuffer.h5')
+        spill_interval = kwargs.get('spill_interval', None)
+        assert isinstance(directory, str)
+        assert isinstance(filename, str)
+        assert spill_interval is None or spill_interval > 0
+
+        self.filename = os.path.join(directory, filename)
+        self.compression = kwargs.get('compression', None)
+        self.spill_interval = spill_interval
+        self._spilling = threading.Lock()
+        self._stop_spilling = threading.Event()
+        self._spiller = None
+        if spill_interval is not None:
+            self._spiller = threading.Thread(target=self._spill_loop)
+            self._spiller.daemon = True
+            self._spiller.start()
+        self._preallocate()
+
+    def close(self):
+        """Stop periodic spilling."""
+        if self._spiller is not None:
+            self._stop_spilling.set()
+            self._spiller.join()
+            self._spiller = None
+
+    def _allocate(self, shape, dtype):
+        self._data = np.zeros((self.N,) + tuple(shape), dtype=dtype)
+        self._slots = np.zeros(self.N, dtype=self._metadata_dtype(len(shape)))
+        self._slots['frame'] = -1
+
+    def _spill_loop(self):
+        while not self._stop_spilling.wait(self.spill_interval):
+            try:
+                self.spill()
+            except Exception:
+                logger.exception('Error spilling ring buffer to disk.')
+
+    def spill(self, filename=None, block=True):
+        """Write a snapshot of the buffer contents to an HDF5 file.
+
+        Taking the snapshot only requires copying the buffer in memory;
+        writing it to disk happens without holding up :meth:`write`.
+
+        Parameters
+        ----------
+        filename : str or None
+            File to write to. Defaults to the file given on
+            initialization. The file is replaced atomically so readers
+            never see a partially written snapshot.
+        block : bool
+            If False, write the snapshot in a background thread and
+            return immediately.
+
+        """
+        import tables
+        filename = filename or self.filename
+        filters = parse_filters(self.compression)
+        with self._lock:
+            if self._data is None:
+                return
+            data, slots = self._data.copy(), self._slots.copy()
+            index = self._index
+
+        def write():
+            with self._spilling:
+                tmp = filename + '.tmp'
+                with tables.open_file(tmp, 'w', title="Ring Buffer") as db:
+                    _write_layout(db, data, slots, filters)
+                    db.root._v_attrs.index = index
+                    db.root._v_attrs.clock_offset = self.clock_offset
+                os.replace(tmp, filename)
+            logger.debug('Spilled ring buffer to {}'.format(filename))
+
+        if block:
+            write()
+        else:
+            thread = threading.Thread(target=write)
+            thread.daemon = True
+            thread.start()
+
+
+def _write_layout(db, data, slots, filters=None):
+    """Write images and slot metadata to an open PyTables file using
+    the :class:`RingBuffer` layout.
+
+    """
+    import tables
+    group = db.create_group('/', 'images', 'Buffered Images')
+    carray = db.create_carray(
+        group, 'data', atom=tables.Atom.from_dtype(data.dtype),
+        shape=data.shape, chunkshape=(1,) + data.shape[1:], filters=filters)
+    carray[:] = data
+    db.create_table(group, 'meta', obj=slots)
+
+
+# Memory mapped ring buffer file layout: a header page followed by
+# per-slot metadata and the image data, each starting on a page
+# boundary.
+MMAP_MAGIC = b'QCRB'
+MMAP_VERSION = 2
+MMAP_PAGE = 4096
+MMAP_MAX_DIMS = 4
+MMAP_HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('N', '<i8'),
+    ('ndim', '<i8'),
+    ('shape', '<i8', (MMAP_MAX_DIMS,)),
+    ('dtype', 'S8'),
+    ('index', '<i8'),  # next slot to be written
+    ('seq', '<i8'),  # number of frames written
+    ('state', '<i8'),  # see MMAP_STATE_*
+    ('clock_offset', '<i8'),  # ns from timestamps to the Unix epoch
+])
+MMAP_STATE_CLOSED = 0
+MMAP_STATE_ACTIVE = 1
+MMAP_STATE_REPLACED = 2
+
+
+def _mmap_slot_dtype(ndim):
+    """Per-slot metadata of memory mapped ring buffers. ``seq`` is a
+    sequence lock: it is odd while the slot is being written.
+
+    """
+    return np.dtype(
+        [('seq', '<i8')] + BaseRingBuffer._metadata_dtype(ndim).descr)
+
+
+def _mmap_offsets(N, ndim):
+    """Return the offsets of the slot metadata and image data."""
+    def pad(n):
+        return n + (-n % MMAP_PAGE)
+    slots = pad(MMAP_HEADER_DTYPE.itemsize)
+    data = slots + pad(N*_mmap_slot_dtype(ndim).itemsize)
+    return slots, data
+
+
+class MmapRingBuffer(BaseRingBuffer):
+    """Ring buffer stored in a fixed size memory mapped file.
+
+    Images are written directly into the mapping, so the contents of
+    the buffer survive a crash of the writing process and other
+    processes can read the most recent frames without going through
+    PyTables by using :class:`MmapRingBufferReader`. Each slot is
+    protected by a sequence lock which lets readers detect frames that
+    were overwritten while being read.
+
+    If the image shape or type changes, a new file is created and
+    atomically moved in place of the old one, which is marked as
+    replaced so that readers know to reopen it.
+
+    """
+    def __init__(self, **kwargs):
+        """Initialize the ring buffer. In addition to the keyword
+        arguments accepted by :class:`BaseRingBuffer`, the following
+        are accepted.
+
+        Keyword arguments
+        -----------------
+        directory : str
+            The directory to store the ring buffer file in.
+        filename : str
+            Filename to use for the ring buffer file. Default:
+            ``'rbuffer.mmap'``.
+
+        """
+        BaseRingBuffer.__init__(self, **kwargs)
+        directory = kwargs.get('directory', '.')
+        filename = kwargs.get('filename', 'rbuffer.mmap')
+        assert isinstance(directory, str)
+        assert isinstance(filename, str)
+        self.filename = os.path.join(directory, filename)
+        self._header = None
+        self._preallocate()
+
+    def close(self):
+        """Flush the mapping to disk and mark the file as closed."""
+        with self._lock:
+            if self._header is None:
+                return
+            self._header['state'] = MMAP_STATE_CLOSED
+            self.drain()
+            self._header = self._slots = self._data = None
+
+    def drain(self):
+        """Flush the mapping to disk."""
+        with self._lock:
+            if self._header is not None:
+                for mm in (self._header, self._slots, self._data):
+                    mm.flush()
+
+    def _allocate(self, shape, dtype):
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        if len(shape) > MMAP_MAX_DIMS:
+            raise ValueError("Images can have at most {} dimensions".format(
+                MMAP_MAX_DIMS))
+        slots_offset, data_offset = _mmap_offsets(self.N, len(shape))
+        size = data_offset + self.N*int(np.prod(shape))*dtype.itemsize
+
+        # Create the new file next to the old one and then move it in
+        # place so that readers never see a half initialized file.
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.truncate(size)
+        header = np.memmap(tmp, MMAP_HEADER_DTYPE, 'r+', shape=())
+        header['magic'] = MMAP_MAGIC
+        header['version'] = MMAP_VERSION
+        header['N'] = self.N
+        header['ndim'] = len(shape)
+        header['shape'][:len(shape)] = shape
+        header['dtype'] = dtype.str
+        header['state'] = MMAP_STATE_ACTIVE
+        header['clock_offset'] = self.clock_offset
+        slots = np.memmap(
+            tmp, _mmap_slot_dtype(len(shape)), 'r+', offset=slots_offset,
+            shape=(self.N,))
+        slots['frame'] = -1
+        data = np.memmap(
+            tmp, dtype, 'r+', offset=data_offset, shape=(self.N,) + shape)
+        header.flush()
+        slots.flush()
+        if self._header is not None:
+            self._header['state'] = MMAP_STATE_REPLACED
+            self._header.flush()
+        os.replace(tmp, self.filename)
+        self._header, self._slots, self._data = header, slots, data
+
+    def _begin_write(self, index):
+        self._slots['seq'][index] += 1
+
+    def _store_metadata(self, index):
+        self._slots['seq'][index] += 1
+        self._header['index'] = (index + 1) % self.N
+        self._header['seq'] += 1
+
+
+class MmapRingBufferReader(object):
+    """Read-only access to a :class:`MmapRingBuffer` file from another
+    process.
+
+    Frames are copied out of the mapping and validated with the slot's
+    sequence lock, so returned frames are never torn even if the
+    writer overwrites the slot while it is being read.
+
+    """
+    def __init__(self, filename, retries=100):
+        """Map the ring buffer file ``filename``. Reading a slot which
+        is concurrently being written is retried up to ``retries``
+        times.
+
+        """
+        self.filename = filename
+        self.retries = retries
+        self.open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.close()
+
+    def __len__(self):
+        return int(min(self._header['seq'], self.N))
+
+    def open(self):
+        """(Re)open the ring buffer file."""
+        header = np.memmap(self.filename, MMAP_HEADER_DTYPE, 'r', shape=())
+        if header['magic'].item() != MMAP_MAGIC or \
+           header['version'].item() != MMAP_VERSION:
+            raise ValueError(
+                "{} is not a ring buffer file".format(self.filename))
+        self.N = int(header['N'])
+        ndim = int(header['ndim'])
+        self.shape = tuple(int(n) for n in header['shape'][:ndim])
+        self.dtype = np.dtype(header['dtype'].item().decode())
+        self.clock_offset = int(header['clock_offset'])
+        slots_offset, data_offset = _mmap_offsets(self.N, ndim)
+        self._header = header
+        self._slots = np.memmap(
+            self.filename, _mmap_slot_dtype(ndim), 'r', offset=slots_offset,
+            shape=(self.N,))
+        self._data = np.memmap(
+            self.filename, self.dtype, 'r', offset=data_offset,
+            shape=(self.N,) + self.shape)
+
+    def close(self):
+        self._header = self._slots = self._data = None
+
+    @property
+    def sequence(self):
+        """Total number of frames written to the buffer."""
+        return int(self._header['seq'])
+
+    @property
+    def index(self):
+        """Index of the next slot to be written."""
+        return int(self._header['index'])
+
+    @property
+    def active(self):
+        """True if a writer currently has the file open."""
+        return self._header['state'].item() == MMAP_STATE_ACTIVE
+
+    def replaced(self):
+        """True if the writer has replaced the file (e.g., because the
+        image shape changed). Call :meth:`open` to map the new file.
+
+        """
+        return self._header['state'].item() == MMAP_STATE_REPLACED
+
+    def read(self, index):
+        """Return a consistent copy of the frame in slot ``index`` and
+        its metadata as a dict.
+
+        Raises
+        ------
+        IndexError
+            If the slot is empty or could not be read consistently.
+
+        """
+        for _ in range(self.retries):
+            seq = self._slots['seq'][index]
+            if seq % 2:
+                continue
+            meta = self._slots[index].copy()
+            shape = meta['shape']
+            img = np.array(
+                self._data[(index,) + tuple(slice(0, n) for n in shape)])
+            if self._slots['seq'][index] == seq:
+                break
+        else:
+            raise IndexError(
+                "Slot {} is being written too frequently".format(index))
+        if meta['frame'] < 0:
+            raise IndexError("No image stored at index {}".format(index))
+        return img, {
+            'timestamp': int(meta['timestamp']),
+            'hw_timestamp': int(meta['hw_timestamp']),
+            'hw_frame': int(meta['hw_frame']),
+            'exposure': float(meta['exposure']),
+            'roi': meta['roi'].tolist(),
+            'frame': int(meta['frame']),
+        }
+
+    def latest(self):
+        """Return the most recently written frame and its metadata."""
+        return self.read((self.index - 1) % self.N)
+
+
+#: Available ring buffer backends.
+BACKENDS = {
+    'hdf5': RingBuffer,
+    'memory': MemoryRingBuffer,
+    'mmap': MmapRingBuffer,
+}
+
+
+#: Filters compared by :func:`benchmark_filters` by default.
+BENCHMARK_FILTERS = [
+    'none', 'zlib:1', 'zlib:5', 'lzo:1', 'bzip2:5',
+    'blosc:blosclz:5+shuffle', 'blosc:lz4:5+shuffle',
+    'blosc:lz4:5+bitshuffle', 'blosc:zstd:5+bitshuffle',
+]
+
+
+def benchmark_filters(frames, filters=BENCHMARK_FILTERS, **kwargs):
+    """Measure compression ratio and write throughput of ring buffer
+    compression filters.
+
+    Parameters
+    ----------
+    frames : list
+        Sample frames to write.
+    filters : list
+        Compression specs to test (see :func:`parse_filters`).
+
+    Additional keyword arguments are passed to :class:`RingBuffer`.
+
+    Returns
+    -------
+    results : list
+        One dict per filter with the compression ratio and achieved
+        throughput. Filters that are not available are skipped.
+
+    """
+    assert len(frames) > 0
+    kwargs.setdefault('N', len(frames))
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for spec in filters:
+            try:
+                available = filters_available(spec)
+            except ValueError as e:
+                logger.warning('Skipping filter {}: {}'.format(spec, e))
+                continue
+            if not available:
+                logger.warning(
+                    'Skipping filter {}: not available'.format(spec))
+                continue
+            rbuffer = RingBuffer(
+                directory=directory, filename='benchmark.h5',
+                compression=spec, **kwargs)
+            t0 = time.perf_counter()
+            for frame in frames:
+                rbuffer.write(frame)
+            rbuffer.drain()
+            elapsed = time.perf_counter() - t0
+            ratio = rbuffer.compression_ratio()
+            nbytes = rbuffer.bytes_written
+            rbuffer.close()
+            results.append({
+                'filter': spec,
+                'ratio': ratio,
+                'fps': len(frames)/elapsed,
+                'MBps': nbytes/elapsed/1e6,
+            })
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+#: Export formats checked by :func:`check_exports`.
+EXPORT_FORMATS = ('.h5', '.fits', '.npz', '.zip')
+
+
+def _read_export(filename):
+    """Read back an exported ring buffer. Returns the images (cropped
+    to their recorded shape) and host timestamps.
+
+    """
+    ext = os.path.splitext(filename)[1]
+    if ext == '.h5':
+        import tables
+        with tables.open_file(filename, 'r') as db:
+            data = db.root.images.data[:]
+            meta = db.root.images.meta[:]
+    elif ext == '.fits':
+        from astropy.io import fits
+        with fits.open(filename) as hdus:
+            data = np.array(hdus[0].data)
+            meta = np.array(hdus['META'].data)
+    elif ext == '.npz':
+        with np.load(filename) as npz:
+            n = len(npz['timestamp'])
+            images = [npz['arr_{}'.format(i)] for i in range(n)]
+            return images, npz['timestamp']
+    elif ext == '.zip':
+        import PIL.Image
+        with zipfile.ZipFile(filename) as zf:
+            rows = zf.read('metadata.csv').decode().splitlines()[1:]
+            frames = [int(row.split(',')[0]) for row in rows]
+            images = []
+            for frame in frames:
+                with zf.open('frame_{:08d}.png'.format(frame)) as f:
+                    images.append(np.array(PIL.Image.open(f)))
+            timestamps = [int(row.split(',')[1]) for row in rows]
+            return images, np.array(timestamps)
+    else:
+        raise ValueError("Unknown file format: {}".format(ext))
+    images = [img[tuple(slice(0, n) for n in shape)]
+              for img, shape in zip(data, meta['shape'])]
+    return images, meta['timestamp']
+
+
+def check_exports(backends=None, formats=EXPORT_FORMATS, N=4):
+    """Round-trip exports of each ring buffer backend: write more than
+    ``N`` frames of varying size, export them in each format, read the
+    files back and compare them with the buffer contents.
+
+    Returns
+    -------
+    results : list
+        One dict per backend and format with the number of frames
+        exported and an ``error`` message, which is None if the
+        export matched. Formats whose libraries are not installed are
+        skipped.
+
+    """
+    backends = list(BACKENDS) if backends is None else backends
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for backend in backends:
+            rbuffer = BACKENDS[backend](
+                directory=directory, N=N, filename='check.{}'.format(backend))
+            try:
+                for i in range(N + 2):
+                    shape = (16, 20) if i % 2 else (24, 32)
+                    img = np.arange(np.prod(shape), dtype=np.uint8)
+                    rbuffer.write(
+                        (img + i).reshape(shape),
+                        info={'timestamp': 1000 + i, 'hw_frame': i})
+                rbuffer.drain()
+                expected = rbuffer.to_list()
+                timestamps = rbuffer.timestamps()
+                for ext in formats:
+                    filename = os.path.join(directory, backend + ext)
+                    result = {'backend': backend, 'format': ext,
+                              'frames': 0, 'error': None}
+                    try:
+                        job = rbuffer.save_as(filename)
+                        if job.error is not None:
+                            raise job.error
+                        images, stored = _read_export(filename)
+                    except ImportError as e:
+                        logger.warning('Skipping {} export: {}'.format(ext, e))
+                        continue
+                    except Exception as e:
+                        result['error'] = '{}: {}'.format(type(e).__name__, e)
+                        results.append(result)
+                        continue
+                    result['frames'] = len(images)
+                    if len(images) != len(expected) or \
+                       any(a.shape != b.shape or (a != b).any()
+                           for a, b in zip(images, expected)):
+                        result['error'] = 'Images differ'
+                    elif not np.array_equal(stored, timestamps):
+                        result['error'] = 'Timestamps differ'
+                    results.append(result)
+            finally:
+                rbuffer.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def _load_sample(filename, n):
+    """Load up to ``n`` recorded frames from a ring buffer file."""
+    import tables
+    with tables.open_file(filename, 'r') as db:
+        data, meta = db.root.images.data, db.root.images.meta
+        stored = np.flatnonzero(meta.col('frame') >= 0)[:n]
+        shapes = meta.col('shape')
+        return [
+            data[(int(i),) + tuple(slice(0, m) for m in shapes[i])]
+            for i in stored]
+
+
+def main(argv=None):
+    """Command line interface. Run with ``--help`` for details."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark ring buffer compression filters.')
+    parser.add_argument(
+        'filename', nargs='?', default=None,
+        help='Ring buffer file to take sample frames from. If not '
+             'given, use simulated frames.')
+    parser.add_argument(
+        '-n', '--frames', type=int, default=50,
+        help='Number of frames to write per filter.')
+    parser.add_argument(
+        '-f', '--filters', nargs='+', default=BENCHMARK_FILTERS,
+        help='Compression specs to compare, e.g., zlib:1 '
+             'blosc:lz4:5+bitshuffle')
+    parser.add_argument(
+        '--async', dest='async_write', action='store_true',
+        help='Use asynchronous writing.')
+    parser.add_argument(
+        '--check-exports', action='store_true',
+        help='Round-trip exports of all backends and formats instead '
+             'of benchmarking filters.')
+    parser.add_argument(
+        '--json', action='store_true', help='Print results as JSON.')
+    args = parser.parse_args(argv)
+
+    if args.check_exports:
+        results = check_exports()
+        if args.json:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+        else:
+            for r in results:
+                print('{backend:<8}{format:<7}{frames:>4} frames  {}'.format(
+                    r['error'] or 'ok', **r))
+        return 1 if any(r['error'] for r in results) else 0
+
+    if args.filename:
+        frames = _load_sample(args.filename, args.frames)
+        if not frames:
+            parser.error('No frames stored in {}'.format(args.filename))
+    else:
+        from simulated import FrameGenerator
+        generator = FrameGenerator((1280, 1024), (500, 400), seed=0)
+        frames = [generator.render() for _ in range(args.frames)]
+
+    results = benchmark_filters(
+        frames, args.filters, async_write=args.async_write)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print('{:<28}{:>8}{:>10}{:>10}'.format(
+            'filter', 'ratio', 'frames/s', 'MB/s'))
+        for r in results:
+            print('{filter:<28}{ratio:>8.2f}{fps:>10.1f}{MBps:>10.1f}'.format(
+                **r))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,333 @@
+"""Simulated camera
+
+A software-only camera that synthesizes realistic beam images. This
+is useful for developing and benchmarking the acquisition path (ring
+buffer, image processing, etc.) on machines without a physical camera
+attached.
+
+"""
+
+import time
+import numpy as np
+from log import logger
+from camera import Camera
+from exceptions import CameraError
+
+
+class FrameGenerator(object):
+    """Vectorized synthesis of camera frames.
+
+    Frames consist of a Gaussian spot on top of a constant background
+    with shot noise and a fixed set of hot pixels. All work buffers are
+    preallocated whenever the readout geometry changes so that
+    rendering a frame does not allocate any memory beyond (optionally)
+    the output array.
+
+    Drawing fresh normal deviates for every pixel is far slower than
+    the rest of the rendering, so shot noise is taken from a random
+    offset into a pool of deviates generated once at startup.
+
+    """
+    def __init__(self, shape, center, **kwargs):
+        """Create a new frame generator.
+
+        Parameters
+        ----------
+        shape : tuple
+            Number of sensor pixels (x, y).
+        center : tuple
+            Center of the spot in sensor pixels (x, y).
+
+        Keyword arguments
+        -----------------
+        depth : int
+            Bits per pixel. Either 8 or 16. Default: 8.
+        sigma : float
+            Width of the spot in sensor pixels. Default: 1/20th of
+            the smallest sensor dimension.
+        peak : float
+            Peak height of the spot as a fraction of full scale when
+            ``scale`` is 1. Default: 0.6.
+        background : float
+            Background level as a fraction of full scale. Default:
+            0.02.
+        adu_gain : float
+            Electrons per count used for computing shot noise.
+            Default: 1.
+        hot_pixels : int
+            Number of hot pixels on the sensor. Default: 20.
+        seed : int or None
+            Seed for the random number generator.
+
+        """
+        depth = kwargs.get('depth', 8)
+        if depth not in (8, 16):
+            raise CameraError("depth must be 8 or 16.")
+        self.shape = tuple(shape)
+        self.center = tuple(center)
+        self.depth = depth
+        self.dtype = np.uint8 if depth == 8 else np.uint16
+        self.max_value = 2**depth - 1
+        self.sigma = float(kwargs.get('sigma', min(self.shape)/20.))
+        self.peak = float(kwargs.get('peak', 0.6))
+        self.background = float(kwargs.get('background', 0.02))
+        self.adu_gain = float(kwargs.get('adu_gain', 1.))
+        self.rng = np.random.default_rng(kwargs.get('seed', None))
+
+        n_hot = int(kwargs.get('hot_pixels', 20))
+        self._hot_x = self.rng.integers(0, self.shape[0], n_hot)
+        self._hot_y = self.rng.integers(0, self.shape[1], n_hot)
+
+        n_pixels = self.shape[0]*self.shape[1]
+        self._noise_pool = self.rng.standard_normal(
+            2*n_pixels, dtype=np.float32)
+
+        self.configure()
+
+    def configure(self, crop=None, bins=1):
+        """Set the readout geometry and (re)allocate work buffers.
+
+        Parameters
+        ----------
+        crop : list or None
+            Sensor area to read out in the form ``[horiz start, horiz
+            end, vert start, vert end]`` with indices starting from 1.
+            If None, use the full sensor.
+        bins : int
+            Bin size. Binned pixels are the sum of ``bins x bins``
+            sensor pixels.
+
+        """
+        if crop is None:
+            crop = [1, self.shape[0], 1, self.shape[1]]
+        x1, x2, y1, y2 = [int(c) for c in crop]
+        if x1 < 1 or y1 < 1 or x2 > self.shape[0] or y2 > self.shape[1]:
+            raise CameraError("Crop {} outside of sensor.".format(crop))
+        nx, ny = (x2 - x1 + 1)//bins, (y2 - y1 + 1)//bins
+        if nx < 1 or ny < 1:
+            raise CameraError("Crop is smaller than the bin size.")
+        self.crop = [x1, x2, y1, y2]
+        self.bins = bins
+
+        # Sensor coordinates of binned pixel centers.
+        x = (x1 - 1) + (np.arange(nx) + 0.5)*bins - 0.5
+        y = (y1 - 1) + (np.arange(ny) + 0.5)*bins - 0.5
+        gx = np.exp(-(x - self.center[0])**2/(2*self.sigma**2))
+        gy = np.exp(-(y - self.center[1])**2/(2*self.sigma**2))
+
+        # Noise free profile in counts (before exposure scaling) per
+        # binned pixel.
+        self._profile = np.multiply.outer(gy, gx).astype(np.float32)
+        self._profile *= self.peak*self.max_value*bins**2
+        self._background = self.background*self.max_value*bins**2
+        self._signal = np.empty_like(self._profile)
+        self._scratch = np.empty_like(self._profile)
+
+        # Hot pixels that fall within the readout area.
+        hx = (self._hot_x - (x1 - 1))//bins
+        hy = (self._hot_y - (y1 - 1))//bins
+        inside = (hx >= 0) & (hx < nx) & (hy >= 0) & (hy < ny)
+        self._hot = (hy[inside], hx[inside])
+
+    @property
+    def frame_shape(self):
+        """Shape of rendered frames as (rows, columns)."""
+        return self._profile.shape
+
+    def render(self, scale=1., out=None):
+        """Render a new frame.
+
+        Parameters
+        ----------
+        scale : float
+            Signal scale factor (e.g., exposure time relative to a
+            reference exposure times the gain).
+        out : np.ndarray or None
+            Array to write the frame to. Must have shape
+            :attr:`frame_shape` and the generator's dtype. If None, a
+            new array is allocated.
+
+        """
+        if out is None:
+            out = np.empty(self.frame_shape, dtype=self.dtype)
+        signal, scratch = self._signal, self._scratch
+        np.multiply(self._profile, scale, out=signal)
+        signal += self._background
+
+        # Shot noise (Gaussian approximation of Poisson statistics).
+        n = signal.size
+        offset = self.rng.integers(0, self._noise_pool.size - n + 1)
+        noise = self._noise_pool[offset:offset + n].reshape(signal.shape)
+        np.divide(signal, self.adu_gain, out=scratch)
+        np.sqrt(scratch, out=scratch)
+        scratch *= noise
+        signal += scratch
+
+        signal[self._hot] = self.max_value
+        np.clip(signal, 0, self.max_value, out=signal)
+        np.copyto(out, signal, casting='unsafe')
+        return out
+
+
+class SimulatedCamera(Camera):
+    """Camera producing synthetic frames at a configurable frame rate.
+
+    Frames show a Gaussian spot centered at ``sim_img_center`` with
+    shot noise and hot pixels. Exposure time, gain, crop and binning
+    all affect the generated frames the way they would on a real
+    sensor.
+
+    """
+    # Exposure time in ms giving the nominal signal level.
+    REFERENCE_EXPOSURE = 100.
+
+    def initialize(self, **kwargs):
+        """Configure the simulated sensor.
+
+        Keyword arguments
+        -----------------
+        shape : tuple
+            Number of sensor pixels (x, y). Default: (1280, 1024).
+        depth : int
+            Bits per pixel. Either 8 or 16. Default: 8.
+        fps : float or None
+            Target frame rate. If None, frames are produced as fast as
+            they can be rendered. Default: None.
+        reuse_buffer : bool
+            If True, always render into the same preallocated output
+            array. This avoids all allocations when acquiring but
+            means that returned frames are only valid until the next
+            acquisition. Default: False.
+
+        Additional keyword arguments are passed on to
+        :class:`FrameGenerator`.
+
+        """
+        shape = tuple(kwargs.get('shape', (1280, 1024)))
+        depth = kwargs.get('depth', 8)
+        fps = kwargs.get('fps', None)
+        reuse_buffer = kwargs.get('reuse_buffer', False)
+        assert len(shape) == 2
+        assert fps is None or fps > 0
+
+        if shape != self.shape:
+            self.shape = shape
+            x0 = np.random.randint(self.shape[0]//4, self.shape[0]//2)
+            y0 = np.random.randint(self.shape[1]//4, self.shape[1]//2)
+            self.sim_img_center = (x0, y0)
+        self.crop = [1, self.shape[0], 1, self.shape[1]]
+        self.fps = fps
+        self.reuse_buffer = reuse_buffer
+        self.running = False
+        self._next_frame = 0.
+
+        generator_kwargs = {
+            key: kwargs[key] for key in
+            ('sigma', 'peak', 'background', 'adu_gain', 'hot_pixels', 'seed')
+            if key in kwargs}
+        self.generator = FrameGenerator(
+            self.shape, self.sim_img_center, depth=depth, **generator_kwargs)
+        self._configure_buffers()
+
+    def get_camera_properties(self):
+        """Set properties matching the simulated sensor."""
+        self.props.update({
+            'pixels': list(self.shape),
+            'depth': self.generator.depth,
+            'bins': [1, 2, 4, 8],
+            'gain_range': [0, 40],
+            'exposure_range': [0.01, 10000],
+            'hardware_crop': True,
+            'gain_adjust': True,
+        })
+
+    def _configure_buffers(self):
+        """Reconfigure the generator for the current crop and binning
+        and preallocate the output buffer.
+
+        """
+        self.generator.configure(self.crop, self.bins)
+        self._out = np.empty(
+            self.generator.frame_shape, dtype=self.generator.dtype)
+
+    def close(self):
+        """Nothing to release for a simulated camera."""
+        self.running = False
+
+    def set_acquisition_mode(self, mode):
+        """Set the image acquisition mode."""
+        self.acq_mode = mode
+
+    def get_trigger_mode(self):
+        """Query the current trigger mode."""
+        return self.trigger_mode
+
+    def set_trigger_mode(self, mode):
+        """Setup trigger mode. Only internal triggering is
+        simulated.
+
+        """
+        self.trigger_mode = mode
+
+    def start(self):
+        """Start free running acquisition."""
+        self.running = True
+        self._next_frame = time.perf_counter()
+
+    def stop(self):
+        """Stop free running acquisition."""
+        self.running = False
+
+    def _wait_for_frame(self):
+        """Block until the next frame is due according to the target
+        frame rate.
+
+        """
+        if self.fps is None:
+            return
+        now = time.perf_counter()
+        if self._next_frame > now:
+            time.sleep(self._next_frame - now)
+        else:
+            # We fell behind: don't try to catch up with a burst of
+            # frames.
+            self._next_frame = now
+        self._next_frame += 1./self.fps
+
+    def acquire_image_data(self):
+        """Render a new frame."""
+        self._wait_for_frame()
+        scale = (self.t_ms/self.REFERENCE_EXPOSURE)*10**(self.gain/20.)
+        out = self._out if self.reuse_buffer else None
+        return self.generator.render(scale, out=out)
+
+    def update_exposure_time(self, t):
+        """Exposure time only affects the signal level of simulated
+        frames.
+
+        """
+        logger.debug('Simulated exposure time set to {} ms'.format(t))
+
+    def get_gain(self):
+        """Query the current gain in dB."""
+        return self.gain
+
+    def set_gain(self, gain, **kwargs):
+        """Set the camera gain in dB."""
+        low, high = self.props['gain_range']
+        if not low <= gain <= high:
+            raise CameraError(
+                "Gain must be in the range {}.".format([low, high]))
+        self.gain = gain
+
+    def update_crop(self, crop):
+        """Change the simulated sensor readout area."""
+        self._configure_buffers()
+
+    def set_bins(self, bins):
+        """Set binning to bins x bins."""
+        if bins not in self.props['bins']:
+            raise CameraError(
+                "Binning must be one of {}.".format(self.props['bins']))
+        self.bins = bins
+        self._configure_buffers()
@@ -10,34 +10,147 @@ __ https://github.com/bernardokyotoku/pydcu
 """
 import sys
 import ctypes
+from collections import deque
 from ctypes import *
 import numpy as np
+from log import logger
 from camera import Camera
+from framepool import FramePool
+from exceptions import ThorlabsDCxError
+
+UC480_DLL = \
+    'C:\\Program Files\\Thorlabs\\Scientific Imaging\\ThorCam\\uc480_64.dll'
+UEYE_SO = 'libueye_api.so'
+
+# Constants from uc480.h
+IS_SUCCESS = 0
+IS_TIMED_OUT = 122
+IS_DONT_WAIT = 0
+IS_FORCE_VIDEO_STOP = 0x4000
+IS_IGNORE_PARAMETER = -1
+IS_AOI_IMAGE_SET_AOI = 1
+IS_AOI_IMAGE_GET_AOI = 2
+IS_GET_FRAMERATE = 0x8000
+IS_USE_DEVICE_ID = 0x8000
+IS_SET_TRIGGER_OFF = 0x0000
+IS_SET_TRIGGER_HI_LO = 0x0001
+IS_SET_TRIGGER_LO_HI = 0x0002
+IS_SET_TRIGGER_SOFTWARE = 0x1000
+IS_GET_EXTERNALTRIGGER = 0x8000
+
+#: Trigger modes by name. ``'internal'`` is free run.
+TRIGGER_MODES = {
+    'internal': IS_SET_TRIGGER_OFF,
+    'software': IS_SET_TRIGGER_SOFTWARE,
+    'rising_edge': IS_SET_TRIGGER_LO_HI,
+    'falling_edge': IS_SET_TRIGGER_HI_LO,
+}
+
+
+def load_library(path=None):
+    """Load the uc480 library for the current platform.
+
+    Parameters
+    ----------
+    path : str or None
+        Path to the library to load. If None, use the default
+        location of the ThorCam DLL on Windows or ``libueye_api.so``
+        elsewhere.
+
+    """
+    if sys.platform.startswith('win'):
+        return ctypes.windll.LoadLibrary(path or UC480_DLL)
+    else:
+        return ctypes.cdll.LoadLibrary(path or UEYE_SO)
+
+
+def open_library(library):
+    """Return a loaded uc480 library given a path, a callable returning
+    the library or the library itself (see :func:`load_library`).
+
+    """
+    if library is None or isinstance(library, str):
+        return load_library(library)
+    elif callable(library):
+        return library()
+    return library
+
+
+def list_cameras(library=None):
+    """Enumerate the connected cameras with ``is_GetCameraList``.
+
+    Parameters
+    ----------
+    library : str, callable, library object or None
+        The uc480 library to use, as accepted by
+        :class:`ThorlabsDCx`.
+
+    Returns
+    -------
+    cameras : list
+        One dict per camera with its ``camera_id`` (to be passed to
+        :class:`ThorlabsDCx`), ``device_id``, ``sensor_id``,
+        ``serial``, ``model`` and whether it is ``in_use`` by another
+        program or handle. Camera IDs are set by the user and need not
+        be unique (cameras ship with ID 1), whereas device IDs are
+        assigned by the driver and are.
+
+    """
+    clib = open_library(library)
+    number_of_cameras = c_int(0)
+    _chk(clib.is_GetNumberOfCameras(byref(number_of_cameras)))
+    n = number_of_cameras.value
+    if n < 1:
+        return []
+    camera_list = camera_list_type(n)()
+    camera_list.dwCount = n
+    status = clib.is_GetCameraList(byref(camera_list))
+    if status != IS_SUCCESS:
+        raise ThorlabsDCxError(
+            "Could not list cameras: error {}".format(status))
+    # Cameras may have been disconnected since counting them.
+    return [{
+        'camera_id': info.dwCameraID,
+        'device_id': info.dwDeviceID,
+        'sensor_id': info.dwSensorID,
+        'serial': info.SerNo.decode('ascii', 'replace'),
+        'model': info.Model.decode('ascii', 'replace'),
+        'in_use': bool(info.dwInUse),
+    } for info in camera_list.uci[:min(camera_list.dwCount, n)]]
 
 
 def _chk(msg):
-    """Check for errors from the C library."""
+    """Check for errors from the C library. Errors are logged through
+    the rate limited qCamera logger (see :func:`log.setup_logging`), so
+    a persistent error cannot flood the log.
+
+    """
     if msg:
         if msg == 127:
-            print("Out of memory, probably because of a memory leak!!!")
+            logger.error(
+                "127: IS_OUT_OF_MEMORY: Out of memory, probably because "
+                "of a memory leak!")
         if msg == 125:
-            print("125: IS_INVALID_PARAMETER: One of the submitted " +
-                  "parameters is outside the valid range or is not " +
-                  "supported for this sensor or is not available in " +
-                  "this mode.")
+            logger.error(
+                "125: IS_INVALID_PARAMETER: One of the submitted "
+                "parameters is outside the valid range or is not "
+                "supported for this sensor or is not available in "
+                "this mode.")
         if msg == 159:
-            print(
-                "159: IS_INVALID_BUFFER_SIZE: The image memory has an " +
-                "inappropriate size to store the image in the desired format.")
+            logger.error(
+                "159: IS_INVALID_BUFFER_SIZE: The image memory has an "
+                "inappropriate size to store the image in the desired "
+                "format.")
         if msg == 178:
             raise RuntimeError("ThorlabsDCx: Transfer error: 178")
         if msg == 1:
             raise RuntimeError("Invalid camera handle.")
         if msg == -1:
             raise RuntimeError("General error message: Likely the camera was disconnected!")
-        print(
-            "Unhandled error number: {}. \
-            See DCx_User_and_SDK_Manual.pdf for details".format(msg))
+        if msg not in (125, 127, 159):
+            logger.error(
+                "Unhandled error number: {}. See "
+                "DCx_User_and_SDK_Manual.pdf for details".format(msg))
 
 
 # Structures used by the ctypes code:
@@ -61,6 +174,57 @@ class IS_RECT(ctypes.Structure):
     ]
 
 
+class SENSORINFO(ctypes.Structure):
+    _fields_ = [
+        ("SensorID", c_ushort),
+        ("strSensorName", c_char*32),
+        ("nColorMode", c_char),
+        ("nMaxWidth", c_uint32),
+        ("nMaxHeight", c_uint32),
+        ("bMasterGain", c_int),
+        ("bRGain", c_int),
+        ("bGGain", c_int),
+        ("bBGain", c_int),
+        ("bGlobShutter", c_int),
+        ("wPixelSize", c_ushort),  # in units of 0.01 um
+        ("nUpperLeftBayerPixel", c_char),
+        ("Reserved", c_char*13)
+    ]
+
+
+class UEYETIME(ctypes.Structure):
+    _fields_ = [
+        ("wYear", c_ushort),
+        ("wMonth", c_ushort),
+        ("wDay", c_ushort),
+        ("wHour", c_ushort),
+        ("wMinute", c_ushort),
+        ("wSecond", c_ushort),
+        ("wMilliseconds", c_ushort),
+        ("byReserved", c_ubyte*10)
+    ]
+
+
+class UEYEIMAGEINFO(ctypes.Structure):
+    _fields_ = [
+        ("dwFlags", c_uint32),
+        ("byReserved1", c_ubyte*4),
+        ("u64TimestampDevice", c_uint64),  # in units of 0.1 us
+        ("TimestampSystem", UEYETIME),
+        ("dwIoStatus", c_uint32),
+        ("wAOIIndex", c_ushort),
+        ("wAOICycle", c_ushort),
+        ("u64FrameNumber", c_uint64),
+        ("dwImageBuffers", c_uint32),
+        ("dwImageBuffersInUse", c_uint32),
+        ("dwReserved3", c_uint32),
+        ("dwImageHeight", c_uint32),
+        ("dwImageWidth", c_uint32),
+        ("dwHostProcessTime", c_uint32),
+        ("byReserved", c_ubyte*32)
+    ]
+
+
 class CamInfo(ctypes.Structure):
     _fields_ = [
         ("SerNo", ctypes.c_char*12),
@@ -73,79 +237,291 @@ class CamInfo(ctypes.Structure):
     ]
 
 
-class ThorlabsDCx(Camera):
-    """Class for Thorlabs DCx series cameras."""
+class UC480_CAMERA_INFO(ctypes.Structure):
+    _fields_ = [
+        ("dwCameraID", c_uint32),
+        ("dwDeviceID", c_uint32),
+        ("dwSensorID", c_uint32),
+        ("dwInUse", c_uint32),
+        ("SerNo", c_char*16),
+        ("Model", c_char*16),
+        ("dwStatus", c_uint32),
+        ("dwReserved", c_uint32*2),
+        ("FullModelName", c_char*32),
+        ("dwReserved2", c_uint32*5)
+    ]
 
-    """Initialize the camera."""
-        # Load the library.
-    def initialize(self, **kwargs):
 
-        uc480_file = 'C:\\Program Files\\Thorlabs\\Scientific Imaging\\ThorCam\\uc480_64.dll'
-        self.clib = windll.LoadLibrary(uc480_file)
+def camera_list_type(n):
+    """Return the UC480_CAMERA_LIST structure type for ``n`` cameras.
+    The SDK declares it with a single entry and expects callers to
+    allocate as many as there are cameras.
 
+    """
+    class UC480_CAMERA_LIST(ctypes.Structure):
+        _fields_ = [
+            ("dwCount", c_uint32),
+            ("uci", UC480_CAMERA_INFO*max(n, 1))
+        ]
+    return UC480_CAMERA_LIST
 
-        
-        '''if 'win' in sys.platform:
-            try:
-                self.clib = ctypes.cdll.uc480_64
-            except:
-                self.clib = ctypes.cdll.uc480
-        else:
-            self.clib = ctypes.cdll.LoadLibrary('libueye_api.so')'''
 
+class ThorlabsDCx(Camera):
+    """Class for Thorlabs DCx series cameras.
+
+    The crop is done in hardware by setting the sensor's area of
+    interest (AOI), so smaller crops mean less data per frame and
+    higher frame rates. :attr:`shape` is the size of the current AOI
+    and :attr:`sensor_shape` that of the full sensor.
+
+    With several cameras connected, pass the ``serial`` number or
+    ``camera_id`` of the one to open (see :func:`list_cameras`); these
+    are available as :attr:`serial` and :attr:`camera_id` once the
+    camera is open.
+
+    Besides free running (``'internal'``), frames can be triggered by
+    software or by a rising or falling edge on the trigger input (see
+    :meth:`set_trigger_mode` and :data:`TRIGGER_MODES`). For low
+    latency, :meth:`arm` queues a burst of preallocated buffers with
+    the driver, so that a trigger involves no allocation or
+    reconfiguration.
 
+    """
 
-        # Initialize the camera. The filehandle being 0 initially
-        # means that the first available camera will be used. This is
-        # not really the right way of doing things if there are
-        # multiple cameras installed, but it's good enough for a lot
-        # of cases.
-        number_of_cameras = ctypes.c_int(0)
-        _chk(self.clib.is_GetNumberOfCameras(byref(number_of_cameras)))
-        if number_of_cameras.value < 1:
+    def initialize(self, **kwargs):
+        """Initialize the camera.
+
+        Keyword arguments
+        -----------------
+        library : str, callable or library object
+            The uc480 library to use. This can be a path to the
+            library, a callable returning a loaded library or an
+            already loaded library (e.g., a
+            :class:`fakeuc480.FakeUC480` instance). Default: load the
+            library with :func:`load_library`.
+        n_buffers : int
+            Number of preallocated frame buffers. In continuous mode
+            these form the driver's image sequence. Default: 8.
+        timeout_ms : int
+            Time to wait for a frame in continuous mode. Default:
+            1000.
+        max_frame_rate : bool
+            Raise the frame rate to the maximum the new AOI allows
+            whenever the AOI changes. Default: True.
+        camera_id : int
+            ID of the camera to open (see :func:`list_cameras`).
+            Default: 0, meaning the first available camera.
+        serial : str or None
+            Serial number of the camera to open. Takes precedence over
+            ``camera_id``. The camera is opened by its device ID, so
+            this works for cameras sharing a camera ID. Default: None.
+
+        """
+        # Load the library.
+        self.clib = open_library(kwargs.get('library', None))
+
+        # Find the camera to open. A camera ID of 0 means that the
+        # first camera not yet in use will be opened.
+        camera_id = int(kwargs.get('camera_id', 0))
+        serial = kwargs.get('serial', None)
+        assert camera_id >= 0
+        cameras = list_cameras(self.clib)
+        if not cameras:
             raise RuntimeError("No camera detected!")
-        self.filehandle = ctypes.c_int(0)
-        _chk(self.clib.is_InitCamera(
-            ctypes.pointer(self.filehandle)))
+        handle = camera_id
+        if serial is not None:
+            matches = [c for c in cameras if c['serial'] == str(serial)]
+            if not matches:
+                raise ThorlabsDCxError(
+                    "No camera with serial number {}. Connected: {}".format(
+                        serial, ', '.join(c['serial'] for c in cameras)))
+            # Camera IDs may be shared by several cameras.
+            camera_id = matches[0]['camera_id']
+            handle = matches[0]['device_id'] | IS_USE_DEVICE_ID
+        self.filehandle = ctypes.c_int(handle)
+        status = self.clib.is_InitCamera(
+            ctypes.pointer(self.filehandle), None)
+        if status != IS_SUCCESS:
+            raise ThorlabsDCxError(
+                "Could not open camera {}: error {}".format(
+                    serial or camera_id or '(first available)', status))
+        info = CamInfo()
+        if self.clib.is_GetCameraInfo(
+                self.filehandle, byref(info)) == IS_SUCCESS:
+            self.serial = info.SerNo.decode('ascii', 'replace')
+            self.camera_id = info.Select & 0xff
+        else:
+            self.serial = None
+            self.camera_id = camera_id or self.filehandle.value
+        logger.info('Opened camera {} (serial number {})'.format(
+            self.camera_id, self.serial))
 
-        # Resolution of camera. (height, width)
-        AOI = self.get_roi()
-        #print("Width, Height =%d, %d" % (AOI.s32Width, AOI.s32Height))
-        self.shape = (AOI.s32Width, AOI.s32Height)
+        # Resolution of the sensor and of the current AOI.
         self.props.load('thorlabs_dcx.json')
-
-        # Allocate memory:
-        # Declare variables for storing memory ID and memory start location:
-        self.pid = ctypes.c_int()
-        self.ppcImgMem = ctypes.c_char_p()
+        info = SENSORINFO()
+        if self.clib.is_GetSensorInfo(
+                self.filehandle, byref(info)) == IS_SUCCESS:
+            self.sensor_shape = (info.nMaxWidth, info.nMaxHeight)
+            self.props['pixels'] = list(self.sensor_shape)
+        else:
+            self.sensor_shape = tuple(self.props['pixels'])
+        self.max_frame_rate = kwargs.get('max_frame_rate', True)
+        self.fps = None
+        self._update_geometry()
 
         # Setting monocrome 8 bit color mode
         # (otherwise we would get several identical readings per pixel!)
         _chk(self.clib.is_SetColorMode(self.filehandle, 6))
+        self.depth = 8  # Camera is 8 bit.
 
-        # Allocate the right amount of memory:
-        bitdepth = 8  # Camera is 8 bit.
-        _chk(self.clib.is_AllocImageMem(
-            self.filehandle, self.shape[0], self.shape[1], bitdepth,
-            byref(self.ppcImgMem),  byref(self.pid)))
+        # Exposure time in effect (IS_EXPOSURE_CMD_GET_EXPOSURE)
+        exposure = c_double()
+        _chk(self.clib.is_Exposure(self.filehandle, 7, byref(exposure), 8))
+        self.t_ms = exposure.value
 
-        # Tell the driver to use the newly allocated memory:
-        _chk(self.clib.is_SetImageMem(
-            self.filehandle, self.ppcImgMem, self.pid))
+        # Allocate memory:
+        self.n_buffers = int(kwargs.get('n_buffers', 8))
+        self.pool = None
+        self.pid = None
+        self.ppcImgMem = None
+        self._pool_exhausted = False
+        self._image_info = {}
+        self.capturing = False
+        self.timeout_ms = int(kwargs.get('timeout_ms', 1000))
+        self.initialize_memory()
+
+        # Start in free run mode.
+        self.burst = None
+        self._sequence = set()
+        self._triggers = deque()
+        _chk(self.clib.is_SetExternalTrigger(
+            self.filehandle, IS_SET_TRIGGER_OFF))
+        self.trigger_mode = 'internal'
 
         # Enable autoclosing. This allows for safely closing the
         # camera if it is disconnected.
         _chk(self.clib.is_EnableAutoExit(self.filehandle, 1))
 
+    def initialize_memory(self):
+        """Allocate image memory for the current AOI.
+
+        Frames are captured directly into a pool of numpy arrays that
+        are registered with the driver using
+        ``is_SetAllocatedImageMem``, so acquiring an image involves no
+        allocation or copying. A driver allocated scratch memory is
+        used in case all pool buffers are in use.
+
+        """
+        capturing = self.capturing
+        if capturing:
+            self.stop()
+        self.free_memory()
+        AOI = self.get_roi()
+        width, height = AOI.s32Width, AOI.s32Height
+
+        # Lines in image memory are padded to a multiple of 4 bytes.
+        bytes_per_pixel = (self.depth + 7)//8
+        line = width*bytes_per_pixel
+        pitch = (line + (-line % 4))//bytes_per_pixel
+        dtype = np.uint8 if self.depth == 8 else np.uint16
+        self.frame_shape = (height, width)
+        self.pool = FramePool(self.n_buffers, (height, pitch), dtype)
+        for i in range(len(self.pool)):
+            address = c_void_p(self.pool.address(i))
+            pid = c_int()
+            _chk(self.clib.is_SetAllocatedImageMem(
+                self.filehandle, width, height, self.depth, address,
+                byref(pid)))
+            self.pool.tags[i] = (address, pid)
+        self._mem_index = {
+            pid.value: i for i, (_, pid) in enumerate(self.pool.tags)}
+
+        # Declare variables for storing memory ID and memory start
+        # location of the scratch memory:
+        self.pid = ctypes.c_int()
+        self.ppcImgMem = ctypes.c_char_p()
+        _chk(self.clib.is_AllocImageMem(
+            self.filehandle, width, height, self.depth,
+            byref(self.ppcImgMem), byref(self.pid)))
+        if capturing:
+            self.start()
+
+    def free_memory(self):
+        """Release all image memory registered with the driver."""
+        if self.pool is not None:
+            for address, pid in self.pool.tags:
+                _chk(self.clib.is_FreeImageMem(self.filehandle, address, pid))
+            self.pool = None
+        if self.ppcImgMem is not None:
+            _chk(self.clib.is_FreeImageMem(
+                self.filehandle, self.ppcImgMem, self.pid))
+            self.ppcImgMem = None
+            self.pid = None
+
     def close(self):
         """Close the camera safely."""
+        if self.capturing:
+            self.stop()
+        self.free_memory()
         _chk(self.clib.is_ExitCamera(self.filehandle))
 
     def start(self):
-        print("Starting??")
+        """Start continuous capture.
+
+        All pool buffers are added to the driver's image sequence so
+        that exposure of the next frame overlaps with readout of the
+        previous one. Completed frames are retrieved in order with
+        :meth:`get_image`. Buffers currently held by the caller are
+        locked until returned with :meth:`release_image`.
+
+        In free run mode the camera captures frames continuously. In
+        an external trigger mode it captures one frame per edge on the
+        trigger input and in software trigger mode one per call to
+        :meth:`trigger`. If a burst is armed (see :meth:`arm`), only
+        the burst buffers are added to the sequence.
+
+        """
+        if self.capturing:
+            return
+        if self.burst is None:
+            indices = list(range(len(self.pool)))
+        else:
+            indices = [
+                i for i in range(len(self.pool)) if self.pool.is_free(i)]
+            if len(indices) < self.burst:
+                raise ThorlabsDCxError(
+                    "Only {} of {} burst buffers are free. Release frames "
+                    "before arming.".format(len(indices), self.burst))
+            indices = indices[:self.burst]
+        _chk(self.clib.is_ClearSequence(self.filehandle))
+        for i in indices:
+            address, pid = self.pool.tags[i]
+            _chk(self.clib.is_AddToSequence(self.filehandle, address, pid))
+            if not self.pool.is_free(i):
+                _chk(self.clib.is_LockSeqBuf(
+                    self.filehandle, IS_IGNORE_PARAMETER, address))
+        self._sequence = set(indices)
+        self._triggers.clear()
+        _chk(self.clib.is_InitImageQueue(self.filehandle, 0))
+        # In software trigger mode, each is_FreezeVideo call in
+        # trigger() captures a frame into the sequence instead.
+        if self.trigger_mode != 'software':
+            _chk(self.clib.is_CaptureVideo(self.filehandle, IS_DONT_WAIT))
+        self.capturing = True
 
     def stop(self):
-        print("Stopping??")
+        """Stop continuous capture. An armed burst stays configured
+        and is re-armed by :meth:`start`.
+
+        """
+        if not self.capturing:
+            return
+        self.capturing = False
+        _chk(self.clib.is_StopLiveVideo(
+            self.filehandle, IS_FORCE_VIDEO_STOP))
+        _chk(self.clib.is_ExitImageQueue(self.filehandle))
+        _chk(self.clib.is_ClearSequence(self.filehandle))
+        self._sequence = set()
 
     def set_acquisition_mode(self, mode):
         """Set the image acquisition mode."""
@@ -154,37 +530,256 @@ class ThorlabsDCx(Camera):
         return self.clib.is_SetDisplayMode(self.filehandle, 0x8000)
 
     def acquire_image_data(self):
-        """Code for getting image data from the camera should be
-        placed here.
+        """Capture a frame into a free pool buffer and return a view
+        of it with the shape of the current AOI. Pass the frame to
+        :meth:`release_image` when done with it to recycle the buffer.
+        If no buffer is free, the frame is copied out of the driver's
+        scratch memory instead.
+
+        With latency instrumentation enabled, time spent in the driver
+        is recorded as the ``freeze`` (single frame) or ``wait``
+        (continuous mode), ``image_info``, ``wrap`` (numpy view) and
+        ``copy`` (if the frame had to be copied) stages. In continuous
+        mode the driver transfers frames into its buffers on its own,
+        so ``wait`` covers exposure, readout and transfer alike.
 
         """
-        # Allocate memory for image:
-        img_size = self.shape[0]*self.shape[1]/self.bins**2
-        c_array = ctypes.c_char*int(img_size)
-        c_img = c_array()
+        latency = self.latency if self.latency.enabled else None
+        if self.capturing:
+            return self._wait_for_image(latency)
+        index = self.pool.acquire()
+        if index is None:
+            return self._acquire_copy(latency)
+        address, pid = self.pool.tags[index]
+        _chk(self.clib.is_SetImageMem(self.filehandle, address, pid))
 
         # Take one picture: wait time is waittime * 10 ms:
-        waittime = c_int(100)
-        _chk(self.clib.is_FreezeVideo(self.filehandle, waittime))
+        t = latency.clock() if latency else 0
+        try:
+            _chk(self.clib.is_FreezeVideo(self.filehandle, 100))
+        except Exception:
+            self.pool.release(index)
+            raise
+        if latency:
+            t = latency.record('freeze', t)
+        self._read_image_info(pid)
+        if latency:
+            t = latency.record('image_info', t)
+        img = self.pool.buffers[index][:, :self.frame_shape[1]]
+        if latency:
+            latency.record('wrap', t)
+        return img
+
+    def _acquire_copy(self, latency=None):
+        """Acquire a frame using the scratch memory and copy it to a
+        newly allocated array.
 
-        # Copy image data from the driver allocated memory to the memory that we
-        # allocated.
+        """
+        if not self._pool_exhausted:
+            logger.warning(
+                'ThorlabsDCx: all frame buffers are in use; falling back '
+                'to copying frames. Use release_image to recycle frames.')
+            self._pool_exhausted = True
+        _chk(self.clib.is_SetImageMem(
+            self.filehandle, self.ppcImgMem, self.pid))
+        t = latency.clock() if latency else 0
+        _chk(self.clib.is_FreezeVideo(self.filehandle, 100))
+        if latency:
+            t = latency.record('freeze', t)
+        self._read_image_info(self.pid)
+        if latency:
+            t = latency.record('image_info', t)
+        buf = self.pool.buffers[0]
+        img = np.empty(buf.shape, dtype=buf.dtype)
         _chk(self.clib.is_CopyImageMem(
-            self.filehandle, self.ppcImgMem, self.pid, c_img))
+            self.filehandle, self.ppcImgMem, self.pid,
+            img.ctypes.data_as(c_void_p)))
+        if latency:
+            t = latency.record('copy', t)
+        img = img[:, :self.frame_shape[1]]
+        if latency:
+            latency.record('wrap', t)
+        return img
+
+    def _wait_for_image(self, latency=None):
+        """Wait for the next frame captured in continuous mode.
+
+        The driver locks the buffer holding the returned frame until it
+        is passed to :meth:`release_image`. To keep the driver from
+        running out of buffers, frames are copied and unlocked right
+        away when fewer than two buffers would remain available.
+
+        """
+        pcMem = c_void_p()
+        mem_id = c_int()
+        t = latency.clock() if latency else 0
+        status = self.clib.is_WaitForNextImage(
+            self.filehandle, self.timeout_ms, byref(pcMem), byref(mem_id))
+        if status == IS_TIMED_OUT:
+            # Frames of any outstanding triggers were lost.
+            self._triggers.clear()
+            raise ThorlabsDCxError("Timed out waiting for an image.")
+        _chk(status)
+        if latency:
+            t = latency.record('wait', t)
+        if self._triggers:
+            t_trigger = self._triggers.popleft()
+            if latency:
+                t = latency.record('trigger', t_trigger)
+        self._read_image_info(mem_id)
+        if latency:
+            t = latency.record('image_info', t)
+        index = self._mem_index[mem_id.value]
+        img = self.pool.buffers[index][:, :self.frame_shape[1]]
+        if latency:
+            t = latency.record('wrap', t)
+        # A burst only has the armed buffers, so it is up to the
+        # caller to release frames in time.
+        if (self.burst is None and self.pool.n_free <= 2) or \
+           not self.pool.take(index):
+            img = img.copy()
+            _chk(self.clib.is_UnlockSeqBuf(
+                self.filehandle, IS_IGNORE_PARAMETER, pcMem))
+            if latency:
+                latency.record('copy', t)
+        return img
+
+    def _read_image_info(self, mem_id):
+        """Read the hardware timestamp and frame counter of the image
+        in memory ``mem_id``. This has to happen before the memory is
+        reused for another frame.
 
-        # Pythonize and return.
-        img_array = np.frombuffer(c_img, dtype=ctypes.c_ubyte)
-        img_array.shape = (1024, 1280)  # FIXME
-        return img_array
+        """
+        info = UEYEIMAGEINFO()
+        status = self.clib.is_GetImageInfo(
+            self.filehandle, mem_id, byref(info), sizeof(info))
+        if status != IS_SUCCESS:
+            self._image_info = {}
+            return
+        self._image_info = {
+            'hw_timestamp': info.u64TimestampDevice*100,
+            'hw_frame': info.u64FrameNumber,
+        }
+
+    def get_image_info(self):
+        """Return the exposure time along with the hardware timestamp
+        (in ns) and frame counter of the most recent image.
+
+        """
+        info = {'exposure': self.t_ms}
+        info.update(self._image_info)
+        return info
+
+    def release_image(self, img):
+        """Return the buffer backing ``img`` to the frame pool."""
+        if self.pool is None:
+            return
+        index = self.pool.index_of(img)
+        if index is not None and self.pool.release(index) and \
+           index in self._sequence:
+            address, _ = self.pool.tags[index]
+            _chk(self.clib.is_UnlockSeqBuf(
+                self.filehandle, IS_IGNORE_PARAMETER, address))
 
     def get_trigger_mode(self):
-        """Query the current trigger mode."""
+        """Query the current trigger mode. Returns one of the names in
+        :data:`TRIGGER_MODES`.
+
+        """
+        code = self.clib.is_SetExternalTrigger(
+            self.filehandle, IS_GET_EXTERNALTRIGGER)
+        for mode, value in TRIGGER_MODES.items():
+            if value == code:
+                return mode
+        return self.trigger_mode
 
     def set_trigger_mode(self, mode):
-        """Setup trigger mode."""
+        """Set the trigger mode to one of :data:`TRIGGER_MODES`:
+        ``'internal'`` (free run), ``'software'`` (see
+        :meth:`trigger`), ``'rising_edge'`` or ``'falling_edge'``
+        (external trigger input). Capture is stopped while the mode
+        changes. Switching to free run disarms any burst.
+
+        """
+        if mode not in TRIGGER_MODES:
+            raise ThorlabsDCxError(
+                "Invalid trigger mode {}. Must be one of {}".format(
+                    mode, list(TRIGGER_MODES)))
+        capturing = self.capturing
+        self.stop()
+        try:
+            status = self.clib.is_SetExternalTrigger(
+                self.filehandle, TRIGGER_MODES[mode])
+            if status != IS_SUCCESS:
+                raise ThorlabsDCxError(
+                    "Could not set trigger mode {}: error {}".format(
+                        mode, status))
+            self.trigger_mode = mode
+            if mode == 'internal':
+                self.burst = None
+        finally:
+            if capturing:
+                self.start()
+
+    def arm(self, frames=None):
+        """Pre-arm a burst of ``frames`` triggered frames (default:
+        one per pool buffer).
+
+        The burst buffers are queued with the driver and capture is
+        started, so each trigger writes a frame straight into the next
+        buffer without any allocation or reconfiguration. Read the
+        frames with :meth:`get_image`; once all ``frames`` buffers are
+        held by the caller, further triggers are lost until frames are
+        passed to :meth:`release_image`.
+
+        """
+        if self.trigger_mode == 'internal':
+            raise ThorlabsDCxError(
+                "Set a trigger mode before arming a burst.")
+        frames = len(self.pool) if frames is None else int(frames)
+        assert frames >= 1
+        self.stop()
+        if frames > len(self.pool):
+            self.n_buffers = frames
+            self.initialize_memory()
+        self.burst = frames
+        self.start()
+
+    def disarm(self):
+        """Stop a burst and return to normal continuous capture the
+        next time :meth:`start` is called.
+
+        """
+        self.stop()
+        self.burst = None
 
     def trigger(self):
-        """Send a software trigger to take an image immediately."""
+        """Send a software trigger to capture a frame immediately.
+
+        Capture must be started (see :meth:`start` and :meth:`arm`).
+        In software trigger mode this captures a frame into the next
+        sequence buffer; in the external trigger modes it forces a
+        trigger as if an edge had occurred. With latency
+        instrumentation enabled, the time from this call until
+        :meth:`get_image` receives the frame is recorded as the
+        ``trigger`` stage. Frames are attributed to triggers in order,
+        so this is only meaningful if no external edges are received
+        at the same time.
+
+        """
+        if self.trigger_mode == 'internal':
+            raise ThorlabsDCxError("Camera is free running.")
+        if not self.capturing:
+            raise ThorlabsDCxError(
+                "Start capture or arm a burst before triggering.")
+        self._triggers.append(self.latency.clock())
+        if self.trigger_mode == 'software':
+            status = self.clib.is_FreezeVideo(self.filehandle, IS_DONT_WAIT)
+        else:
+            status = self.clib.is_ForceTrigger(self.filehandle)
+        if status != IS_SUCCESS:
+            self._triggers.pop()
+            raise ThorlabsDCxError("Trigger failed: error {}".format(status))
 
     def open_shutter(self):
         """Open the shutter."""
@@ -202,6 +797,8 @@ class ThorlabsDCx(Camera):
         SizeOfParam = 8
         _chk(self.clib.is_Exposure(
             self.filehandle, nCommand, byref(Param), SizeOfParam))
+        # The driver returns the exposure time actually set.
+        self.t_ms = Param.value
 
     def get_gain(self):
         """Query the current gain settings."""
@@ -210,52 +807,136 @@ class ThorlabsDCx(Camera):
         """Set the camera gain."""
 
     def get_roi(self):
-        """Define the region of interest."""
+        """Query the sensor AOI as an :class:`IS_RECT`."""
         rectAOI = IS_RECT()
-        _chk(self.clib.is_AOI(self.filehandle, 2, pointer(rectAOI), 4*4))
+        _chk(self.clib.is_AOI(
+            self.filehandle, IS_AOI_IMAGE_GET_AOI, pointer(rectAOI), 4*4))
         return rectAOI
 
+    def _update_geometry(self):
+        """Update :attr:`shape` and :attr:`crop` from the AOI in
+        effect.
+
+        """
+        AOI = self.get_roi()
+        self.shape = (AOI.s32Width, AOI.s32Height)
+        self.crop = [AOI.s32x + 1, AOI.s32x + AOI.s32Width,
+                     AOI.s32y + 1, AOI.s32y + AOI.s32Height]
+        self.roi_pos = [AOI.s32x, AOI.s32y]
+        self.roi_shape = [AOI.s32Width, AOI.s32Height]
+
+    def set_aoi(self, x, y, width, height):
+        """Set the sensor AOI to ``width x height`` pixels starting at
+        ``(x, y)`` (0-based) and reallocate the image memory to match.
+
+        The change is transactional: capture is paused while the AOI
+        and memory are changed, and if either fails the previous AOI
+        and memory are restored before the error is raised. Frames
+        acquired before the change remain valid, but are no longer
+        recycled by :meth:`release_image`.
+
+        Raises
+        ------
+        ThorlabsDCxError
+            If the sensor does not support the requested AOI (e.g.,
+            because of size or alignment constraints).
+
+        """
+        old = self.get_roi()
+        new = IS_RECT(x, y, width, height)
+        if (old.s32x, old.s32y, old.s32Width, old.s32Height) == \
+           (x, y, width, height):
+            return
+        capturing = self.capturing
+        if capturing:
+            self.stop()
+        try:
+            status = self.clib.is_AOI(
+                self.filehandle, IS_AOI_IMAGE_SET_AOI, byref(new),
+                sizeof(new))
+            if status != IS_SUCCESS:
+                raise ThorlabsDCxError(
+                    "Invalid AOI {}: error {}.".format(
+                        [x, y, width, height], status))
+            try:
+                self.initialize_memory()
+            except Exception:
+                logger.error('Reallocating image memory failed; '
+                             'restoring the previous AOI.')
+                _chk(self.clib.is_AOI(
+                    self.filehandle, IS_AOI_IMAGE_SET_AOI, byref(old),
+                    sizeof(old)))
+                self.initialize_memory()
+                raise
+            if self.max_frame_rate:
+                self.set_frame_rate(None)
+        finally:
+            self._update_geometry()
+            if capturing:
+                self.start()
+        logger.info('AOI set to {}x{} at ({}, {}).'.format(
+            width, height, x, y))
+
+    def update_crop(self, crop):
+        """Set the sensor AOI to the crop ``[horiz start, horiz end,
+        vert start, vert end]`` (indices starting from 1).
+
+        """
+        x1, x2, y1, y2 = [int(c) for c in crop]
+        self.set_aoi(x1 - 1, y1 - 1, x2 - x1 + 1, y2 - y1 + 1)
+
+    def reset_crop(self):
+        """Reset the AOI to the full sensor."""
+        self.set_crop([1, self.sensor_shape[0], 1, self.sensor_shape[1]])
+
+    def set_frame_rate(self, fps=None):
+        """Set the free run frame rate. If ``fps`` is None, use the
+        highest frame rate the current AOI and exposure time allow.
+        Returns the frame rate actually set. Since the exposure time
+        cannot exceed the frame time, an explicit ``fps`` may shorten
+        it.
+
+        """
+        if fps is None:
+            t_min, t_max, interval = c_double(), c_double(), c_double()
+            status = self.clib.is_GetFrameTimeRange(
+                self.filehandle, byref(t_min), byref(t_max), byref(interval))
+            if status != IS_SUCCESS or t_min.value <= 0:
+                return self.fps
+            fps = 1./max(t_min.value, self.t_ms/1000.)
+        actual = c_double()
+        _chk(self.clib.is_SetFrameRate(
+            self.filehandle, c_double(fps), byref(actual)))
+        self.fps = actual.value
+        exposure = c_double()
+        _chk(self.clib.is_Exposure(self.filehandle, 7, byref(exposure), 8))
+        self.t_ms = exposure.value
+        return self.fps
+
     def save_image(self):
         size = sizeof(ImageFileParams)
         params = ImageFileParams()
         params.nQuality = 0
         params.pwchFileName = u"mypic.bmp"
         params.ppcImageMem = None
-        print("size", size)
+        logger.debug("ImageFileParams size: {}".format(size))
         _chk(self.clib.is_ImageFile(self.filehandle, 2, pointer(params), size))
 
     def get_parameters(self):
         _chk(self.clib.is_ParameterSet(self.filehandle, 4, "file.ini", None))
 
     def set_roi_shape(self, set_roi_shape):
-        class IS_SIZE_2D(Structure):
-            _fields_ = [('s32Width', c_int), ('s32Height', c_int)]
-        AOI_size = IS_SIZE_2D(set_roi_shape[0], set_roi_shape[1]) #Width and Height
-            
-        is_AOI = self.clib.is_AOI
-        is_AOI.argtypes = [c_int, c_uint, POINTER(IS_SIZE_2D), c_uint]
-        i = is_AOI(self.filehandle, 5, byref(AOI_size), 8 )#5 for setting size, 3 for setting position
-        is_AOI(self.filehandle, 6, byref(AOI_size), 8 )#6 for getting size, 4 for getting position
-        self.roi_shape = [AOI_size.s32Width, AOI_size.s32Height]
-                # Resolution of camera. (height, width)
-        self.props.load('thorlabs_dcx.json')
-        if i == 0:
-            print("ThorCam ROI size set successfully.")
-            #self.initialize_memory()
-        else:
-            print("Set ThorCam ROI size failed with error code "+str(i))
+        """Set the AOI size to ``[width, height]`` keeping its
+        position. See :meth:`set_aoi`.
+
+        """
+        width, height = set_roi_shape
+        self.set_aoi(self.roi_pos[0], self.roi_pos[1], width, height)
 
     def set_roi_pos(self, set_roi_pos):
-        class IS_POINT_2D(Structure):
-            _fields_ = [('s32X', c_int), ('s32Y', c_int)]
-        AOI_pos = IS_POINT_2D(set_roi_pos[0], set_roi_pos[1]) #Width and Height
-            
-        is_AOI = self.clib.is_AOI
-        is_AOI.argtypes = [c_int, c_uint, POINTER(IS_POINT_2D), c_uint]
-        i = is_AOI(self.filehandle, 3, byref(AOI_pos), 8 )#5 for setting size, 3 for setting position
-        is_AOI(self.filehandle, 4, byref(AOI_pos), 8 )#6 for getting size, 4 for getting position
-        self.roi_pos = [AOI_pos.s32X, AOI_pos.s32Y]
-        if i == 0:
-            print("ThorCam ROI position set successfully.")
-        else:
-            print("Set ThorCam ROI size failed with error code "+str(i))
\ No newline at end of file
+        """Move the AOI to ``[x, y]`` keeping its size. See
+        :meth:`set_aoi`.
+
+        """
+        x, y = set_roi_pos
+        self.set_aoi(x, y, self.roi_shape[0], self.roi_shape[1])
@@ -0,0 +1,353 @@
+"""Live camera view.
+
+A :class:`LiveViewer` shows frames from a camera in a single matplotlib
+figure which is kept alive for the whole session: new frames only
+update the pixel data of one image artist, which is redrawn with
+blitting instead of redrawing the whole figure.
+
+Acquisition and display are decoupled. Frames are grabbed by the
+camera's background acquisition thread (see
+:meth:`camera.Camera.start_acquisition_thread`) and the viewer only
+keeps a downsampled copy of the most recent one; the display loop
+redraws at most ``fps`` times per second and skips frames arriving in
+between. Slow rendering therefore never lowers the acquisition rate.
+
+The viewer works with any matplotlib backend, including the
+off-screen ``Agg`` backend for running without a display::
+
+  $ python viewer.py --simulated --headless --duration 5 --json
+
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from log import logger, setup_logging
+from exceptions import CameraError
+
+# Interval in s over which frame rates are measured.
+_RATE_INTERVAL = 0.5
+
+
+class LiveViewer(object):
+    """Display frames from a camera as they are acquired.
+
+    Attributes
+    ----------
+    frames_received : int
+        Number of frames handed to the viewer by the acquisition
+        thread.
+    frames_displayed : int
+        Number of frames drawn.
+    acquisition_fps : float
+        Camera frame rate measured over the last interval. This
+        includes frames skipped by the display.
+    display_fps : float
+        Display frame rate measured over the last interval.
+
+    """
+    def __init__(self, camera, fps=30., cmap='gray', vmin=None, vmax=None,
+                 max_size=1024, show_fps=True):
+        """Create a new viewer.
+
+        Parameters
+        ----------
+        camera : Camera
+            The camera to display images from.
+        fps : float
+            Maximum display frame rate.
+        cmap : str
+            Name of a matplotlib colormap.
+        vmin, vmax : int or float or None
+            Color scale limits. If None, the full range of the image
+            type is used for integer images and the range of the first
+            frame otherwise.
+        max_size : int or None
+            Frames are decimated so that no side is displayed with
+            more than ``max_size`` pixels. Screens cannot show more
+            detail, and smaller frames are faster to copy and draw.
+            None disables decimation.
+        show_fps : bool
+            Overlay acquisition and display frame rates.
+
+        """
+        assert fps > 0
+        assert max_size is None or max_size >= 1
+        self.camera = camera
+        self.fps = fps
+        self.cmap = cmap
+        self.vmin = vmin
+        self.vmax = vmax
+        self.max_size = max_size
+        self.show_fps = show_fps
+        self.frames_received = 0
+        self.frames_displayed = 0
+        self.acquisition_fps = 0.
+        self.display_fps = 0.
+
+        self.figure = None
+        self._ax = None
+        self._image = None
+        self._text = None
+        self._background = None
+        self._latest = None
+        self._new_frame = False
+        self._lock = threading.Lock()
+        self._started_engine = False
+        self._closed = False
+        self._rate_time = None
+        self._rate_counts = (0, 0)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.stop()
+
+    def _decimation(self, shape):
+        if self.max_size is None:
+            return 1
+        return max(1, -(-max(shape[:2]) // self.max_size))
+
+    def _on_frame(self, frame):
+        """Keep a downsampled copy of the newest frame. Runs on the
+        acquisition engine's dispatch thread; frames are recycled by
+        the camera as soon as this returns.
+
+        """
+        step = self._decimation(frame.shape)
+        view = frame[::step, ::step]
+        with self._lock:
+            latest = self._latest
+            if latest is None or latest.shape != view.shape or \
+               latest.dtype != view.dtype:
+                latest = self._latest = np.empty_like(view)
+            np.copyto(latest, view)
+            self._new_frame = True
+            self.frames_received += 1
+
+    def start(self):
+        """Start acquiring frames. The figure is opened once the first
+        frame arrives.
+
+        """
+        engine = self.camera.engine
+        if engine is not None and engine.running:
+            raise CameraError(
+                "Acquisition thread already running; stop it before "
+                "starting the viewer.")
+        self.camera.start_acquisition_thread(
+            callback=self._on_frame, policy='drop_oldest')
+        self._started_engine = True
+        self._closed = False
+        self._rate_time = time.perf_counter()
+        self._rate_counts = (0, self.frames_displayed)
+
+    def stop(self):
+        """Stop acquiring frames. The figure is left open."""
+        if self._started_engine:
+            self.camera.stop_acquisition_thread()
+            self._started_engine = False
+
+    def _create_figure(self, frame):
+        import matplotlib.pyplot as plt
+        if self.vmin is None or self.vmax is None:
+            if frame.dtype.kind in 'ui':
+                info = np.iinfo(frame.dtype)
+                vmin, vmax = info.min, info.max
+            else:
+                vmin, vmax = float(frame.min()), float(frame.max())
+            self.vmin = vmin if self.vmin is None else self.vmin
+            self.vmax = vmax if self.vmax is None else self.vmax
+
+        self.figure, self._ax = plt.subplots()
+        self._image = self._ax.imshow(
+            frame, cmap=self.cmap, vmin=self.vmin, vmax=self.vmax,
+            interpolation='nearest', animated=True)
+        self.figure.colorbar(self._image, ax=self._ax)
+        self._text = self._ax.text(
+            0.02, 0.98, '', transform=self._ax.transAxes, va='top',
+            color='yellow', family='monospace', animated=True,
+            visible=self.show_fps)
+        canvas = self.figure.canvas
+        canvas.mpl_connect('draw_event', self._on_draw)
+        canvas.mpl_connect('close_event', self._on_close)
+        plt.show(block=False)
+        canvas.draw()
+
+    def _on_draw(self, event):
+        """Save the static parts of the figure after a full redraw
+        (e.g., when the window is resized) and draw the animated
+        artists on top.
+
+        """
+        canvas = self.figure.canvas
+        self._background = canvas.copy_from_bbox(self._ax.bbox)
+        self._ax.draw_artist(self._image)
+        self._ax.draw_artist(self._text)
+
+    def _on_close(self, event):
+        self._closed = True
+
+    def _update_rates(self, now):
+        elapsed = now - self._rate_time
+        if elapsed < _RATE_INTERVAL:
+            return
+        engine = self.camera.engine
+        acquired = 0 if engine is None else engine.frames_acquired
+        displayed = self.frames_displayed
+        self.acquisition_fps = (acquired - self._rate_counts[0])/elapsed
+        self.display_fps = (displayed - self._rate_counts[1])/elapsed
+        self._rate_time = now
+        self._rate_counts = (acquired, displayed)
+
+    def update(self):
+        """Draw the newest frame if there is one. Returns True if the
+        display was updated.
+
+        """
+        self._update_rates(time.perf_counter())
+        with self._lock:
+            if not self._new_frame:
+                return False
+            frame = self._latest.copy()
+            self._new_frame = False
+
+        if self.figure is None:
+            self._create_figure(frame)
+        elif frame.shape != self._image.get_array().shape:
+            # Crop or binning changed: the extent needs a full redraw.
+            self._image.set_data(frame)
+            self._image.set_extent(
+                (-0.5, frame.shape[1] - 0.5, frame.shape[0] - 0.5, -0.5))
+            self.figure.canvas.draw()
+        self._image.set_data(frame)
+        self._text.set_text('acq {:6.1f} fps\ndsp {:6.1f} fps'.format(
+            self.acquisition_fps, self.display_fps))
+
+        canvas = self.figure.canvas
+        canvas.restore_region(self._background)
+        self._ax.draw_artist(self._image)
+        self._ax.draw_artist(self._text)
+        canvas.blit(self._ax.bbox)
+        canvas.flush_events()
+        self.frames_displayed += 1
+        return True
+
+    def run(self, duration=None):
+        """Display frames until the figure is closed or ``duration``
+        seconds have passed.
+
+        """
+        self.start()
+        period = 1./self.fps
+        t_end = None if duration is None else time.perf_counter() + duration
+        try:
+            while not self._closed:
+                t0 = time.perf_counter()
+                if t_end is not None and t0 >= t_end:
+                    break
+                engine = self.camera.engine
+                if engine.error is not None:
+                    raise CameraError(
+                        "Acquisition failed: {}".format(engine.error))
+                self.update()
+                remaining = period - (time.perf_counter() - t0)
+                if remaining > 0:
+                    if self.figure is None:
+                        time.sleep(remaining)
+                    else:
+                        self.figure.canvas.start_event_loop(remaining)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stats(self):
+        """Return a dict of frame counters and rates."""
+        return {
+            'received': self.frames_received,
+            'displayed': self.frames_displayed,
+            'acquisition_fps': self.acquisition_fps,
+            'display_fps': self.display_fps,
+        }
+
+    def save(self, filename):
+        """Save the current figure to a file."""
+        if self.figure is None:
+            raise CameraError("Nothing displayed yet.")
+        self.figure.savefig(filename)
+
+    def close(self):
+        """Stop acquiring and close the figure."""
+        self.stop()
+        if self.figure is not None:
+            import matplotlib.pyplot as plt
+            plt.close(self.figure)
+            self.figure = None
+
+
+def main(argv=None):
+    """Command line interface. Run with ``--help`` for details."""
+    parser = argparse.ArgumentParser(description='Live camera view.')
+    parser.add_argument(
+        '--simulated', action='store_true',
+        help='Use a simulated camera instead of a ThorLabs DCx camera.')
+    parser.add_argument(
+        '--headless', action='store_true',
+        help='Render off-screen with the Agg backend.')
+    parser.add_argument(
+        '--fps', type=float, default=30.,
+        help='Maximum display frame rate.')
+    parser.add_argument(
+        '--duration', type=float, default=None,
+        help='Stop after this many seconds.')
+    parser.add_argument('--cmap', default='gray', help='Colormap.')
+    parser.add_argument(
+        '--save', metavar='FILE',
+        help='Save the last displayed frame to an image file.')
+    parser.add_argument(
+        '--json', action='store_true', help='Print statistics as JSON.')
+    args = parser.parse_args(argv)
+    if not args.json:
+        # Log to stdout; keep it clean for the JSON output otherwise.
+        setup_logging()
+
+    if args.headless:
+        import matplotlib
+        matplotlib.use('Agg')
+    if args.simulated:
+        from simulated import SimulatedCamera
+        camera = SimulatedCamera(recording=False, buffer_backend='memory')
+    else:
+        from thorlabs import ThorlabsDCx
+        camera = ThorlabsDCx()
+
+    with camera:
+        try:
+            camera.start()
+        except NotImplementedError:
+            pass
+        viewer = LiveViewer(camera, fps=args.fps, cmap=args.cmap)
+        viewer.run(args.duration)
+        camera.stop()
+        if args.save:
+            viewer.save(args.save)
+        viewer.close()
+
+    stats = viewer.stats()
+    if args.json:
+        json.dump(stats, sys.stdout, indent=2)
+        print()
+    else:
+        logger.info(
+            'Received {received} frames ({acquisition_fps:.1f} fps), '
+            'displayed {displayed} ({display_fps:.1f} fps)'.format(**stats))
+
+
+if __name__ == "__main__":
+    main()